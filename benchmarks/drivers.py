@@ -0,0 +1,348 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Driver workload benchmark.
+
+Drives the fiscal printer drivers through standard workloads over the
+protocol emulators, or replaying a session recorded from them, and
+accounts the commands sent, the bytes written and read, the time these
+bytes take on the serial line at each supported baud rate and the CPU
+spent by the driver per operation.
+
+Drivers lacking what the workloads need are skipped. A workload that
+fails is reported and left out of the results, and the exit status
+is then 1.
+
+Usage::
+
+    python benchmarks/drivers.py [-n ROUNDS] [-t emulator|replay]
+        [-o results.json] [-w workload] [brand:model ...]
+"""
+
+from decimal import Decimal
+import json
+import optparse
+import os
+import sys
+import tempfile
+import traceback
+
+from zope.interface import implements
+
+from stoqdrivers.emulator import PtyEmulator, get_protocol, get_protocols
+from stoqdrivers.emulator.capture import Capture, CapturePort
+from stoqdrivers.emulator.replay import ReplayPort
+from stoqdrivers.enum import TaxType
+from stoqdrivers.interfaces import ISerialPort
+from stoqdrivers.manifest import get_driver_info
+from stoqdrivers.printers.base import get_baudrate_values
+from stoqdrivers.printers.fiscal import FiscalPrinter
+from stoqdrivers.utils import BITS_PER_BYTE, monotonic, thread_time
+
+
+class MeterPort(object):
+    """ Counts the bytes going through a serial port. """
+    implements(ISerialPort)
+
+    def __init__(self, port):
+        self._port = port
+        self.reset()
+
+    def __getattr__(self, name):
+        return getattr(self._port, name)
+
+    def reset(self):
+        self.writes = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def setDTR(self, value=True):
+        return self._port.setDTR(value)
+
+    def getDSR(self):
+        return self._port.getDSR()
+
+    def waitDSR(self, timeout=None):
+        return self._port.waitDSR(timeout)
+
+    def read(self, n_bytes=1):
+        data = self._port.read(n_bytes)
+        if data:
+            self.bytes_read += len(data)
+        return data
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes_written += len(data)
+        return self._port.write(data)
+
+
+#
+# Workloads
+#
+
+
+def _sell(printer, n_items):
+    printer.open()
+    for i in range(n_items):
+        printer.add_item(u'%d' % (i + 1, ), u'Item %d' % (i + 1, ),
+                         Decimal('1.50'), printer.taxcode)
+    total = printer.totalize()
+    printer.add_payment(printer.payment, total)
+    printer.close()
+
+
+def sale(printer):
+    _sell(printer, 1)
+
+
+def sale_50(printer):
+    _sell(printer, 50)
+
+
+def cancel(printer):
+    printer.open()
+    printer.add_item(u'1', u'Item', Decimal('1.50'), printer.taxcode)
+    printer.cancel()
+
+
+def till(printer):
+    printer.open_till()
+    printer.till_add_cash(Decimal('100'))
+    printer.till_remove_cash(Decimal('50'))
+    printer.close_till()
+
+
+def sintegra(printer):
+    printer.get_sintegra()
+
+
+def gerencial(printer):
+    printer.gerencial_report_open()
+    printer.gerencial_report_print('\n'.join(['Line %d' % i
+                                             for i in range(10)]))
+    printer.gerencial_report_close()
+
+WORKLOADS = [
+    ('sale', sale),
+    ('sale-50', sale_50),
+    ('cancel', cancel),
+    ('till', till),
+    ('sintegra', sintegra),
+    ('gerencial', gerencial),
+]
+
+# Used by _connect, through FiscalPrinter, before any workload
+REQUIRED_METHODS = ['get_tax_constants', 'get_payment_constants']
+
+
+def get_missing_methods(brand, model):
+    """ Returns the methods the workloads need and the driver lacks,
+    the dataregis EP375 for instance has no tax constants.
+    """
+    driver_class = get_driver_info('printers', brand, model).load()
+    return [name for name in REQUIRED_METHODS
+            if not hasattr(driver_class, name)]
+
+
+#
+# Transports
+#
+
+
+class _Session(object):
+    """ A printer connected to a fresh emulator, ready to run a workload. """
+
+    def __init__(self, brand, model, capture=None):
+        self.emulator = PtyEmulator(get_protocol(brand, model))
+        self.emulator.start()
+        port = self.emulator.open_port()
+        if capture is not None:
+            port = CapturePort(port, capture)
+        self.port = MeterPort(port)
+        self.printer = _connect(brand, model, self.port)
+
+    def close(self):
+        self.emulator.stop()
+
+
+def _connect(brand, model, port):
+    printer = FiscalPrinter(brand=brand, model=model, port=port)
+    printer.taxcode = printer.get_tax_constant(TaxType.NONE)
+    printer.payment = printer.get_payment_constants()[0][0]
+    return printer
+
+
+def _measure(printer, port, workload):
+    port.reset()
+    start_cpu = thread_time()
+    start = monotonic()
+    workload(printer)
+    return monotonic() - start, thread_time() - start_cpu
+
+
+def _run_emulator(brand, model, workload, rounds):
+    wall = cpu = 0
+    for i in range(rounds):
+        session = _Session(brand, model)
+        try:
+            session.emulator.commands = 0
+            round_wall, round_cpu = _measure(session.printer, session.port,
+                                             workload)
+        finally:
+            session.close()
+        wall += round_wall
+        cpu += round_cpu
+    return session.emulator.commands, session.port, wall, cpu
+
+
+def _run_replay(brand, model, workload, rounds):
+    fd, filename = tempfile.mkstemp(suffix='.cap')
+    os.close(fd)
+    try:
+        # Record the whole session once, then replay it from the start
+        session = _Session(brand, model, capture=filename)
+        try:
+            session.emulator.commands = 0
+            _measure(session.printer, session.port, workload)
+            session.port.close()
+        finally:
+            session.close()
+        capture = Capture(filename)
+    finally:
+        os.unlink(filename)
+
+    wall = cpu = 0
+    for i in range(rounds):
+        port = MeterPort(ReplayPort(capture))
+        printer = _connect(brand, model, port)
+        round_wall, round_cpu = _measure(printer, port, workload)
+        wall += round_wall
+        cpu += round_cpu
+    return session.emulator.commands, port, wall, cpu
+
+TRANSPORTS = {
+    'emulator': _run_emulator,
+    'replay': _run_replay,
+}
+
+
+def run(brand, model, name, workload, transport, rounds):
+    """ Runs a workload and returns its results as a dictionary. """
+    result = dict(driver='%s:%s' % (brand, model), workload=name)
+    try:
+        commands, port, wall, cpu = TRANSPORTS[transport](
+            brand, model, workload, rounds)
+    except Exception:
+        result['error'] = traceback.format_exc().strip().split('\n')[-1]
+        return result
+    n_bytes = port.bytes_written + port.bytes_read
+    result.update(
+        commands=commands,
+        writes=port.writes,
+        bytes_written=port.bytes_written,
+        bytes_read=port.bytes_read,
+        wire_time=dict([(baudrate,
+                         n_bytes * BITS_PER_BYTE / float(baudrate))
+                        for baudrate in get_baudrate_values()]),
+        wall_time=wall / rounds,
+        cpu_time=cpu / rounds)
+    return result
+
+
+def main(args):
+    usage = "usage: %prog [options] [brand:model ...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-n', '--rounds',
+                      action="store",
+                      type="int",
+                      dest="rounds",
+                      default=5,
+                      help='Number of runs per workload')
+    parser.add_option('-t', '--transport',
+                      action="store",
+                      type="choice",
+                      choices=sorted(TRANSPORTS),
+                      dest="transport",
+                      default="emulator",
+                      help='Run over the emulators or replay them')
+    parser.add_option('-w', '--workload',
+                      action="append",
+                      dest="workloads",
+                      help='Workload to run, all of them by default')
+    parser.add_option('-o', '--output',
+                      action="store",
+                      dest="output",
+                      help='File where the results are saved as JSON')
+    options, args = parser.parse_args(args)
+
+    drivers = [name.split(':') for name in args[1:]]
+    if not drivers:
+        drivers = get_protocols()
+    workloads = [(name, workload) for name, workload in WORKLOADS
+                 if not options.workloads or name in options.workloads]
+
+    results = []
+    errors = []
+    skipped = []
+    print "%-22s %-10s %6s %8s %8s %10s %10s" % (
+        'driver', 'workload', 'cmds', 'written', 'read',
+        'wire 9600', 'cpu (ms)')
+    for brand, model in drivers:
+        missing = get_missing_methods(brand, model)
+        if missing:
+            skipped.append('%s:%s' % (brand, model))
+            print "%-22s %-10s skipped, lacks %s" % (
+                '%s:%s' % (brand, model), '*', ', '.join(missing))
+            continue
+        for name, workload in workloads:
+            result = run(brand, model, name, workload, options.transport,
+                         options.rounds)
+            if 'error' in result:
+                errors.append(result)
+                print "%-22s %-10s %s" % (result['driver'], name,
+                                          result['error'])
+                continue
+            results.append(result)
+            print "%-22s %-10s %6d %8d %8d %10.3f %10.3f" % (
+                result['driver'], name, result['commands'],
+                result['bytes_written'], result['bytes_read'],
+                result['wire_time']['9600'], result['cpu_time'] * 1000)
+
+    if options.output:
+        fp = open(options.output, 'w')
+        json.dump(dict(transport=options.transport, rounds=options.rounds,
+                       results=results, errors=errors, skipped=skipped),
+                  fp, indent=2, sort_keys=True)
+        fp.close()
+
+    if errors:
+        print >> sys.stderr, "%d workload(s) failed" % (len(errors), )
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,93 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Driver registry benchmark.
+
+Measures, in a fresh interpreter for each case, how long it takes to list
+the supported printers through the manifest and how many driver modules
+get imported, compared with importing every driver class as
+get_supported_printers() used to do.
+
+Usage::
+
+    python benchmarks/registry.py [-n ROUNDS]
+"""
+
+import optparse
+import subprocess
+import sys
+
+_LISTING = """
+import sys, time
+start = time.time()
+from stoqdrivers.printers.base import get_supported_printers
+printers = get_supported_printers()
+%s
+elapsed = time.time() - start
+drivers = [m for m in sys.modules
+           if m.count('.') == 3 and m.startswith('stoqdrivers.printers.')
+           and sys.modules[m] is not None]
+print elapsed, len(drivers)
+"""
+
+CASES = [
+    ('manifest', ''),
+    ('manifest + load one', "printers['bematech'][0].load()"),
+    ('import all drivers', """
+for infos in printers.values():
+    for info in infos:
+        info.load()
+"""),
+]
+
+
+def run_case(code):
+    output = subprocess.Popen([sys.executable, '-c', _LISTING % code],
+                              stdout=subprocess.PIPE).communicate()[0]
+    elapsed, modules = output.split()
+    return float(elapsed), int(modules)
+
+
+def main(args):
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-n', '--rounds',
+                      action="store",
+                      type="int",
+                      dest="rounds",
+                      default=5,
+                      help='Number of interpreters started per case')
+    options, args = parser.parse_args(args)
+
+    print "%-22s %12s %10s" % ('case', 'time (ms)', 'drivers')
+    for name, code in CASES:
+        results = [run_case(code) for i in range(options.rounds)]
+        elapsed = min([r[0] for r in results])
+        print "%-22s %12.3f %10d" % (name, elapsed * 1000, results[0][1])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
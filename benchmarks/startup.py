@@ -0,0 +1,126 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Device construction benchmark.
+
+Measures how long it takes to build a L{FiscalPrinter}, comparing the
+default construction, which opens the port and sets up the driver, with
+lazy construction, which only resolves the driver class.
+
+Usage::
+
+    python benchmarks/startup.py [-n ROUNDS] [brand:model ...]
+"""
+
+import optparse
+import sys
+import time
+
+from zope.interface import implements
+
+from stoqdrivers.exceptions import DriverError
+from stoqdrivers.interfaces import ISerialPort
+from stoqdrivers.printers.fiscal import FiscalPrinter
+
+DEFAULT_DRIVERS = ['bematech:MP25', 'bematech:MP4000', 'daruma:FS345',
+                   'dataregis:EP375', 'elgin:KFiscal', 'perto:Pay2023']
+
+
+class NullPort(object):
+    """ A port which is not connected to any device: everything written
+    is discarded and reads time out immediately.
+    """
+    implements(ISerialPort)
+
+    def getDSR(self):
+        return True
+
+    def waitDSR(self, timeout=None):
+        return True
+
+    def setDTR(self, value=True):
+        pass
+
+    def setParity(self, parity):
+        pass
+
+    def setTimeout(self, timeout):
+        pass
+
+    def setWriteTimeout(self, timeout):
+        pass
+
+    def write(self, data):
+        pass
+
+    def read(self, n_bytes=1):
+        return ''
+
+
+def construct(brand, model, lazy):
+    start = time.time()
+    try:
+        FiscalPrinter(brand=brand, model=model, port=NullPort(), lazy=lazy)
+    except DriverError:
+        # Drivers that talk to the printer in setup() time out on a
+        # NullPort, which is what happens at startup when the printer
+        # is turned off, so it is still a fair measure.
+        pass
+    return time.time() - start
+
+
+def main(args):
+    usage = "usage: %prog [options] [brand:model ...]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-n', '--rounds',
+                      action="store",
+                      type="int",
+                      dest="rounds",
+                      default=20,
+                      help='Number of constructions per driver')
+    options, args = parser.parse_args(args)
+
+    print "%-20s %12s %12s %12s" % ('driver', 'import (ms)',
+                                    'eager (ms)', 'lazy (ms)')
+    for name in args[1:] or DEFAULT_DRIVERS:
+        brand, model = name.split(':')
+
+        start = time.time()
+        __import__('stoqdrivers.printers.%s.%s' % (brand, model))
+        import_time = time.time() - start
+
+        eager = sum([construct(brand, model, False)
+                     for i in range(options.rounds)])
+        lazy = sum([construct(brand, model, True)
+                    for i in range(options.rounds)])
+        print "%-20s %12.3f %12.3f %12.3f" % (
+            name, import_time * 1000,
+            eager * 1000 / options.rounds,
+            lazy * 1000 / options.rounds)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,197 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Wire logging overhead benchmark.
+
+Compares the cost of logging a frame by formatting it eagerly, as the
+drivers used to, with the lazy logging of L{stoqdrivers.wirelog}, under
+the default logging setup where debug records are dropped by the
+console handler and with a handler emitting them, both when the coupon
+is sampled and when it is not.
+The saving per item is estimated by counting the records logged while
+adding an item on the emulator of the given driver.
+
+Usage::
+
+    python benchmarks/wirelog.py [-n CALLS] [brand:model]
+"""
+
+from decimal import Decimal
+import logging
+import optparse
+import sys
+import timeit
+
+from kiwi.log import Logger
+
+from stoqdrivers import wirelog
+from stoqdrivers.emulator import PtyEmulator, get_protocol
+from stoqdrivers.enum import TaxType
+from stoqdrivers.printers.fiscal import FiscalPrinter
+
+log = Logger('stoqdrivers.benchmark')
+
+# An item addition frame of the Bematech MP25
+FRAME = ('\x02\x8f\x00\x1c\x3f' + '123' + ' ' * 10 + 'Item one' +
+         ' ' * 21 + 'FF' + '000000010000' + '0001000' * 3 + '\xfa\x17')
+
+
+def eager():
+    log.debug(">>> %r (%d bytes)" % (FRAME, len(FRAME)))
+
+
+def lazy():
+    if wirelog.is_enabled(log):
+        log.debug(">>> %s (%d bytes)", wirelog.frame(FRAME), len(FRAME))
+
+
+def eager_call():
+    log.info("add_item(code=%r, description=%r, price=%r, "
+             "taxcode=%r, quantity=%r, unit=%r, discount=%r, "
+             "surcharge=%r, unit_desc=%r)" % (
+                 u'123', u'Item one', Decimal('10'), 'T1', Decimal('1'),
+                 0, Decimal('0'), Decimal('0'), ''))
+
+
+def lazy_call():
+    log.info("add_item(code=%r, description=%r, price=%r, "
+             "taxcode=%r, quantity=%r, unit=%r, discount=%r, "
+             "surcharge=%r, unit_desc=%r)",
+             u'123', u'Item one', Decimal('10'), 'T1', Decimal('1'),
+             0, Decimal('0'), Decimal('0'), '')
+
+
+class _Counter(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.frames = 0
+        self.calls = 0
+
+    def emit(self, record):
+        if record.name.startswith('stoqdrivers.emulator'):
+            return
+        if record.name == 'stoqdrivers.fiscalprinter':
+            self.calls += 1
+        elif isinstance(record.args, tuple) and [
+            arg for arg in record.args
+            if isinstance(arg, type(wirelog.frame('')))]:
+            self.frames += 1
+
+
+def count_records(brand, model):
+    """ Returns the number of frames and of printer calls logged while
+    adding an item.
+    """
+    emulator = PtyEmulator(get_protocol(brand, model))
+    emulator.start()
+    try:
+        printer = FiscalPrinter(brand=brand, model=model,
+                                port=emulator.open_port())
+        taxcode = printer.get_tax_constant(TaxType.NONE)
+        printer.open()
+        counter = _Counter()
+        logger = logging.getLogger('stoqdrivers')
+        logger.addHandler(counter)
+        wirelog.update()
+        try:
+            printer.add_item(u'123', u'Item one', Decimal('10'), taxcode)
+        finally:
+            logger.removeHandler(counter)
+            wirelog.update()
+        printer.cancel()
+    finally:
+        emulator.stop()
+    return counter.frames, counter.calls
+
+
+class _Formatter(logging.Handler):
+    def emit(self, record):
+        record.getMessage()
+
+
+def measure(func, calls):
+    return min(timeit.repeat(func, repeat=5, number=calls)) / calls
+
+
+def measure_frames(calls):
+    """ Returns the seconds taken to log a frame eagerly and lazily, in
+    a sampled coupon and in a coupon which is not
+    """
+    wirelog.update()
+    eager_time = measure(eager, calls)
+    wirelog.start_coupon()
+    sampled_time = measure(lazy, calls)
+    # A coupon which is not sampled behaves as if the sampling was 0
+    wirelog.set_sampling(0)
+    not_sampled_time = measure(lazy, calls)
+    wirelog.set_sampling(1)
+    wirelog.end_coupon()
+    return eager_time, sampled_time, not_sampled_time
+
+
+def main(args):
+    usage = "usage: %prog [options] [brand:model]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-n', '--calls',
+                      action="store",
+                      type="int",
+                      dest="calls",
+                      default=20000,
+                      help='Number of calls measured')
+    options, args = parser.parse_args(args)
+    if len(args) > 1:
+        brand, model = args[1].split(':')
+    else:
+        brand, model = 'bematech', 'MP25'
+
+    frames, calls = count_records(brand, model)
+    call_saved = (measure(eager_call, options.calls) -
+                  measure(lazy_call, options.calls))
+    print "%s:%s add_item logs %d frames and %d calls" % (
+        brand, model, frames, calls)
+    print "%-28s %10s %10s %14s" % ('', 'eager (us)', 'lazy (us)',
+                                    'saved/item (us)')
+
+    results = [('debug off', measure_frames(options.calls))]
+    handler = _Formatter()
+    log.addHandler(handler)
+    try:
+        results.append(('debug on', measure_frames(options.calls)))
+    finally:
+        log.removeHandler(handler)
+        wirelog.update()
+
+    for name, (eager_time, sampled_time, not_sampled_time) in results:
+        for coupon, lazy_time in [('sampled', sampled_time),
+                                  ('not sampled', not_sampled_time)]:
+            saved = frames * (eager_time - lazy_time) + calls * call_saved
+            print "%-28s %10.2f %10.2f %14.2f" % (
+                '%s, %s coupon' % (name, coupon), eager_time * 1e6,
+                lazy_time * 1e6, saved * 1e6)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -35,17 +35,21 @@ from stoqdrivers.configparser import StoqdriversConfig
 from stoqdrivers.enum import DeviceType
 from stoqdrivers.exceptions import CriticalError, ConfigError
 from stoqdrivers.translation import stoqdrivers_gettext
-from stoqdrivers.serialbase import SerialPort
+from stoqdrivers.serialbase import SerialBase, SerialPort
 
 _ = stoqdrivers_gettext
 
 log = Logger('stoqdrivers.basedev')
 
 
-class BaseDevice:
+class BaseDevice(object):
     """ Base class for all device interfaces, responsible for instantiate
     the device driver itself based on the brand and model specified or in
     the configuration file.
+
+    When created with lazy=True, the constructor only resolves the driver
+    class; the serial port is opened and the driver instantiated when the
+    first command is sent to the device (or when L{connect} is called).
     """
     typename_translate_dict = {
         DeviceType.PRINTER: "Printer",
@@ -58,7 +62,7 @@ class BaseDevice:
     device_type = None
 
     def __init__(self, brand=None, model=None, device=None, config_file=None,
-                 port=None, consts=None):
+                 port=None, consts=None, lazy=False):
         if not self.device_dirname:
             raise ValueError("Subclasses must define the "
                              "`device_dirname' attribute")
@@ -69,7 +73,11 @@ class BaseDevice:
         self.model = model
         self._port = port
         self._driver_constants = consts
+        self._driver_class = None
+        self._driver_instance = None
         self._load_configuration(config_file)
+        if not lazy:
+            self.connect()
 
     def _load_configuration(self, config_file):
         section_name = BaseDevice.typename_translate_dict[self.device_type]
@@ -95,16 +103,101 @@ class BaseDevice:
         if not driver_class:
             raise CriticalError("Device driver at %s needs a class called %s"
                                 % (name, class_name))
+        self._driver_class = driver_class
+        log.info(("Config data: brand=%s,device=%s,model=%s"
+                  % (self.brand, self.device, self.model)))
+
+    def _get_driver(self):
+        if self._driver_instance is None:
+            self.connect()
+        return self._driver_instance
+
+    _driver = property(_get_driver)
+
+    def _driver_connected(self):
+        """ Called right after the driver was instantiated, subclasses can
+        override this to do any setup that requires talking to the device.
+        """
+
+    def connect(self):
+        """ Opens the serial port and instantiates the driver. Devices
+        created with lazy=False (the default) are connected by the
+        constructor, lazy devices by the first command sent to them.
+        Calling this method on a connected device does nothing.
+        """
+        if self._driver_instance is not None:
+            return
         if not self._port:
             self._port = SerialPort(self.device)
 
-        self._driver = driver_class(self._port, consts=self._driver_constants)
-        log.info(("Config data: brand=%s,device=%s,model=%s"
-                  % (self.brand, self.device, self.model)))
-        self.check_interfaces()
+        self._driver_instance = self._driver_class(
+            self._port, consts=self._driver_constants)
+        # Left disconnected on failure, so that connecting can be retried
+        try:
+            self.check_interfaces()
+            self._driver_connected()
+        except Exception:
+            self._driver_instance = None
+            raise
+
+    def is_connected(self):
+        """ Returns True if the driver was already instantiated """
+        return self._driver_instance is not None
 
     def get_model_name(self):
-        return self._driver.model_name
+        return self._driver_class.model_name
+
+    def enable_stats(self, stats):
+        """ Starts collecting statistics of the commands sent to the
+        device, see L{stoqdrivers.stats}. Drivers which do not talk to a
+        serial port, like the virtual printer, ignore this.
+
+        @param stats: a L{stoqdrivers.stats.DriverStats} or None to stop
+        """
+        driver = self._driver
+        if isinstance(driver, SerialBase):
+            driver.enable_stats(stats)
+
+    def get_stats(self):
+        """ Returns the L{stoqdrivers.stats.DriverStats} set by
+        L{enable_stats} or None, also when not connected yet
+        """
+        driver = self._driver_instance
+        if isinstance(driver, SerialBase):
+            return driver.get_stats()
+        return None
+
+    def get_recorder(self):
+        """ Returns the L{stoqdrivers.flightrecorder.FlightRecorder} with
+        the last frames exchanged with the device, or None if the driver
+        does not talk to a serial port or is not connected yet.
+        """
+        driver = self._driver_instance
+        if isinstance(driver, SerialBase):
+            return driver.get_recorder()
+        return None
+
+    def get_breaker(self):
+        """ Returns the L{stoqdrivers.health.CircuitBreaker} of the
+        device, or None if the driver does not talk to a serial port or
+        is not connected yet.
+        """
+        driver = self._driver_instance
+        if isinstance(driver, SerialBase):
+            return driver.get_breaker()
+        return None
+
+    def check_health(self, timeout=0.5):
+        """ Checks if the device is replying, see
+        L{stoqdrivers.serialbase.SerialBase.check_health}. Drivers which
+        do not talk to a serial port are always healthy.
+
+        @param timeout: the read timeout of the probe, in seconds
+        @raises PrinterOfflineError: if the device is not replying
+        """
+        driver = self._driver
+        if isinstance(driver, SerialBase):
+            driver.check_health(timeout)
 
     def get_firmware_version(self):
         """Printer firmware version
@@ -122,11 +215,16 @@ class BaseDevice:
         is coming from the serial port.   It is necessary that a gobject main
         loop is already running before calling this method.
         """
+        self.connect()
         gobject.io_add_watch(self.get_port().fd, gobject.IO_IN,
                              lambda fd, cond: func(self, cond))
 
     def set_port(self, port):
-        self._driver.set_port(port)
+        self._port = port
+        if self.is_connected():
+            self._driver.set_port(port)
 
     def get_port(self):
+        if not self.is_connected():
+            return self._port
         return self._driver.get_port()
@@ -0,0 +1,112 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Timestamped binary captures of the conversations with a device.
+
+A capture starts with a header holding a magic string and the wall clock
+time when it started, followed by one record per read or write: the
+direction, the seconds since the start on a monotonic clock, the size of
+the payload and the payload itself. Records are appended to the file as
+they happen, so a capture can run for as long as needed.
+
+Capturing a port and replaying a capture are done by
+L{stoqdrivers.emulator.capture}.
+"""
+
+import struct
+import time
+
+from stoqdrivers.utils import monotonic
+
+MAGIC = 'STQCAP01'
+READ = 'R'
+WRITE = 'W'
+
+_HEADER = struct.Struct('<8sd')
+# direction, seconds since the start, payload size
+_RECORD = struct.Struct('<cdI')
+
+
+class CaptureWriter(object):
+    """ Appends records to a capture file.
+
+    @ivar start_time: the wall clock time when the capture started
+    """
+
+    def __init__(self, filename, start_time=None):
+        """ Creates the capture file.
+
+        @param start_time: the wall clock time when the capture started,
+          now if not given
+        """
+        self.filename = filename
+        self._start = monotonic()
+        if start_time is None:
+            start_time = time.time()
+        self.start_time = start_time
+        self._fp = open(filename, 'wb')
+        self._fp.write(_HEADER.pack(MAGIC, self.start_time))
+        self._fp.flush()
+
+    def record(self, direction, data, timestamp=None):
+        """ Appends a record.
+
+        @param timestamp: the seconds since the start, now if not given
+        """
+        if timestamp is None:
+            timestamp = monotonic() - self._start
+        self._fp.write(_RECORD.pack(direction, timestamp, len(data)) + data)
+        self._fp.flush()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+def read_capture(filename):
+    """ Reads the records of a capture file.
+
+    A record which was being written when the capture was interrupted is
+    ignored.
+
+    @returns: a generator of (direction, timestamp, data) tuples
+    """
+    fp = open(filename, 'rb')
+    try:
+        magic, start_time = _HEADER.unpack(fp.read(_HEADER.size))
+        if magic != MAGIC:
+            raise TypeError("%s is not a capture file" % (filename, ))
+        while True:
+            header = fp.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                break
+            direction, timestamp, size = _RECORD.unpack(header)
+            data = fp.read(size)
+            if len(data) < size:
+                break
+            yield direction, timestamp, data
+    finally:
+        fp.close()
@@ -0,0 +1,175 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+"""
+A durable journal of the coupon being emitted.
+
+The state of a coupon, its items, whether it was totalized and what was
+paid, only lives in the memory of the process driving the printer. A
+L{CouponJournal} set in a L{stoqdrivers.printers.fiscal.FiscalPrinter}
+appends every step accepted by the printer to a file, one JSON line synced
+to disk each, so that after a crash
+L{stoqdrivers.printers.fiscal.FiscalPrinter.resume_coupon} can continue the
+coupon where it stopped instead of cancelling it and starting over.
+
+Items are also recorded before they are sent: if the process died while
+adding one, the last item id of the printer tells whether it was added.
+"""
+
+from decimal import Decimal
+import json
+import os
+
+OPEN = 'open'
+ADDING = 'adding'
+ITEM = 'item'
+CANCEL_ITEM = 'cancel-item'
+TOTALIZE = 'totalize'
+PAYMENT = 'payment'
+
+
+class CouponJournal(object):
+    """ Records the steps of the coupon being emitted in a file
+
+    @ivar filename: the journal file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fp = None
+
+    def _record(self, *record):
+        if self._fp is None:
+            # Drops a torn record first, or this one would be glued to it
+            self._read()
+            self._fp = open(self.filename, 'a')
+        self._fp.write(json.dumps(record) + '\n')
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def _read(self):
+        try:
+            fp = open(self.filename, 'r')
+        except (OSError, IOError):
+            return []
+        records = []
+        size = 0
+        try:
+            for line in fp:
+                # A record which was being appended when the process
+                # died, the step was not done
+                if not line.endswith('\n'):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+                size += len(line)
+        finally:
+            fp.close()
+        # Drop the broken tail, so that the next record starts a line
+        if size < os.path.getsize(self.filename):
+            fp = open(self.filename, 'r+')
+            try:
+                fp.truncate(size)
+                fp.flush()
+                os.fsync(fp.fileno())
+            finally:
+                fp.close()
+        return records
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def clear(self):
+        """ Forgets the coupon, once it is closed or cancelled """
+        self.close()
+        fp = open(self.filename, 'w')
+        try:
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+
+    def open_coupon(self):
+        self.clear()
+        self._record(OPEN)
+
+    def adding_item(self, code, description, price, taxcode, quantity,
+                    unit, discount, surcharge, unit_desc):
+        """ Records an item about to be sent to the printer """
+        self._record(ADDING, code, description, str(price), taxcode,
+                     str(quantity), int(unit), str(discount), str(surcharge),
+                     unit_desc)
+
+    def add_item(self, item_id):
+        """ Records that the printer accepted the item being added """
+        self._record(ITEM, item_id)
+
+    def cancel_item(self, item_id):
+        self._record(CANCEL_ITEM, item_id)
+
+    def totalize(self, total):
+        self._record(TOTALIZE, str(total))
+
+    def add_payment(self, method, value):
+        self._record(PAYMENT, method, str(value))
+
+    def get_operations(self):
+        """ Reads the steps recorded for the coupon
+
+        @returns: a list of tuples, one of::
+            (OPEN, )
+            (ITEM, item_id, code, description, price, taxcode, quantity,
+             unit, discount, surcharge, unit_desc)
+            (CANCEL_ITEM, item_id)
+            (TOTALIZE, total)
+            (PAYMENT, method, value)
+          the last one may also be an item which was being added when the
+          process stopped, as (ADDING, code, description, ...)
+        """
+        operations = []
+        adding = None
+        for record in self._read():
+            kind, args = record[0], record[1:]
+            if kind == ITEM and adding is not None:
+                operations.append((ITEM, args[0]) + adding)
+            elif kind == ADDING:
+                (code, description, price, taxcode, quantity, unit,
+                 discount, surcharge, unit_desc) = args
+                adding = (code, description, Decimal(price), str(taxcode),
+                          Decimal(quantity), unit, Decimal(discount),
+                          Decimal(surcharge), unit_desc)
+                continue
+            elif kind == TOTALIZE:
+                operations.append((kind, Decimal(args[0])))
+            elif kind == PAYMENT:
+                operations.append((kind, args[0], Decimal(args[1])))
+            elif kind != ITEM:
+                operations.append(tuple(record))
+            # An item not followed by its id was refused by the printer
+            adding = None
+        if adding is not None:
+            operations.append((ADDING, ) + adding)
+        return operations
@@ -0,0 +1,45 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Wire protocol emulators for the fiscal printers.
+
+Each emulator speaks the byte level protocol of a printer family behind
+a pseudo terminal, so the unmodified drivers can talk to it through a
+L{stoqdrivers.serialbase.SerialPort}::
+
+    emulator = PtyEmulator(get_protocol('bematech', 'MP25'),
+                           latency=0.05, baudrate=9600)
+    emulator.start()
+    printer = FiscalPrinter(brand='bematech', model='MP25',
+                            port=emulator.open_port())
+"""
+
+from stoqdrivers.emulator.base import (EmulatorError, FiscalState,
+                                       PtyEmulator, PtySerialPort)
+from stoqdrivers.emulator.registry import get_protocol, get_protocols
+from stoqdrivers.emulator.replay import ReplayMismatch, ReplayPort
+
+__all__ = ['EmulatorError', 'FiscalState', 'PtyEmulator', 'PtySerialPort',
+           'ReplayMismatch', 'ReplayPort', 'get_protocol', 'get_protocols']
@@ -0,0 +1,511 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Fiscal state, protocol base class and the pseudo terminal transport
+shared by all the emulators.
+"""
+
+import datetime
+from decimal import Decimal
+import os
+import pty
+import select
+import termios
+import threading
+import time
+import traceback
+import tty
+
+from kiwi.log import Logger
+from serial import Serial
+
+from stoqdrivers.serialbase import SerialPort
+from stoqdrivers.utils import BITS_PER_BYTE
+
+log = Logger('stoqdrivers.emulator')
+
+# Reasons an emulated printer refuses a command. Each protocol maps
+# them to its own error replies.
+COUPON_OPEN = 'coupon-open'
+COUPON_NOT_OPEN = 'coupon-not-open'
+NO_SUCH_ITEM = 'no-such-item'
+NO_ITEMS = 'no-items'
+ALREADY_TOTALIZED = 'already-totalized'
+NOT_TOTALIZED = 'not-totalized'
+NOT_PAID = 'not-paid'
+PENDING_REDUCE_Z = 'pending-reduce-z'
+NOTHING_TO_CANCEL = 'nothing-to-cancel'
+
+# Document types
+COUPON = 'coupon'
+NON_FISCAL = 'non-fiscal'
+REPORT = 'report'
+
+
+class EmulatorError(Exception):
+    """ Raised by L{FiscalState} when a command is not valid in the
+    current state of the printer.
+
+    @ivar reason: one of the reason constants of this module
+    """
+
+    def __init__(self, reason):
+        Exception.__init__(self, reason)
+        self.reason = reason
+
+
+class FiscalState(object):
+    """ The fiscal memory of an emulated printer.
+
+    Money values are Decimals and counters are integers. Every document
+    emitted is appended to L{documents}, which is what the memory reading
+    commands report.
+    """
+
+    def __init__(self, serial='EMU0000000000001'):
+        self.serial = serial
+        self.opening_date = datetime.date.today()
+        self.coo = 0
+        self.ccf = 0
+        self.gnf = 0
+        self.crz = 0
+        self.cro = 1
+        self.grand_total = Decimal('0')
+        self.period_total = Decimal('0')
+        self.period_cancelled = Decimal('0')
+        self.period_discount = Decimal('0')
+        self.tax_totals = {}
+        self.pending_reduce_z = False
+        self.taxes = [(Decimal('17.00'), False),
+                      (Decimal('12.00'), False),
+                      (Decimal('25.00'), False),
+                      (Decimal('8.00'), False),
+                      (Decimal('5.00'), False),
+                      (Decimal('3.00'), True)]
+        self.payment_methods = [u'Dinheiro', u'Cheque', u'Cartao Credito',
+                                u'Cartao Debito']
+        self.documents = []
+        self.document = None
+        self._last_coupon = None
+        self._reset_coupon()
+
+    def _reset_coupon(self):
+        self.items = []
+        self.discount = Decimal('0')
+        self.surcharge = Decimal('0')
+        self.totalized = False
+        self.payments = []
+
+    def _emit(self, type, **kwargs):
+        document = dict(type=type, coo=self.coo, crz=self.crz,
+                        date=datetime.datetime.now())
+        document.update(kwargs)
+        self.documents.append(document)
+        return document
+
+    def _check_can_open(self):
+        if self.document is not None:
+            raise EmulatorError(COUPON_OPEN)
+        if self.pending_reduce_z:
+            raise EmulatorError(PENDING_REDUCE_Z)
+
+    def _check_coupon(self):
+        if self.document != COUPON:
+            raise EmulatorError(COUPON_NOT_OPEN)
+
+    #
+    # Fiscal coupons
+    #
+
+    def has_open_coupon(self):
+        return self.document == COUPON
+
+    def open_coupon(self):
+        self._check_can_open()
+        self.coo += 1
+        self.ccf += 1
+        self.document = COUPON
+        self._reset_coupon()
+        return self.coo
+
+    def add_item(self, price, quantity=Decimal('1'), discount=Decimal('0'),
+                 surcharge=Decimal('0'), taxcode=None):
+        """ Adds an item to the open coupon.
+
+        @returns: the item id, starting at 1
+        """
+        self._check_coupon()
+        if self.totalized:
+            raise EmulatorError(ALREADY_TOTALIZED)
+        value = (price * quantity).quantize(Decimal('0.01'))
+        self.items.append(dict(value=value - discount + surcharge,
+                               discount=discount, taxcode=taxcode,
+                               cancelled=False))
+        return len(self.items)
+
+    def cancel_item(self, item_id=None):
+        self._check_coupon()
+        if item_id is None:
+            item_id = len(self.items)
+        if not 1 <= item_id <= len(self.items):
+            raise EmulatorError(NO_SUCH_ITEM)
+        item = self.items[item_id - 1]
+        if item['cancelled']:
+            raise EmulatorError(NO_SUCH_ITEM)
+        item['cancelled'] = True
+
+    def adjust_item(self, item_id=None, discount=Decimal('0'),
+                    surcharge=Decimal('0')):
+        """ Applies a discount or surcharge to an item already added,
+        the last one if item_id is not given.
+        """
+        self._check_coupon()
+        if item_id is None:
+            item_id = len(self.items)
+        if not 1 <= item_id <= len(self.items):
+            raise EmulatorError(NO_SUCH_ITEM)
+        item = self.items[item_id - 1]
+        item['value'] += surcharge - discount
+        item['discount'] += discount
+
+    def get_item_count(self):
+        return len(self.items)
+
+    def get_subtotal(self):
+        total = sum([item['value'] for item in self.items
+                     if not item['cancelled']], Decimal('0'))
+        return total - self.discount + self.surcharge
+
+    def totalize(self, discount=Decimal('0'), surcharge=Decimal('0')):
+        self._check_coupon()
+        if self.totalized:
+            raise EmulatorError(ALREADY_TOTALIZED)
+        if not [i for i in self.items if not i['cancelled']]:
+            raise EmulatorError(NO_ITEMS)
+        self.discount = discount
+        self.surcharge = surcharge
+        self.totalized = True
+        return self.get_subtotal()
+
+    def get_paid(self):
+        return sum([value for method, value in self.payments], Decimal('0'))
+
+    def get_remaining(self):
+        return max(self.get_subtotal() - self.get_paid(), Decimal('0'))
+
+    def add_payment(self, value, method=0):
+        """ Adds a payment to the open coupon.
+
+        @param method: the index of the method in L{payment_methods}
+        @returns: the value still to be paid
+        """
+        self._check_coupon()
+        if not self.totalized:
+            raise EmulatorError(NOT_TOTALIZED)
+        self.payments.append((method, value))
+        return self.get_remaining()
+
+    def close_coupon(self):
+        self._check_coupon()
+        if not self.totalized:
+            raise EmulatorError(NOT_TOTALIZED)
+        total = self.get_subtotal()
+        if self.get_paid() < total:
+            raise EmulatorError(NOT_PAID)
+        for item in self.items:
+            if item['cancelled']:
+                self.period_cancelled += item['value']
+                continue
+            taxcode = item['taxcode']
+            self.tax_totals[taxcode] = (self.tax_totals.get(taxcode, 0) +
+                                        item['value'])
+        self.period_discount += self.discount
+        self.period_total += total
+        self.grand_total += total
+        payments = [(self.get_payment_name(m), v) for m, v in self.payments]
+        self._last_coupon = self._emit(COUPON, ccf=self.ccf, total=total,
+                                       payments=payments)
+        self.document = None
+        self._reset_coupon()
+        return self.coo
+
+    def cancel_coupon(self):
+        """ Cancels the open coupon or, if there is none, the last one
+        emitted.
+        """
+        if self.document == COUPON:
+            self.period_cancelled += self.get_subtotal()
+            self.document = None
+            self._reset_coupon()
+        elif self.document is None and self._last_coupon:
+            total = self._last_coupon['total']
+            self._last_coupon['cancelled'] = True
+            self.period_cancelled += total
+            self.period_total -= total
+            self._last_coupon = None
+        elif self.document is not None:
+            self.close_document()
+            return
+        else:
+            raise EmulatorError(NOTHING_TO_CANCEL)
+        self.coo += 1
+        self._emit('cancel')
+
+    def get_payment_name(self, method):
+        try:
+            return self.payment_methods[method]
+        except (IndexError, TypeError):
+            return unicode(method)
+
+    #
+    # Non fiscal documents
+    #
+
+    def open_document(self, type=NON_FISCAL):
+        self._check_can_open()
+        self.coo += 1
+        self.gnf += 1
+        self.document = type
+        self._emit(type)
+
+    def close_document(self):
+        if self.document not in (NON_FISCAL, REPORT):
+            raise EmulatorError(COUPON_NOT_OPEN)
+        self.document = None
+        self._last_coupon = None
+
+    def add_voucher(self, value, cash_in=True):
+        self.open_document()
+        self.documents[-1].update(total=value, cash_in=cash_in)
+        self.close_document()
+
+    #
+    # Reports
+    #
+
+    def read_x(self):
+        if self.document is not None:
+            raise EmulatorError(COUPON_OPEN)
+        self.coo += 1
+        self.gnf += 1
+        self._emit('X')
+
+    def reduce_z(self):
+        if self.document == COUPON:
+            self.cancel_coupon()
+        elif self.document is not None:
+            self.close_document()
+        self.coo += 1
+        self.crz += 1
+        self._emit('Z', total=self.period_total,
+                   grand_total=self.grand_total,
+                   tax_totals=dict(self.tax_totals))
+        self.period_total = Decimal('0')
+        self.period_cancelled = Decimal('0')
+        self.period_discount = Decimal('0')
+        self.tax_totals = {}
+        self.pending_reduce_z = False
+        self._last_coupon = None
+
+    def get_documents(self, start=None, end=None, type=None):
+        """ Returns the emitted documents, optionally filtered by a
+        COO range and by type.
+        """
+        return [d for d in self.documents
+                if (start is None or d['coo'] >= start) and
+                (end is None or d['coo'] <= end) and
+                (type is None or d['type'] == type)]
+
+
+class BaseProtocol(object):
+    """ Base class for the wire protocol emulators.
+
+    Subclasses implement L{extract}, which splits a complete request out
+    of the bytes received so far, and L{process}, which executes it.
+
+    @cvar name: the name used to identify the protocol on the command line
+    """
+
+    name = None
+
+    def __init__(self, state=None):
+        self.state = state or FiscalState()
+        self._buffer = ''
+
+    def feed(self, data):
+        """ Feeds bytes written by the host.
+
+        @returns: a list of (command, request, reply) for each complete
+            request received
+        """
+        self._buffer += data
+        replies = []
+        while self._buffer:
+            request, self._buffer = self.extract(self._buffer)
+            if request is None:
+                break
+            command, reply = self.process(request)
+            log.debug('%s: %r -> %r' % (self.name, request, reply))
+            replies.append((command, request, reply))
+        return replies
+
+    def extract(self, data):
+        """ Splits the first complete request out of data.
+
+        @returns: a (request, remaining data) tuple, where request is
+            None if the request is still incomplete
+        """
+        raise NotImplementedError
+
+    def process(self, request):
+        """ Executes a request.
+
+        @returns: a (command, reply) tuple, where command identifies the
+            command for the latency table and reply is the bytes to send
+        """
+        raise NotImplementedError
+
+
+class PtySerialPort(SerialPort):
+    """ A SerialPort for the slave side of a pseudo terminal.
+
+    Pseudo terminals have no modem control lines, so setting DTR is
+    ignored and DSR is always reported as set. They do not have a
+    parity either, so the settings they reject are ignored too.
+    """
+
+    def _reconfigurePort(self):
+        try:
+            Serial._reconfigurePort(self)
+        except termios.error:
+            pass
+
+    def setDTR(self, level=True):
+        try:
+            Serial.setDTR(self, level)
+        except IOError:
+            pass
+
+    def getDSR(self):
+        return True
+
+
+class PtyEmulator(object):
+    """ Serves a protocol emulator on a pseudo terminal.
+
+    @ivar device: the path of the slave device, once started
+    @ivar latency: seconds spent processing each command, either a number
+        or a dictionary mapping commands to seconds; the None key holds
+        the default
+    @ivar baudrate: if set, the time the bytes would take on a serial line
+        at this speed is added to each request and reply
+    """
+
+    def __init__(self, protocol, latency=0, baudrate=None):
+        self.protocol = protocol
+        self.latency = latency
+        self.baudrate = baudrate
+        self.device = None
+        self.commands = 0
+        self._master = None
+        self._slave = None
+        self._wakeup = None
+        self._thread = None
+
+    def _get_latency(self, command):
+        if isinstance(self.latency, dict):
+            return self.latency.get(command, self.latency.get(None, 0))
+        return self.latency
+
+    def _send(self, data):
+        if not self.baudrate:
+            os.write(self._master, data)
+            return
+        # Send at most 10ms worth of bytes at a time so the reader sees
+        # them arrive at the line speed.
+        chunk = max(1, self.baudrate / BITS_PER_BYTE / 100)
+        for i in range(0, len(data), chunk):
+            part = data[i:i + chunk]
+            time.sleep(self.get_wire_time(len(part)))
+            os.write(self._master, part)
+
+    def _run(self):
+        while True:
+            rlist = select.select([self._master, self._wakeup[0]], [], [])[0]
+            if self._wakeup[0] in rlist:
+                break
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                break
+            try:
+                replies = self.protocol.feed(data)
+            except Exception:
+                log.error('Failed to process %r:\n%s' % (
+                    data, traceback.format_exc()))
+                continue
+            for command, request, reply in replies:
+                self.commands += 1
+                delay = (self.get_wire_time(len(request)) +
+                         self._get_latency(command))
+                if delay:
+                    time.sleep(delay)
+                if reply:
+                    self._send(reply)
+
+    def get_wire_time(self, n_bytes):
+        """ Returns the seconds n_bytes take on the serial line. """
+        if not self.baudrate:
+            return 0
+        return n_bytes * BITS_PER_BYTE / float(self.baudrate)
+
+    def start(self):
+        """ Creates the pseudo terminal and starts serving it.
+
+        @returns: the path of the slave device
+        """
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.device = os.ttyname(self._slave)
+        self._wakeup = os.pipe()
+        self._thread = threading.Thread(target=self._run,
+                                        name='emulator-%s' % self.device)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self.device
+
+    def stop(self):
+        if self._thread is None:
+            return
+        os.write(self._wakeup[1], 'x')
+        self._thread.join()
+        self._thread = None
+        for fd in (self._master, self._slave) + self._wakeup:
+            os.close(fd)
+        self._master = self._slave = self._wakeup = None
+
+    def open_port(self):
+        """ Opens a serial port connected to the emulator. """
+        return PtySerialPort(self.device, self.baudrate or 9600)
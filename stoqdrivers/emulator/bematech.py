@@ -0,0 +1,455 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Bematech MP25, MP20 and MP4000 protocol emulators.
+
+Requests are STX, a two bytes length, the protocol byte, the command and
+a two bytes checksum. Replies are an ACK, the command data and the status
+bytes, with a size the driver knows beforehand for each command.
+"""
+
+import datetime
+from decimal import Decimal
+import struct
+
+from stoqdrivers.emulator.base import (BaseProtocol, EmulatorError, REPORT,
+                                       COUPON_OPEN, COUPON_NOT_OPEN,
+                                       NO_SUCH_ITEM, NO_ITEMS, NOT_PAID,
+                                       ALREADY_TOTALIZED, NOT_TOTALIZED,
+                                       PENDING_REDUCE_Z, NOTHING_TO_CANCEL)
+from stoqdrivers.printers.bematech.MP20 import MP20Registers
+from stoqdrivers.printers.bematech.MP25 import MP25Registers
+from stoqdrivers.printers.bematech.MP4000 import MP4000Registers
+
+STX = '\x02'
+ACK = 6
+ETX = '\x03'
+
+CMD_COUPON_OPEN = 0
+CMD_REDUCE_Z = 5
+CMD_READ_X = 6
+CMD_ADD_TAX = 7
+CMD_READ_MEMORY = 8
+CMD_ADD_ITEM_SIMPLE = 9
+CMD_COUPON_CANCEL = 14
+CMD_STATUS = 19
+CMD_GERENCIAL_REPORT_PRINT = 20
+CMD_GERENCIAL_REPORT_CLOSE = 21
+CMD_ADD_VOUCHER = 25
+CMD_READ_TAXCODES = 26
+CMD_READ_TOTALIZERS = 27
+CMD_GET_COUPON_SUBTOTAL = 29
+CMD_GET_COUPON_NUMBER = 30
+CMD_CANCEL_ITEM = 31
+CMD_COUPON_TOTALIZE = 32
+CMD_COUPON_CLOSE = 34
+CMD_READ_REGISTER = 35
+CMD_EXTENDED = 62
+CMD_ADD_ITEM = 63
+CMD_PAYMENT_RECEIPT_OPEN = 66
+CMD_PAYMENT_RECEIPT_PRINT = 67
+CMD_PROGRAM_PAYMENT_METHOD = 71
+CMD_ADD_PAYMENT = 72
+CMD_CANCEL_LAST = 81
+
+# Extended (CMD_EXTENDED) subcommands
+EXT_LAST_Z = '7'
+EXT_ADD_ITEM = 'G'
+
+# st1 bits
+ST1_COUPON_OPEN = 2
+
+# st2 bits
+ST2_CANCEL_ITEM = 4
+ST2_NOT_EXECUTED = 1
+
+# st3 codes
+ST3_PENDING_REDUCE_Z = 66
+
+_st3_codes = {
+    COUPON_OPEN: 7,
+    COUPON_NOT_OPEN: 8,
+    NO_ITEMS: 17,
+    NOT_PAID: 23,
+    NOTHING_TO_CANCEL: 8,
+    ALREADY_TOTALIZED: 169,
+    NOT_TOTALIZED: 170,
+    PENDING_REDUCE_Z: ST3_PENDING_REDUCE_Z,
+    NO_SUCH_ITEM: 115,
+}
+
+
+def dec2bcd(value, size):
+    """ Packs an integer as size bytes of BCD. """
+    digits = '%0*d' % (size * 2, value)
+    return ''.join([chr(int(digits[i:i + 2], 16))
+                    for i in range(0, size * 2, 2)])
+
+
+def _cents(value):
+    return int(value * 100)
+
+
+class MP25Protocol(BaseProtocol):
+    name = 'bematech-mp25'
+    model_name = 'MP-25 FI'
+    proto = 0x1c
+    registers = MP25Registers
+    status_format = '<BBH'
+    serial_size = 20
+    last_z_size = 308
+    # MP4000 replies raise CouponOpenError when st1 has the coupon open
+    # bit set, so it's only reported by the status command there.
+    open_on_every_reply = True
+
+    def __init__(self, state=None):
+        BaseProtocol.__init__(self, state)
+        self._register_values = {
+            self.registers.TOTAL: lambda: _cents(self.state.grand_total),
+            self.registers.TOTAL_CANCELATIONS:
+                lambda: _cents(self.state.period_cancelled),
+            self.registers.TOTAL_DISCOUNT:
+                lambda: _cents(self.state.period_discount),
+            self.registers.COO: lambda: self.state.coo,
+            self.registers.GNF: lambda: self.state.gnf,
+            self.registers.NUMBER_REDUCTIONS_Z: lambda: self.state.crz,
+            self.registers.CRO: lambda: self.state.cro,
+            self.registers.LAST_ITEM_ID: self.state.get_item_count,
+            self.registers.NUMBER_TILL: lambda: 1,
+            self.registers.FISCAL_FLAGS: self._get_fiscal_flags,
+            self.registers.EMISSION_DATE: self._get_emission_date,
+            self.registers.TOTALIZERS: self._get_totalizers_flags,
+            self.registers.PAYMENT_METHODS: self._get_payment_methods,
+            self.registers.SERIAL: lambda: self.state.serial,
+            self.registers.FIRMWARE: lambda: 10000,
+        }
+        for name, value in [
+                ('CCF', lambda: self.state.ccf),
+                ('DAY_TOTAL', lambda: _cents(self.state.period_total)),
+                ('NUMBER_STORE', lambda: 1),
+                ('CURRENCY', lambda: 'R$'),
+                ('PRINTER_INFO', lambda: '%-15s%-20s%-7s' % (
+                    'BEMATECH', self.model_name, 'ECF-IF')),
+                ('SECOND_TO_TILL', self._get_seconds_to_till),
+                ('PRINTER_SENSORS', lambda: 0)]:
+            if hasattr(self.registers, name):
+                self._register_values[getattr(self.registers, name)] = value
+
+    #
+    # Registers
+    #
+
+    def _get_fiscal_flags(self):
+        flags = 0
+        if self.state.has_open_coupon():
+            flags |= 1 | 32
+        return chr(flags)
+
+    def _get_emission_date(self):
+        now = datetime.datetime.now()
+        return dec2bcd(int(now.strftime('%d%m%y%H%M%S')), 6)
+
+    def _get_totalizers_flags(self):
+        flags = 0
+        for i, (value, service) in enumerate(self.state.taxes):
+            if service:
+                flags |= 1 << 15 - i
+        return flags
+
+    def _get_payment_methods(self):
+        names = ''.join(['%-16s' % name.encode('cp850')
+                         for name in self.state.payment_methods])
+        return (len(self.state.payment_methods), names, '', '', '')
+
+    def _get_seconds_to_till(self):
+        if self.state.pending_reduce_z:
+            return 0
+        return 3600
+
+    def _read_register(self, reg):
+        fmt, bcd = self.registers.formats[reg]
+        value = self._register_values.get(reg, lambda: '')()
+        if reg == self.registers.TOTALIZERS:
+            return struct.pack('>H', value)
+        if bcd:
+            return dec2bcd(value, struct.calcsize(fmt))
+        if isinstance(value, tuple):
+            return struct.pack('<' + fmt, *value)
+        if fmt == 'B':
+            return chr(value)
+        return struct.pack('<' + fmt, value)
+
+    #
+    # Tables
+    #
+
+    def _get_taxcodes(self):
+        data = ''.join([dec2bcd(_cents(value), 2)
+                        for value, service in self.state.taxes])
+        return chr(len(self.state.taxes)) + data.ljust(32, '\x00')
+
+    def _get_totalizers(self):
+        totals = self.state.tax_totals
+        data = ''.join([dec2bcd(_cents(totals.get('%02d' % (i + 1), 0)), 7)
+                        for i in range(16)])
+        for code in ['II', 'NN', 'FF']:
+            data += dec2bcd(_cents(totals.get(code, 0)), 7)
+        return data.ljust(219, '\x00')
+
+    def _get_last_z(self):
+        data = '\x00' + dec2bcd(_cents(self.state.grand_total -
+                                       self.state.period_total), 9)
+        data = data.ljust(284, '\x00') + dec2bcd(self.state.coo, 3)
+        return data.ljust(self.last_z_size, '\x00')
+
+    def _get_memory(self):
+        lines = []
+        for document in self.state.get_documents(type='Z'):
+            lines.append('CRZ: %04d COO: %06d %s VENDA BRUTA: %s' % (
+                document['crz'], document['coo'],
+                document['date'].strftime('%d/%m/%Y'),
+                document['total']))
+        return '\n'.join(lines)
+
+    #
+    # Commands
+    #
+
+    def _parse_item(self, args):
+        taxcode = args[:2]
+        price = Decimal(args[2:11]) / 1000
+        quantity = Decimal(args[11:18]) / 1000
+        discount = Decimal(args[18:28]) / 100
+        markup = Decimal(args[28:38]) / 100
+        return taxcode, price, quantity, discount, markup
+
+    def _add_item(self, args):
+        taxcode, price, quantity, discount, markup = self._parse_item(args)
+        self.state.add_item(price, quantity, discount, markup, taxcode)
+
+    def _totalize(self, args):
+        value = Decimal(args[1:15]) / 100
+        if args[0] == 'd':
+            self.state.totalize(discount=value)
+        else:
+            self.state.totalize(surcharge=value)
+
+    def _add_payment(self, args):
+        method = int(args[:2]) - 1
+        self.state.add_payment(Decimal(args[2:16]) / 100, method)
+
+    def _cancel_coupon(self, args):
+        self.state.cancel_coupon()
+
+    def _add_voucher(self, args):
+        self.state.add_voucher(Decimal(args[2:16]) / 100,
+                               cash_in=args[:2] == 'SU')
+
+    def _add_tax(self, args):
+        self.state.taxes.append((Decimal(args[:4]) / 100, args[4] == '1'))
+
+    def _add_payment_method(self, args):
+        self.state.payment_methods.append(
+            args[:16].rstrip().decode('cp850'))
+
+    def _gerencial_report_print(self, args):
+        if self.state.document is None:
+            self.state.open_document(REPORT)
+
+    def _gerencial_report_close(self, args):
+        self.state.close_document()
+
+    def _read_memory(self, args):
+        # The report sent through the serial port follows the reply
+        if args.endswith('R'):
+            return '', self._get_memory() + ETX
+        return '', None
+
+    def _execute(self, command, args):
+        """ Executes a command.
+
+        @returns: a (data, trailer) tuple, where data goes before the
+            status bytes and trailer after them
+        """
+        state = self.state
+        if command == CMD_STATUS:
+            return '', None
+        elif command == CMD_READ_REGISTER:
+            return self._read_register(ord(args[0])), None
+        elif command == CMD_GET_COUPON_SUBTOTAL:
+            return dec2bcd(_cents(state.get_subtotal()), 7), None
+        elif command == CMD_GET_COUPON_NUMBER:
+            return dec2bcd(state.coo, 3), None
+        elif command == CMD_READ_TAXCODES:
+            return self._get_taxcodes(), None
+        elif command == CMD_READ_TOTALIZERS:
+            return self._get_totalizers(), None
+        elif command == CMD_READ_MEMORY:
+            return self._read_memory(args)
+        elif command == CMD_EXTENDED and args[:1] == EXT_LAST_Z:
+            return self._get_last_z(), None
+
+        handlers = {
+            CMD_COUPON_OPEN: lambda args: state.open_coupon(),
+            CMD_ADD_ITEM: self._add_item,
+            CMD_CANCEL_ITEM: lambda args: state.cancel_item(int(args[:4])),
+            CMD_COUPON_TOTALIZE: self._totalize,
+            CMD_ADD_PAYMENT: self._add_payment,
+            CMD_COUPON_CLOSE: lambda args: state.close_coupon(),
+            CMD_COUPON_CANCEL: self._cancel_coupon,
+            CMD_CANCEL_LAST: self._cancel_coupon,
+            CMD_READ_X: lambda args: state.read_x(),
+            CMD_REDUCE_Z: lambda args: state.reduce_z(),
+            CMD_ADD_VOUCHER: self._add_voucher,
+            CMD_ADD_TAX: self._add_tax,
+            CMD_PROGRAM_PAYMENT_METHOD: self._add_payment_method,
+            CMD_GERENCIAL_REPORT_PRINT: self._gerencial_report_print,
+            CMD_GERENCIAL_REPORT_CLOSE: self._gerencial_report_close,
+            CMD_PAYMENT_RECEIPT_OPEN:
+                lambda args: state.open_document(REPORT),
+        }
+        handler = handlers.get(command)
+        if handler is not None:
+            handler(args)
+        return '', None
+
+    def _get_status(self, command, error=None):
+        st1 = st2 = st3 = 0
+        if (self.state.has_open_coupon() and
+                (self.open_on_every_reply or command == CMD_STATUS)):
+            st1 |= ST1_COUPON_OPEN
+        if self.state.pending_reduce_z:
+            st3 = ST3_PENDING_REDUCE_Z
+        if error == NO_SUCH_ITEM:
+            st2 |= ST2_CANCEL_ITEM
+        elif error is not None:
+            st2 |= ST2_NOT_EXECUTED
+            st3 = _st3_codes.get(error, 0)
+        n_bytes = len(self.status_format) - 1
+        return struct.pack(self.status_format, *(st1, st2, st3)[:n_bytes])
+
+    def extract(self, data):
+        start = data.find(STX)
+        if start == -1:
+            return None, ''
+        data = data[start:]
+        if len(data) < 3:
+            return None, data
+        size = struct.unpack('<H', data[1:3])[0]
+        if len(data) < 3 + size:
+            return None, data
+        # Skip the protocol byte and the checksum
+        return data[4:3 + size - 2], data[3 + size:]
+
+    def process(self, request):
+        command, args = ord(request[0]), request[1:]
+        error = None
+        try:
+            data, trailer = self._execute(command, args)
+        except EmulatorError, e:
+            error = e.reason
+            data, trailer = '', None
+        if data is None:
+            return command, ''
+        reply = chr(ACK) + data + self._get_status(command, error)
+        return command, reply + (trailer or '')
+
+
+class MP20Protocol(MP25Protocol):
+    name = 'bematech-mp20'
+    model_name = 'MP-20 FI II'
+    proto = 0x1b
+    registers = MP20Registers
+    status_format = '<BB'
+
+    def _read_register(self, reg):
+        if reg == self.registers.SERIAL:
+            return '%-15s' % self.state.serial[:15]
+        return MP25Protocol._read_register(self, reg)
+
+    def _execute(self, command, args):
+        if command == CMD_ADD_ITEM_SIMPLE:
+            taxcode = args[42:44]
+            quantity = Decimal(args[44:51]) / 1000
+            price = Decimal(args[51:59]) / 100
+            discount = Decimal(args[59:67]) / 100
+            self.state.add_item(price, quantity, discount, taxcode=taxcode)
+            return '', None
+        return MP25Protocol._execute(self, command, args)
+
+
+class MP4000Protocol(MP25Protocol):
+    name = 'bematech-mp4000'
+    model_name = 'MP-4000 TH FI'
+    proto = 0x1b
+    registers = MP4000Registers
+    status_format = '<BB'
+    last_z_size = 324
+    open_on_every_reply = False
+
+    # Transactions are requested with an extended command and dates
+    TRANSACTIONS_SIZE = 13
+
+    def _parse_item(self, args):
+        taxcode = args[:2]
+        price = Decimal(args[2:13]) / 1000
+        quantity = Decimal(args[13:20]) / 1000
+        discount = Decimal(args[20:30])
+        markup = Decimal(args[30:40]) / 100
+        return taxcode, price, quantity, discount, markup
+
+    def _get_transactions(self, period, dest):
+        if dest == 'I':
+            return None
+        first = last = None
+        # A COO range, unless both halves are ddmmyy dates
+        try:
+            for date in period[:6], period[6:]:
+                datetime.datetime.strptime(date, '%d%m%y')
+        except ValueError:
+            first, last = int(period[:6]), int(period[6:])
+        lines = ['BEMATECH %s' % self.model_name] + [''] * 10
+        for document in self.state.get_documents(type='coupon'):
+            if first is not None and not first <= document['coo'] <= last:
+                continue
+            lines.append('COO:%06d CCF:%06d %s' % (
+                document['coo'], document['ccf'],
+                document['date'].strftime('%d/%m/%Y %H:%M:%S')))
+            for name, value in document['payments']:
+                lines.append('%s = %s' % (
+                    name.encode('cp850'), ('%.2f' % value).replace('.', ',')))
+        return '\x00\x00\x00' + '\n'.join(lines) + ETX
+
+    def process(self, request):
+        if request[:2] == chr(CMD_EXTENDED) + EXT_ADD_ITEM:
+            args = request[2:]
+            if args[0] == '7' and len(args) == self.TRANSACTIONS_SIZE + 1:
+                return request[:3], self._get_transactions(
+                    args[1:13], args[13:]) or ''
+            # Refunds are added like items, with an extra '3'
+            if args[0] == '3':
+                args = args[1:]
+            request = chr(CMD_ADD_ITEM) + args
+        return MP25Protocol.process(self, request)
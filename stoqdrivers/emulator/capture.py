@@ -0,0 +1,203 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Ports capturing the conversations with a device, in the format of
+L{stoqdrivers.capture}, and the replay and conversion of the captures.
+"""
+
+import bisect
+import time
+
+from zope.interface import implements
+
+from stoqdrivers.capture import READ, WRITE, CaptureWriter, read_capture
+from stoqdrivers.emulator.replay import ReplayPort, get_transcript
+from stoqdrivers.interfaces import ISerialPort
+from stoqdrivers.utils import monotonic
+
+
+class CapturePort(object):
+    """ Captures everything read from and written to a serial port.
+
+    The other methods and attributes are the ones of the port.
+    """
+    implements(ISerialPort)
+
+    def __init__(self, port, filename):
+        self._port = port
+        self._writer = CaptureWriter(filename)
+
+    def __getattr__(self, name):
+        return getattr(self._port, name)
+
+    def setDTR(self, value=True):
+        return self._port.setDTR(value)
+
+    def getDSR(self):
+        return self._port.getDSR()
+
+    def waitDSR(self, timeout=None):
+        return self._port.waitDSR(timeout)
+
+    def read(self, n_bytes=1):
+        data = self._port.read(n_bytes)
+        if data:
+            self._writer.record(READ, data)
+        return data
+
+    def write(self, data):
+        self._writer.record(WRITE, data)
+        return self._port.write(data)
+
+    def close(self):
+        self._writer.close()
+        self._port.close()
+
+
+#
+# Conversion
+#
+
+
+def capture_to_transcript(capture, transcript):
+    """ Converts a capture file to a text transcript, as found on the
+    tests/data directory.
+
+    Consecutive reads are merged, as the timing is lost anyway.
+    """
+    fp = open(transcript, 'w')
+    reading = ''
+    for direction, timestamp, data in read_capture(capture):
+        if direction == READ:
+            reading += data
+            continue
+        if reading:
+            fp.write('R %s\n' % (repr(reading)[1:-1], ))
+            reading = ''
+        fp.write('W %s\n' % (repr(data)[1:-1], ))
+    if reading:
+        fp.write('R %s\n' % (repr(reading)[1:-1], ))
+    fp.close()
+
+
+def transcript_to_capture(transcript, capture, baudrate=9600):
+    """ Converts a text transcript to a capture file.
+
+    Transcripts have no timing, so each record is timestamped with the
+    time its bytes would take on a serial line at the baud rate.
+    """
+    transcript = get_transcript(transcript)
+    writer = CaptureWriter(capture)
+    timestamp = 0.0
+    for direction, data in transcript.get_records():
+        timestamp += len(data) * 10.0 / baudrate
+        writer.record(direction, data, timestamp)
+    writer.close()
+
+
+#
+# Replay
+#
+
+
+class Capture(object):
+    """ A capture loaded to be replayed by a L{ReplayPort}.
+
+    @ivar writes: all the bytes written by the driver
+    @ivar reads: all the bytes replied by the device
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        writes = []
+        reads = []
+        # (offset, timestamp) of each record, per direction
+        self.write_times = []
+        self.read_times = []
+        write_offset = read_offset = 0
+        for direction, timestamp, data in read_capture(filename):
+            if direction == WRITE:
+                self.write_times.append((write_offset, timestamp))
+                writes.append(data)
+                write_offset += len(data)
+            else:
+                self.read_times.append((read_offset, timestamp))
+                reads.append(data)
+                read_offset += len(data)
+        self.writes = ''.join(writes)
+        self.reads = ''.join(reads)
+
+    def get_lineno(self, offset):
+        """ Returns the number of the write record holding offset. """
+        return bisect.bisect_right([start for start, timestamp
+                                    in self.write_times], offset)
+
+
+class TimedReplayPort(ReplayPort):
+    """ Replays a capture, reproducing the timing of the replies.
+
+    Each reply record is only available as long after the last write as
+    it was when captured, so the driver waits on the port as it did on
+    the real device.
+
+    @ivar speed: how much faster than the capture to replay
+    """
+
+    def __init__(self, capture, speed=1.0):
+        if isinstance(capture, basestring):
+            capture = Capture(capture)
+        ReplayPort.__init__(self, capture)
+        self.speed = speed
+        self._anchor = None
+        self._next_write = 0
+        self._next_read = 0
+
+    def write(self, data):
+        ReplayPort.write(self, data)
+        # Anchor the replies to the last record written
+        times = self.transcript.write_times
+        while (self._next_write < len(times) and
+               times[self._next_write][0] < self._write_offset):
+            self._next_write += 1
+        self._anchor = monotonic(), times[self._next_write - 1][1]
+
+    def read(self, n_bytes=1):
+        times = self.transcript.read_times
+        while (self._next_read + 1 < len(times) and
+               times[self._next_read + 1][0] <= self._read_offset):
+            self._next_read += 1
+        if self._next_read >= len(times):
+            return None
+        offset, timestamp = times[self._next_read]
+        if self._anchor is not None:
+            now, anchor = self._anchor
+            delay = (timestamp - anchor) / self.speed - (monotonic() - now)
+            if delay > 0:
+                time.sleep(delay)
+        # Return only the bytes of this record, the next may take longer
+        if self._next_read + 1 < len(times):
+            end = times[self._next_read + 1][0]
+            n_bytes = min(n_bytes, end - self._read_offset)
+        return ReplayPort.read(self, n_bytes)
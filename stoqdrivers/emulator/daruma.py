@@ -0,0 +1,495 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Daruma FS345 and FS2100 protocol emulators.
+
+FS345 requests are an ESC followed by the command number and its
+parameters, without any terminator, so the length of the parameters of
+each command must be known in advance. Replies start with a colon and
+end with a carriage return. The FS2100 adds a superset of commands,
+prefixed with FS and followed by a XOR checksum, whose replies are
+followed by a checksum too.
+"""
+
+from decimal import Decimal
+import operator
+import time
+
+from stoqdrivers.emulator.base import (BaseProtocol, EmulatorError, REPORT,
+                                       COUPON_OPEN, COUPON_NOT_OPEN,
+                                       NO_SUCH_ITEM, NOTHING_TO_CANCEL,
+                                       PENDING_REDUCE_Z)
+from stoqdrivers.printers.daruma.FS345 import (
+    CMD_STATUS, CMD_GET_MODEL, CMD_GET_FIRMWARE, CMD_OPEN_COUPON,
+    CMD_IDENTIFY_CUSTOMER, CMD_CANCEL_ITEM, CMD_CANCEL_COUPON, CMD_GET_X,
+    CMD_REDUCE_Z, CMD_READ_MEMORY, CMD_GERENCIAL_REPORT_OPEN,
+    CMD_GERENCIAL_REPORT_CLOSE, CMD_GERENCIAL_REPORT_PRINT, CMD_OPEN_VOUCHER,
+    CMD_DESCRIBE_MESSAGES, CMD_OPEN_NON_FISCAL_BOUND_RECEIPT,
+    CMD_CONFIGURE_TAXES, CMD_ADD_ITEM_3L13D53U,
+    CMD_DESCRIBE_NON_FISCAL_RECEIPT, CMD_GET_CONFIGURATION, CMD_GET_TAX_CODES,
+    CMD_GET_IDENTIFIER, CMD_GET_PERSONAL_MESSAGES, CMD_GET_DOCUMENT_STATUS,
+    CMD_GET_FISCAL_REGISTRIES, CMD_TOTALIZE_COUPON, CMD_DESCRIBE_PAYMENT_FORM,
+    CMD_CLOSE_COUPON, CMD_GET_REGISTRIES, CMD_GET_DATES, CASH_IN_TYPE,
+    OPENED_FISCAL_COUPON, CLOSED_COUPON)
+from stoqdrivers.printers.daruma.FS2100 import CMD_ADD_ITEM
+
+ESC = '\x1b'
+FS = '\x1c'
+GS = CMD_STATUS[0]
+EOL = '\r'
+EOF = '\xff'
+
+# Parameters ending with EOF instead of having a fixed length
+VARIABLE = None
+
+_extra_sizes = {
+    CMD_OPEN_COUPON: 0,
+    CMD_IDENTIFY_CUSTOMER: 252,
+    CMD_CANCEL_ITEM: 3,
+    CMD_CANCEL_COUPON: 0,
+    CMD_GET_X: 0,
+    CMD_REDUCE_Z: 12,
+    CMD_READ_MEMORY: 13,
+    CMD_GERENCIAL_REPORT_OPEN: 0,
+    CMD_GERENCIAL_REPORT_CLOSE: 0,
+    CMD_GERENCIAL_REPORT_PRINT: VARIABLE,
+    CMD_OPEN_VOUCHER: VARIABLE,
+    CMD_DESCRIBE_MESSAGES: 21,
+    CMD_OPEN_NON_FISCAL_BOUND_RECEIPT: 20,
+    CMD_ADD_ITEM_3L13D53U: VARIABLE,
+    CMD_DESCRIBE_NON_FISCAL_RECEIPT: 22,
+    CMD_GET_CONFIGURATION: 0,
+    CMD_GET_TAX_CODES: 0,
+    CMD_GET_IDENTIFIER: 0,
+    CMD_GET_PERSONAL_MESSAGES: 0,
+    CMD_GET_DOCUMENT_STATUS: 0,
+    CMD_GET_FISCAL_REGISTRIES: 0,
+    CMD_TOTALIZE_COUPON: 13,
+    CMD_DESCRIBE_PAYMENT_FORM: VARIABLE,
+    CMD_CLOSE_COUPON: VARIABLE,
+    CMD_GET_REGISTRIES: 0,
+    CMD_GET_DATES: 0,
+    CMD_GET_MODEL: 0,
+    CMD_GET_FIRMWARE: 0,
+}
+
+_error_codes = {
+    COUPON_OPEN: 10,
+    COUPON_NOT_OPEN: 11,
+    NOTHING_TO_CANCEL: 12,
+    NO_SUCH_ITEM: 15,
+    PENDING_REDUCE_Z: 23,
+}
+ERROR_BAD_PARAMETERS = 39
+ERROR_REDUCE_Z_DONE = 22
+
+LETTERS = 'ABCDEFGHIJKLMNOP'
+
+
+def _cents(value):
+    return int(value * 100)
+
+
+class _Error(Exception):
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+class FS345Protocol(BaseProtocol):
+    name = 'daruma-fs345'
+    model_name = 'FS345'
+
+    def __init__(self, state=None):
+        BaseProtocol.__init__(self, state)
+        self._reduced = False
+        self._pending_voucher = None
+        # The kind of each payment method slot, V when receipts can be
+        # bound to it and X otherwise
+        self._payment_kinds = {}
+        self._handlers = {
+            CMD_OPEN_COUPON: self._coupon_open,
+            CMD_CANCEL_ITEM: self._cancel_item,
+            CMD_CANCEL_COUPON: self._cancel_coupon,
+            CMD_GET_X: self._read_x,
+            CMD_REDUCE_Z: self._reduce_z,
+            CMD_READ_MEMORY: self._read_memory,
+            CMD_GERENCIAL_REPORT_OPEN: self._report_open,
+            CMD_GERENCIAL_REPORT_CLOSE: self._document_close,
+            CMD_OPEN_VOUCHER: self._open_voucher,
+            CMD_OPEN_NON_FISCAL_BOUND_RECEIPT: self._report_open,
+            CMD_ADD_ITEM_3L13D53U: self._add_item,
+            CMD_CONFIGURE_TAXES: self._configure_tax,
+            CMD_DESCRIBE_MESSAGES: self._describe_message,
+            CMD_GET_TAX_CODES: self._get_tax_codes,
+            CMD_GET_IDENTIFIER: self._get_identifier,
+            CMD_GET_PERSONAL_MESSAGES: self._get_messages,
+            CMD_GET_DOCUMENT_STATUS: self._get_document_status,
+            CMD_GET_FISCAL_REGISTRIES: self._get_fiscal_registries,
+            CMD_TOTALIZE_COUPON: self._totalize,
+            CMD_DESCRIBE_PAYMENT_FORM: self._add_payment,
+            CMD_CLOSE_COUPON: self._coupon_close,
+            CMD_GET_REGISTRIES: self._get_registries,
+            CMD_GET_DATES: self._get_dates,
+            CMD_GET_MODEL: lambda extra: self.model_name,
+            CMD_GET_FIRMWARE: lambda extra: '01.00.00',
+        }
+
+    #
+    # Commands
+    #
+
+    def _coupon_open(self, extra):
+        self.state.open_coupon()
+        return 'A%06d' % self.state.coo
+
+    def _add_item(self, extra):
+        taxcode = extra[:2]
+        d = extra[15]
+        E = Decimal(extra[16:20]) / 100
+        price = Decimal(extra[20:30]) / 1000
+        quantity = Decimal(extra[30:38]) / 1000
+        discount = surcharge = Decimal('0')
+        if d == '1':
+            surcharge = E
+        else:
+            discount = E
+        item_id = self.state.add_item(price, quantity, discount, surcharge,
+                                      taxcode)
+        return '+%03d N %013d' % (item_id, _cents(price * quantity))
+
+    def _cancel_item(self, extra):
+        self.state.cancel_item(int(extra))
+        return ''
+
+    def _cancel_coupon(self, extra):
+        self.state.cancel_coupon()
+        return ''
+
+    def _totalize(self, extra):
+        value = Decimal(extra[1:]) / 100
+        if extra[0] == '3':
+            total = self.state.totalize(surcharge=value)
+        else:
+            total = self.state.totalize(discount=value)
+        return '%012d' % _cents(total)
+
+    def _add_payment(self, extra):
+        value = Decimal(extra[1:13]) / 100
+        if self._pending_voucher is not None and not self.state.totalized:
+            # Paying the cash added by a voucher
+            self.state.add_voucher(self._pending_voucher)
+            self._pending_voucher = None
+            return '%012d' % 0
+        method = LETTERS.index(extra[0])
+        return '%012d' % _cents(self.state.add_payment(value, method))
+
+    def _coupon_close(self, extra):
+        coo = self.state.close_coupon()
+        return 'F%012d' % coo
+
+    def _read_x(self, extra):
+        self.state.read_x()
+        return ''
+
+    def _reduce_z(self, extra):
+        if self._reduced:
+            raise _Error(ERROR_REDUCE_Z_DONE)
+        if self.state.has_open_coupon():
+            self.state.cancel_coupon()
+        self.state.reduce_z()
+        self._reduced = True
+        return ''
+
+    def _read_memory(self, extra):
+        return ''
+
+    def _report_open(self, extra):
+        self.state.open_document(REPORT)
+        return ''
+
+    def _document_close(self, extra):
+        self.state.close_document()
+        return ''
+
+    def _open_voucher(self, extra):
+        value = Decimal(extra[14:26]) / 100
+        if extra[0] == CASH_IN_TYPE:
+            # The cash is only added when paid
+            self._pending_voucher = value
+        else:
+            self.state.add_voucher(value, cash_in=False)
+        return ''
+
+    def _configure_tax(self, extra):
+        if len(self.state.taxes) >= 14:
+            raise _Error(ERROR_BAD_PARAMETERS)
+        self.state.taxes.append((Decimal(extra[-4:]) / 100,
+                                 extra[0] == 'S'))
+        return ''
+
+    def _describe_message(self, extra):
+        # Only the payment methods are kept, PG<kind><letter><name>
+        if extra[:2] != 'PG':
+            return ''
+        index = LETTERS.index(extra[3])
+        methods = self.state.payment_methods
+        methods.extend([None] * (index + 1 - len(methods)))
+        methods[index] = extra[4:].rstrip().decode('ascii', 'replace')
+        self._payment_kinds[index] = extra[2]
+        return ''
+
+    def _get_tax_codes(self, extra):
+        codes = ''
+        for i, letter in enumerate(LETTERS[:14]):
+            if i < len(self.state.taxes):
+                value, service = self.state.taxes[i]
+                if service:
+                    letter = letter.lower()
+                codes += '%s%04d' % (letter, value * 100)
+            else:
+                codes += letter + '////'
+        return '%' + codes
+
+    def _get_identifier(self, extra):
+        return 'D%-8s%04d%04d' % (self.state.serial[-8:], 0, 1)
+
+    def _get_messages(self, extra):
+        receipts = ''
+        methods = ''
+        for i in range(16):
+            try:
+                name = self.state.payment_methods[i]
+            except IndexError:
+                name = None
+            if name is None:
+                receipts += EOF * 21
+                methods += EOF * 18
+                continue
+            name = name.encode('ascii', 'replace')
+            kind = self._payment_kinds.get(i, i and 'V' or 'X')
+            methods += '%s%-17s' % (kind, name[:17])
+            receipts += '%s%-20s' % (kind, name[:20])
+        return ' ' * 372 + receipts + methods
+
+    def _get_document_status(self, extra):
+        if self.state.has_open_coupon():
+            document = OPENED_FISCAL_COUPON
+        else:
+            document = CLOSED_COUPON
+        return ('%s%c%04d%s%05d %s%014d%018d' % (
+            ESC, CMD_GET_DOCUMENT_STATUS, 1, document, self.state.coo,
+            time.strftime('%H%M%S%d%m%Y'),
+            _cents(self.state.get_subtotal()),
+            _cents(self.state.grand_total)))
+
+    def _get_fiscal_registries(self, extra):
+        state = self.state
+        totals = state.tax_totals
+        data = '%018d' % _cents(state.grand_total - state.period_total)
+        for value in [state.period_discount, state.period_cancelled,
+                      totals.get('Ib', 0), totals.get('Nb', 0),
+                      totals.get('Fb', 0)]:
+            data += '%014d' % _cents(value)
+        for i in range(14):
+            data += '%014d' % _cents(totals.get(self._get_taxcode(i), 0))
+        return '%s%c%s' % (ESC, CMD_GET_FISCAL_REGISTRIES, data)
+
+    def _get_taxcode(self, index):
+        return 'T' + LETTERS[index].lower()
+
+    def _get_registries(self, extra):
+        state = self.state
+        first = state.get_documents(type='Z')
+        start = first and first[-1]['coo'] + 1 or 1
+        return ('%s%c%06d%06d%06d%s%04d%04d%s' % (
+            ESC, CMD_GET_REGISTRIES, start, state.coo, state.gnf, '0' * 16,
+            state.cro, state.crz, '0' * 10))
+
+    def _get_dates(self, extra):
+        return self.state.opening_date.strftime('%d%m%y') + '0' * 6
+
+    #
+    # Framing
+    #
+
+    def _get_status(self):
+        state = self.state
+        status = ['A', '4', 'C', '2', '0', 'C', '0', '0', '0', '0', '0']
+        if state.pending_reduce_z:
+            status[1] = '6'
+        if state.has_open_coupon():
+            status[3] = '6'
+        if self._reduced:
+            status[5] = 'E'
+        return ''.join(status)
+
+    def _get_error(self, error):
+        return ':E%02d' % error
+
+    def _extract_extra(self, command, data):
+        size = _extra_sizes.get(command, 0)
+        if command == CMD_CONFIGURE_TAXES:
+            size = data[:1] == 'S' and 5 or 4
+        if size is VARIABLE:
+            end = data.find(EOF)
+            if end == -1:
+                return None
+            return end + 1
+        if len(data) < size:
+            return None
+        return size
+
+    def extract(self, data):
+        while data and data[0] not in (ESC, GS, FS):
+            data = data[1:]
+        if len(data) < 2:
+            return None, data
+        if data.startswith(CMD_STATUS):
+            return CMD_STATUS, data[2:]
+        if data[0] == ESC:
+            size = self._extract_extra(ord(data[1]), data[2:])
+            if size is None:
+                return None, data
+            return data[:size + 2], data[size + 2:]
+        return None, data[1:]
+
+    def process(self, request):
+        if request == CMD_STATUS:
+            return 'status', ':%s%s' % (self._get_status(), EOL)
+        command = ord(request[1])
+        handler = self._handlers.get(command, lambda extra: '')
+        try:
+            data = handler(request[2:])
+        except EmulatorError, e:
+            data = self._get_error(
+                _error_codes.get(e.reason, ERROR_BAD_PARAMETERS))
+            return command, data + EOL
+        except _Error, e:
+            return command, self._get_error(e.code) + EOL
+        return command, ':%s%s' % (data, EOL)
+
+
+class FS2100Protocol(FS345Protocol):
+    name = 'daruma-fs2100'
+    model_name = 'FS2100'
+
+    decimals_quantity = 3
+    decimals_price = 2
+
+    # While time.time() is before it the commands are refused as if the
+    # MFD was being compacted
+    busy_until = 0
+    # The replies still owed for the commands refused meanwhile
+    _stale = 0
+
+    # The new commands whose parameters have a fixed size
+    _new_extra_sizes = {
+        ('R', 200): 3,
+    }
+
+    def _get_taxcode(self, index):
+        return '%02d' % (index + 1)
+
+    def compact(self, seconds):
+        """ Refuses the commands for some seconds, replying ':E99' like
+        the printer does while it compacts its MFD. As in the transcripts
+        of the printer, each refused command is replied once more after
+        the next one that is accepted.
+        """
+        self.busy_until = time.time() + seconds
+
+    def _add_new_item(self, extra):
+        taxcode = extra[:2]
+        quantity = Decimal(extra[2:9]) / 10 ** self.decimals_quantity
+        price = Decimal(extra[9:17]) / 10 ** self.decimals_price
+        d = extra[17]
+        E = Decimal(extra[18:29]) / 100
+        discount = surcharge = Decimal('0')
+        if d in '23':
+            surcharge = E
+        else:
+            discount = E
+        item_id = self.state.add_item(price, quantity, discount, surcharge,
+                                      taxcode)
+        return '%03d%013d' % (item_id, _cents(price * quantity))
+
+    def _process_new(self, prefix, command, extra):
+        if (prefix, command) == ('R', 200):
+            return '%c%s%d%d' % (command, extra, self.decimals_quantity,
+                                 self.decimals_price)
+        if command == CMD_ADD_ITEM:
+            data = self._add_new_item(extra)
+        elif command in (236, 227):
+            value = Decimal(extra[:11]) / 100
+            self.state.add_voucher(value, cash_in=command == 236)
+            data = '%06d' % self.state.coo
+        else:
+            data = ''
+        return '0000000%c%s' % (command, data)
+
+    def extract(self, data):
+        start = 0
+        while start < len(data) and data[start] not in (ESC, GS, FS):
+            start += 1
+        data = data[start:]
+        if not data.startswith(FS):
+            return FS345Protocol.extract(self, data)
+        if len(data) < 3:
+            return None, data
+        size = self._new_extra_sizes.get((data[1], ord(data[2])), VARIABLE)
+        if size is VARIABLE:
+            end = data.find(EOF, 3)
+            if end == -1:
+                return None, data
+            end += 1
+        else:
+            end = 3 + size
+        # The checksum follows the parameters
+        if len(data) < end + 1:
+            return None, data
+        return data[:end + 1], data[end + 1:]
+
+    def process(self, request):
+        if request != CMD_STATUS and time.time() < self.busy_until:
+            if request.startswith(ESC):
+                self._stale += 1
+            return 'busy', self._get_error(99) + EOL
+        if not request.startswith(FS):
+            command, reply = FS345Protocol.process(self, request)
+            if request.startswith(ESC):
+                reply += (self._get_error(99) + EOL) * self._stale
+                self._stale = 0
+            return command, reply
+        prefix, command = request[1], ord(request[2])
+        try:
+            data = self._process_new(prefix, command, request[3:-1])
+        except EmulatorError, e:
+            error = _error_codes.get(e.reason, ERROR_BAD_PARAMETERS)
+            data = '%02d00000%c' % (error, command)
+        reply = ':%s%s' % (data, EOL)
+        checksum = reduce(operator.xor, [ord(c) for c in reply], 0)
+        return (prefix, command), reply + chr(checksum)
+
@@ -0,0 +1,266 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Dataregis EP375 protocol emulator.
+
+Requests are packages made of a prefix, a counter, the command, the size
+of the parameters, the parameters and a checksum. The host sends an EOT
+after reading each reply. Replies are lines: an EOT when there is no data
+to return, an ACK when the command failed, which makes the host query the
+status for the error, or a BS followed by one line per reply package, the
+last one marked with a SUB.
+"""
+
+from decimal import Decimal
+
+from stoqdrivers.emulator.base import (BaseProtocol, EmulatorError, REPORT,
+                                       COUPON_OPEN, COUPON_NOT_OPEN,
+                                       NO_SUCH_ITEM, NO_ITEMS,
+                                       NOTHING_TO_CANCEL, PENDING_REDUCE_Z)
+from stoqdrivers.printers.dataregis.EP375 import EP375, EP375Status
+
+PREFIX = EP375.CMD_PREFIX
+EOT = '\x04'
+ACK = '\x06'
+BS = '\x08'
+CR = '\r'
+SUB = '\x1a'
+
+# Internal states, see EP375Status
+STATE_IDLE = 'L'
+STATE_SALE = chr(EP375Status.HAS_FISCAL_SALE)
+STATE_TOTALIZED = chr(EP375Status.HAS_BEEN_TOTALIZED)
+STATE_NEEDS_REDUCE_Z = chr(EP375Status.NEEDS_REDUCE_Z)
+STATE_REPORT = chr(EP375Status.HAS_OPENED_REPORT)
+
+ERROR_NONE = chr(EP375Status.PRINTER_IS_OK)
+ERROR_NO_ITEMS = 'b'
+ERROR_INVALID_STATE = 'N'
+ERROR_INVALID_PARAMETERS = 'i'
+
+_error_codes = {
+    COUPON_OPEN: ERROR_INVALID_STATE,
+    COUPON_NOT_OPEN: ERROR_INVALID_STATE,
+    NO_SUCH_ITEM: ERROR_NO_ITEMS,
+    NO_ITEMS: ERROR_NO_ITEMS,
+    NOTHING_TO_CANCEL: ERROR_INVALID_STATE,
+    PENDING_REDUCE_Z: 'R',
+}
+
+# The largest amount of data sent in a single reply package
+PACKAGE_SIZE = 32
+
+
+class EP375Protocol(BaseProtocol):
+    name = 'dataregis-ep375'
+
+    def __init__(self, state=None):
+        BaseProtocol.__init__(self, state)
+        self._counter = 0xdb
+        self._error = ERROR_NONE
+        self._handlers = {
+            EP375.CMD_GET_STATUS: self._get_status,
+            EP375.CMD_ADD_ITEM_WITH_DISCOUNT: self._add_item,
+            EP375.CMD_ADD_ITEM_WITH_SURCHARGE: self._add_item,
+            EP375.CMD_CANCEL_ITEM: self._cancel_item,
+            EP375.CMD_CANCEL_COUPON: self._cancel_coupon,
+            EP375.CMD_ADD_PAYMENT: self._add_payment,
+            EP375.CMD_ADD_PAYMENT_WITH_SURCHARGE: self._add_payment,
+            EP375.CMD_GET_REMAINING_VALUE: self._get_remaining_value,
+            EP375.CMD_GET_FISCAL_COUNTERS: self._get_fiscal_counters,
+            EP375.CMD_READ_X: self._read_x,
+            EP375.CMD_REDUCE_Z: self._reduce_z,
+            EP375.CMD_GERENCIAL_REPORT: self._report_print,
+            EP375.CMD_CLOSE_GERENCIAL_REPORT: self._report_close,
+            'K': self._report_close,
+        }
+
+    #
+    # Commands
+    #
+
+    def _get_internal_state(self):
+        state = self.state
+        if state.pending_reduce_z:
+            return STATE_NEEDS_REDUCE_Z
+        if state.has_open_coupon():
+            if state.totalized:
+                return STATE_TOTALIZED
+            return STATE_SALE
+        if state.document == REPORT:
+            return STATE_REPORT
+        return STATE_IDLE
+
+    def _get_status(self, params):
+        error, self._error = self._error, ERROR_NONE
+        return self._get_internal_state() + 'SNNN' + error
+
+    def _parse_item(self, params):
+        # The description has 20 or 60 characters
+        desc_size = len(params) - 39
+        params = params[16 + desc_size:]
+        taxcode = params[:2]
+        quantity = Decimal(params[2:8]) / 1000
+        price = Decimal(params[8:17]) / 100
+        D = Decimal(params[17:21]) / 100
+        return taxcode, quantity, price, D
+
+    def _add_item(self, params, command):
+        taxcode, quantity, price, D = self._parse_item(params)
+        discount = surcharge = Decimal('0')
+        if command == EP375.CMD_ADD_ITEM_WITH_SURCHARGE:
+            surcharge = D
+        else:
+            discount = D
+        # The coupon is opened by the first item
+        if not self.state.has_open_coupon():
+            self.state.open_coupon()
+        self.state.add_item(price, quantity, discount, surcharge, taxcode)
+
+    def _cancel_item(self, params):
+        taxcode, quantity, price, D = self._parse_item(params)
+        value = (price * quantity).quantize(Decimal('0.01'))
+        for item_id, item in enumerate(self.state.items):
+            if (not item['cancelled'] and item['taxcode'] == taxcode and
+                    item['value'] + item['discount'] in (value, value + D)):
+                self.state.cancel_item(item_id + 1)
+                return
+        raise EmulatorError(NO_SUCH_ITEM)
+
+    def _cancel_coupon(self, params):
+        self.state.cancel_coupon()
+
+    def _add_payment(self, params, command):
+        method = int(params[:2])
+        value = Decimal(params[2:16]) / 100
+        if not self.state.totalized:
+            discount = surcharge = Decimal('0')
+            if command == EP375.CMD_ADD_PAYMENT_WITH_SURCHARGE:
+                D = Decimal(params[16:30]) / 100
+                if params[30] == 'D':
+                    discount = D
+                else:
+                    surcharge = D
+            self.state.totalize(discount, surcharge)
+        # The coupon is closed as soon as it is paid
+        if not self.state.add_payment(value, method):
+            self.state.close_coupon()
+
+    def _get_remaining_value(self, params):
+        state = self.state
+        if not state.has_open_coupon():
+            return 'T%014d%03d' % (0, 0)
+        if state.totalized:
+            remaining = state.get_remaining()
+        else:
+            remaining = state.get_subtotal()
+        return 'S%014d%03d' % (remaining * 100, state.get_item_count())
+
+    def _get_fiscal_counters(self, params):
+        state = self.state
+        return ('%016d%06d%04d%04d%013d%06d%04d' % (
+            state.grand_total * 100, state.gnf, state.cro, state.crz, 0,
+            state.coo, state.ccf))
+
+    def _read_x(self, params):
+        self.state.read_x()
+
+    def _reduce_z(self, params):
+        self.state.reduce_z()
+
+    def _report_print(self, params):
+        if self.state.document != REPORT:
+            self.state.open_document(REPORT)
+
+    def _report_close(self, params):
+        self.state.close_document()
+
+    #
+    # Framing
+    #
+
+    def _get_next_counter(self):
+        self._counter = (self._counter + 1) & 0xff
+        if chr(self._counter) == CR:
+            self._counter += 1
+        return chr(self._counter)
+
+    def _pack(self, command, params, last):
+        data = '%s%c%s' % (command, len(params), params)
+        checksum = chr(sum([ord(c) for c in data]) & 0xff)
+        if CR in data or checksum == CR or (checksum == SUB and not last):
+            return None
+        return (PREFIX + self._get_next_counter() + data + checksum +
+                (last and SUB or '') + CR)
+
+    def _build_reply(self, command, data):
+        if data is None:
+            return EOT + CR
+        reply = BS + CR
+        while True:
+            size = min(len(data), PACKAGE_SIZE)
+            # Shrink the package until neither the checksum nor the size
+            # are mistaken for the end of the line
+            while True:
+                package = self._pack(command, data[:size],
+                                     size == len(data))
+                if package is not None:
+                    break
+                size -= 1
+            reply += package
+            data = data[size:]
+            if not data:
+                return reply
+
+    def extract(self, data):
+        # Skip the EOT and ACK sent by the host after each reply
+        start = data.find(PREFIX)
+        if start == -1:
+            return None, ''
+        data = data[start:]
+        if len(data) < 4:
+            return None, data
+        end = 5 + ord(data[3])
+        if len(data) < end:
+            return None, data
+        return data[:end], data[end:]
+
+    def process(self, request):
+        command, params = request[2], request[4:-1]
+        handler = self._handlers.get(command)
+        if handler is None:
+            return command, EOT + CR
+        try:
+            if command in (EP375.CMD_ADD_ITEM_WITH_DISCOUNT,
+                           EP375.CMD_ADD_ITEM_WITH_SURCHARGE,
+                           EP375.CMD_ADD_PAYMENT,
+                           EP375.CMD_ADD_PAYMENT_WITH_SURCHARGE):
+                data = handler(params, command)
+            else:
+                data = handler(params)
+        except EmulatorError, e:
+            self._error = _error_codes.get(e.reason, ERROR_INVALID_PARAMETERS)
+            return command, ACK + CR
+        return command, self._build_reply(command, data)
@@ -0,0 +1,353 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Epson FBII and FBIII protocol emulators.
+
+Requests are framed by STX, a frame id, the FLD separated fields and ETX,
+followed by an hexadecimal checksum. Special characters inside the frame
+are escaped with ESC. The printer acknowledges each frame with an ACK
+before sending the reply, which the host acknowledges too.
+"""
+
+from decimal import Decimal
+import struct
+
+from stoqdrivers.emulator.base import (BaseProtocol, EmulatorError, REPORT,
+                                       NON_FISCAL, COUPON_OPEN, NO_SUCH_ITEM,
+                                       NOTHING_TO_CANCEL, PENDING_REDUCE_Z)
+from stoqdrivers.printers.epson.FBII import (ACK, STX, ETX, ESC, FLD,
+                                             escape)
+
+# Fiscal status
+STATUS_CLOSED = 0xc080
+STATUS_FISCAL_COUPON = 0x0001
+STATUS_NON_FISCAL_COUPON = 0x0008
+
+# Journey states, as reported by 0810
+JOURNEY_OPEN = '2'
+JOURNEY_PENDING_REDUCE_Z = '4'
+
+# Last document types, as reported by 0908
+FISCAL_COUPON = '1'
+NON_FISCAL_COUPON = '24'
+
+SUCCESS = '0000'
+ERROR_INVALID_STATE = '0101'
+ERROR_INVALID_DOCUMENT = '0102'
+ERROR_CLOSED_JOURNEY = '0801'
+ERROR_UNDEFINED_PAYMENT = '090C'
+ERROR_CANCEL_LAST = '0A12'
+ERROR_INVALID_ITEM = '0A16'
+
+_error_codes = {
+    COUPON_OPEN: ERROR_INVALID_STATE,
+    NO_SUCH_ITEM: ERROR_INVALID_ITEM,
+    NOTHING_TO_CANCEL: ERROR_CANCEL_LAST,
+    PENDING_REDUCE_Z: ERROR_CLOSED_JOURNEY,
+}
+
+
+def _split_fields(frame):
+    """ Splits an escaped frame in its unescaped fields. """
+    fields = ['']
+    escaped = False
+    for c in frame:
+        if escaped:
+            fields[-1] += c
+            escaped = False
+        elif c == ESC:
+            escaped = True
+        elif c == FLD:
+            fields.append('')
+        else:
+            fields[-1] += c
+    return fields
+
+
+def _cents(value):
+    return str(int(value * 100))
+
+
+class _Error(Exception):
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+class FBIIProtocol(BaseProtocol):
+    name = 'epson-fbii'
+    model_name = 'FBII'
+    decimals_quantity = '3'
+    decimals_price = '2'
+
+    def __init__(self, state=None):
+        BaseProtocol.__init__(self, state)
+        self._last_document = None
+        self._handlers = {
+            '0001': self._get_status,
+            '0402': self._get_details,
+            '0507': self._get_fiscal_data,
+            '050D': self._get_payment_method,
+            '0542': self._get_taxes,
+            '0585': self._get_decimals,
+            '0702': self._noop,
+            '0801': self._reduce_z,
+            '0802': self._read_x,
+            '0805': self._read_x,
+            '080A': self._get_journey,
+            '0810': self._get_journey_state,
+            '0906': self._get_totals,
+            '0907': self._get_counters,
+            '0908': self._get_last_document,
+            '0910': self._noop,
+            '0A01': self._coupon_open,
+            '0A02': self._add_item,
+            '0A03': self._get_subtotal,
+            '0A04': self._add_discount,
+            '0A05': self._add_payment,
+            '0A06': self._coupon_close,
+            '0A18': self._cancel,
+            '0A20': self._noop,
+            '0A22': self._noop,
+            '0E01': self._document_open,
+            '0E02': self._noop,
+            '0E06': self._document_close,
+            '0E15': self._add_voucher_item,
+            '0E18': self._cancel,
+            '0E30': self._document_open,
+        }
+
+    #
+    # Commands
+    #
+
+    def _noop(self, extension, args):
+        return []
+
+    def _get_status(self, extension, args):
+        return []
+
+    def _get_details(self, extension, args):
+        return [self.state.serial, 'EPSON', self.model_name, 'ECF-IF', '',
+                '01.00.00']
+
+    def _get_fiscal_data(self, extension, args):
+        return ['Stoq', '', '', '', '', '', '', '', '001', 'LJ01',
+                self.state.opening_date.strftime('%d%m%Y'), '1']
+
+    def _get_payment_method(self, extension, args):
+        try:
+            name = self.state.payment_methods[int(args[0]) - 1]
+        except IndexError:
+            raise _Error(ERROR_UNDEFINED_PAYMENT)
+        return [name.encode('ascii', 'replace'), 'N']
+
+    def _get_taxes(self, extension, args):
+        fields = []
+        for i, (value, service) in enumerate(self.state.taxes):
+            name = (service and 'S' or 'T') + chr(ord('a') + i)
+            sold = self.state.tax_totals.get(name, 0)
+            fields.extend([name, '%04d' % (value * 100), _cents(sold)])
+        return fields
+
+    def _get_decimals(self, extension, args):
+        return [self.decimals_quantity, self.decimals_price]
+
+    def _reduce_z(self, extension, args):
+        self.state.reduce_z()
+        return []
+
+    def _read_x(self, extension, args):
+        self.state.read_x()
+        return []
+
+    def _get_journey(self, extension, args):
+        first = self.state.get_documents(start=None, type='Z')
+        return [self.state.opening_date.strftime('%d%m%Y'), '000000',
+                '01012000', '000000',
+                str(first and first[-1]['coo'] + 1 or 1)]
+
+    def _get_journey_state(self, extension, args):
+        if self.state.pending_reduce_z:
+            return [JOURNEY_PENDING_REDUCE_Z]
+        return [JOURNEY_OPEN]
+
+    def _get_totals(self, extension, args):
+        state = self.state
+        totals = state.tax_totals
+        fields = [_cents(state.grand_total), _cents(state.period_total),
+                  _cents(state.period_cancelled),
+                  _cents(state.period_discount)]
+        fields.extend(['0'] * 11)
+        fields.extend([_cents(totals.get('F', 0)),
+                       _cents(totals.get('I', 0)),
+                       _cents(totals.get('N', 0))])
+        return fields + ['0'] * 3
+
+    def _get_counters(self, extension, args):
+        state = self.state
+        return ['%06d' % state.coo, '%04d' % state.crz, '%03d' % state.cro,
+                '%06d' % state.gnf, '0000', '0000', '%06d' % state.gnf,
+                '%06d' % state.ccf, '0000', '000000', '0000', '0000',
+                '000000', '000000']
+
+    def _get_last_document(self, extension, args):
+        if self._last_document is None:
+            return ['0']
+        return [self._last_document]
+
+    def _coupon_open(self, extension, args):
+        self.state.open_coupon()
+        return []
+
+    def _add_item(self, extension, args):
+        code, description, quantity, unit, price, taxcode = args[:6]
+        quantity = Decimal(quantity) / Decimal('1e' + self.decimals_quantity)
+        price = Decimal(price) / Decimal('1e' + self.decimals_price)
+        return [str(self.state.add_item(price, quantity, taxcode=taxcode))]
+
+    def _get_subtotal(self, extension, args):
+        return [_cents(self.state.get_subtotal())]
+
+    def _add_discount(self, extension, args):
+        value = Decimal(args[0]) / 100
+        if extension == '0004':
+            self.state.adjust_item(discount=value)
+        elif extension == '0005':
+            self.state.adjust_item(surcharge=value)
+        elif extension == '0006':
+            self.state.totalize(discount=value)
+        elif extension == '0007':
+            self.state.totalize(surcharge=value)
+        return [_cents(self.state.get_subtotal())]
+
+    def _add_payment(self, extension, args):
+        # There is no totalize command, the first payment ends the sale
+        if not self.state.totalized:
+            self.state.totalize()
+        method = int(args[0]) - 1
+        remaining = self.state.add_payment(Decimal(args[1]) / 100, method)
+        return [_cents(remaining), '0']
+
+    def _coupon_close(self, extension, args):
+        coo = self.state.close_coupon()
+        self._last_document = FISCAL_COUPON
+        return [str(coo)]
+
+    def _cancel(self, extension, args):
+        if extension == '0004':
+            self.state.cancel_item(int(args[0]))
+            return []
+        self.state.cancel_coupon()
+        self._last_document = None
+        return []
+
+    def _document_open(self, extension, args):
+        if extension == '0004':
+            self.state.open_document(REPORT)
+        else:
+            self.state.open_document(NON_FISCAL)
+        return []
+
+    def _document_close(self, extension, args):
+        self.state.close_document()
+        self._last_document = NON_FISCAL_COUPON
+        return []
+
+    def _add_voucher_item(self, extension, args):
+        document = self.state.documents[-1]
+        document.update(total=Decimal(args[1]) / 100, cash_in=args[0] == '02')
+        return []
+
+    #
+    # Framing
+    #
+
+    def _get_fiscal_status(self):
+        status = STATUS_CLOSED
+        if self.state.has_open_coupon():
+            status |= STATUS_FISCAL_COUPON
+        elif self.state.document is not None:
+            status |= STATUS_NON_FISCAL_COUPON
+        return status
+
+    def _build_reply(self, frame_id, fields, error=SUCCESS):
+        code = chr(int(error[:2], 16)) + chr(int(error[2:], 16))
+        frame = (escape(struct.pack('>H', 0)) + FLD +
+                 escape(struct.pack('>H', self._get_fiscal_status())) +
+                 FLD + FLD + escape(code) + FLD)
+        if error == SUCCESS:
+            frame += FLD + FLD.join([escape(f) for f in fields])
+        package = STX + frame_id + frame + ETX
+        return ACK + package + '%04X' % sum([ord(c) for c in package])
+
+    def extract(self, data):
+        start = data.find(STX)
+        if start == -1:
+            return None, ''
+        data = data[start:]
+        end = 2
+        while True:
+            end = data.find(ETX, end)
+            if end == -1:
+                return None, data
+            if data[end - 1] != ESC:
+                break
+            end += 1
+        if len(data) < end + 5:
+            return None, data
+        return data[1:end], data[end + 5:]
+
+    def process(self, request):
+        frame_id = request[0]
+        fields = _split_fields(request[1:])
+        command = '%02X%02X' % (ord(fields[0][0]), ord(fields[0][1]))
+        extension = '%02X%02X' % (ord(fields[1][0]), ord(fields[1][1]))
+        handler = self._handlers.get(command, self._noop)
+        try:
+            fields = handler(extension, fields[2:])
+        except EmulatorError, e:
+            error = _error_codes.get(e.reason, ERROR_INVALID_DOCUMENT)
+            return command, self._build_reply(frame_id, [], error)
+        except _Error, e:
+            return command, self._build_reply(frame_id, [], e.code)
+        return command, self._build_reply(frame_id, fields)
+
+
+class FBIIIProtocol(FBIIProtocol):
+    name = 'epson-fbiii'
+    model_name = 'FBIII'
+
+    def __init__(self, state=None):
+        FBIIProtocol.__init__(self, state)
+        self._handlers['0A07'] = self._add_item_discount
+
+    def _add_item_discount(self, extension, args):
+        item_id, value = int(args[0]), Decimal(args[1]) / 100
+        if extension == '0010':
+            self.state.adjust_item(item_id, discount=value)
+        else:
+            self.state.adjust_item(item_id, surcharge=value)
+        return []
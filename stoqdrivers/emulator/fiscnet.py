@@ -0,0 +1,378 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+FiscNet protocol emulator.
+
+Requests are made of a command id, the command name and its named
+parameters, separated by semicolons and surrounded by curly braces.
+Replies have the same form, carrying the error code and the named
+return values instead.
+"""
+
+import datetime
+from decimal import Decimal
+import re
+
+from stoqdrivers.emulator.base import (BaseProtocol, EmulatorError, REPORT,
+                                       NON_FISCAL, COUPON_OPEN,
+                                       COUPON_NOT_OPEN, NO_SUCH_ITEM, NO_ITEMS,
+                                       ALREADY_TOTALIZED, NOT_TOTALIZED,
+                                       NOT_PAID, PENDING_REDUCE_Z,
+                                       NOTHING_TO_CANCEL)
+from stoqdrivers.printers.fiscnet.FiscNetECF import (FLAG_DIA_ABERTO,
+                                                     FLAG_Z_PENDENTE,
+                                                     FLAG_DOCUMENTO_ABERTO,
+                                                     FLAG_INSCRICOES_OK,
+                                                     FLAG_CLICHE_OK,
+                                                     FLAG_EM_LINHA)
+
+START = '{'
+END = '}'
+
+_PARAM_RE = re.compile(r'(\S+?)=("(?:[^"\\]|\\.)*"|#[^#]*#|\S*)')
+
+ERROR_TAX_UNDEFINED = 8005
+ERROR_PAYMENT_UNDEFINED = 8014
+ERROR_NON_FISCAL_UNDEFINED = 8057
+ERROR_INVALID_STATE = 11007
+ERROR_UNKNOWN_COMMAND = 11006
+
+_error_codes = {
+    COUPON_OPEN: ERROR_INVALID_STATE,
+    COUPON_NOT_OPEN: ERROR_INVALID_STATE,
+    NO_SUCH_ITEM: 8044,
+    NO_ITEMS: 8013,
+    ALREADY_TOTALIZED: 8007,
+    NOT_TOTALIZED: 8013,
+    NOT_PAID: 8017,
+    PENDING_REDUCE_Z: 15009,
+    NOTHING_TO_CANCEL: 8045,
+}
+
+# The money payment method, the programmable ones start at 0
+MONEY = -2
+
+_NON_FISCAL_NAMES = ['Suprimento', 'Sangria']
+
+
+class _Error(Exception):
+    def __init__(self, code, reason):
+        Exception.__init__(self, reason)
+        self.code = code
+        self.reason = reason
+
+
+def _parse_value(value):
+    if value.startswith('"'):
+        return re.sub(r'\\(.)', r'\1', value[1:-1])
+    elif value.startswith('#'):
+        d, m, y = map(int, value[1:-1].split('/'))
+        return datetime.date(2000 + y % 100, m, d)
+    elif value in ('t', 'f'):
+        return value == 't'
+    elif ',' in value:
+        return Decimal(value.replace(',', '.'))
+    elif value.lstrip('-').isdigit():
+        return int(value)
+    return value
+
+
+def _format_money(value):
+    return ('%.2f' % value).replace('.', ',')
+
+
+class FiscNetProtocol(BaseProtocol):
+    name = 'fiscnet'
+
+    def __init__(self, state=None):
+        BaseProtocol.__init__(self, state)
+        # The payment methods receipts can be bound to
+        self._vinculated = set()
+        self._registers = {
+            'Indicadores': self._get_flags,
+            'COO': lambda: self.state.coo,
+            'CCF': lambda: self.state.ccf,
+            'GNF': lambda: self.state.gnf,
+            'CRO': lambda: self.state.cro,
+            'CRZ': lambda: self.state.crz,
+            'ECF': lambda: 1,
+            'COOInicioDia': self._get_first_coo,
+            'ContadorDocUltimoItemVendido': self.state.get_item_count,
+            'TotalDocLiquido': self.state.get_subtotal,
+            'TotalDocValorPago': self.state.get_paid,
+            'DocumentoAberto': lambda: self.state.document is not None,
+            'NumeroSerieECF': lambda: self.state.serial,
+            'VersaoSW': lambda: '01.00.00',
+            'GT': lambda: self.state.grand_total,
+            'TotalDiaVendaBruta': lambda: self.state.period_total,
+            'TotalDiaDescontos': lambda: self.state.period_discount,
+            'TotalDiaCancelamentosICMS': lambda: self.state.period_cancelled,
+            'TotalDiaIsencaoICMS': lambda: self._get_tax_total('-3'),
+            'TotalDiaSubstituicaoTributariaICMS':
+            lambda: self._get_tax_total('-2'),
+            'TotalDiaNaoTributadoICMS': lambda: self._get_tax_total('-4'),
+            'DataAbertura': lambda: self.state.opening_date,
+        }
+        self._handlers = {
+            'LeInteiro': self._read_register,
+            'LeMoeda': self._read_register,
+            'LeData': self._read_register,
+            'LeTexto': self._read_register,
+            'LeIndicador': self._read_register,
+            'LeAliquota': self._read_tax,
+            'LeMeioPagamento': self._read_payment_method,
+            'LeNaoFiscal': self._read_non_fiscal,
+            'DefineAliquota': self._define_tax,
+            'ExcluiAliquota': self._delete_tax,
+            'DefineMeioPagamento': self._define_payment_method,
+            'ExcluiMeioPagamento': self._delete_payment_method,
+            'AbreCupomFiscal': self._coupon_open,
+            'VendeItem': self._add_item,
+            'AcresceItemFiscal': self._adjust_item,
+            'CancelaItemFiscal': self._cancel_item,
+            'CancelaCupom': self._cancel_coupon,
+            'AcresceSubtotal': self._totalize,
+            'PagaCupom': self._add_payment,
+            'EncerraDocumento': self._close_document,
+            'EmiteLeituraX': self._read_x,
+            'EmiteReducaoZ': self._reduce_z,
+            'AbreCupomNaoFiscal': self._open_non_fiscal,
+            'AbreCreditoDebito': self._open_non_fiscal,
+            'EmiteItemNaoFiscal': self._add_non_fiscal_item,
+            'AbreGerencial': self._open_report,
+        }
+
+    #
+    # Registers
+    #
+
+    def _get_flags(self):
+        flags = (FLAG_DIA_ABERTO | FLAG_INSCRICOES_OK | FLAG_CLICHE_OK |
+                 FLAG_EM_LINHA)
+        if self.state.document is not None:
+            flags |= FLAG_DOCUMENTO_ABERTO
+        if self.state.pending_reduce_z:
+            flags |= FLAG_Z_PENDENTE
+        return flags
+
+    def _get_first_coo(self):
+        reductions = self.state.get_documents(type='Z')
+        return reductions and reductions[-1]['coo'] + 1 or 1
+
+    def _get_tax_total(self, taxcode):
+        return self.state.tax_totals.get(taxcode, Decimal('0'))
+
+    def _read_register(self, name, params):
+        register = params.values()[0]
+        match = re.match(r'TotalDiaValorAliquota\[(\d+)\]', register)
+        if match:
+            value = self._get_tax_total(match.group(1))
+        elif register in self._registers:
+            value = self._registers[register]()
+        else:
+            raise _Error(ERROR_INVALID_STATE,
+                         'Unknown register %s' % register)
+        if name == 'LeInteiro':
+            return dict(ValorInteiro=str(value))
+        elif name == 'LeMoeda':
+            return dict(ValorMoeda=_format_money(value))
+        elif name == 'LeData':
+            return dict(ValorData=value.strftime('#%d/%m/%Y#'))
+        elif name == 'LeTexto':
+            return dict(ValorTexto='"%s"' % value)
+        return dict(ValorNumericoIndicador=str(int(bool(value))))
+
+    #
+    # Configuration
+    #
+
+    def _read_tax(self, name, params):
+        code = params['CodAliquotaProgramavel']
+        try:
+            value, service = self.state.taxes[code]
+        except (IndexError, TypeError):
+            raise _Error(ERROR_TAX_UNDEFINED, 'Aliquota nao carregada')
+        return dict(CodAliquotaProgramavel=str(code),
+                    PercentualAliquota=_format_money(value),
+                    AliquotaICMS=service and 'N' or 'Y')
+
+    def _read_payment_method(self, name, params):
+        code = params['CodMeioPagamentoProgram']
+        try:
+            method = self.state.payment_methods[code + 1]
+        except IndexError:
+            method = None
+        if method is None:
+            raise _Error(ERROR_PAYMENT_UNDEFINED,
+                         'Meio de pagamento nao carregado')
+        vinculated = code in self._vinculated
+        method = '"%s"' % method.encode('cp850')
+        return dict(CodMeioPagamentoProgram=str(code),
+                    NomeMeioPagamento=method,
+                    DescricaoMeioPagamento=method,
+                    PermiteVinculado=vinculated and 'Y' or 'N')
+
+    def _set_slot(self, table, index, value):
+        table.extend([None] * (index + 1 - len(table)))
+        table[index] = value
+
+    def _define_tax(self, name, params):
+        self._set_slot(self.state.taxes, params['CodAliquotaProgramavel'],
+                       (Decimal(str(params['PercentualAliquota'])),
+                        not params['AliquotaICMS']))
+
+    def _delete_tax(self, name, params):
+        self._set_slot(self.state.taxes, params['CodAliquotaProgramavel'],
+                       None)
+
+    def _define_payment_method(self, name, params):
+        code = params['CodMeioPagamentoProgram']
+        self._set_slot(self.state.payment_methods, code + 1,
+                       params['NomeMeioPagamento'].decode('cp850'))
+        if params['PermiteVinculado']:
+            self._vinculated.add(code)
+        else:
+            self._vinculated.discard(code)
+
+    def _delete_payment_method(self, name, params):
+        code = params['CodMeioPagamentoProgram']
+        self._set_slot(self.state.payment_methods, code + 1, None)
+        self._vinculated.discard(code)
+
+    def _read_non_fiscal(self, name, params):
+        code = params['CodNaoFiscal']
+        try:
+            name = '"%s"' % _NON_FISCAL_NAMES[code]
+        except IndexError:
+            raise _Error(ERROR_NON_FISCAL_UNDEFINED, 'Nao fiscal nao carregado')
+        return dict(NomeNaoFiscal=name, DescricaoNaoFiscal=name)
+
+    #
+    # Documents
+    #
+
+    def _coupon_open(self, name, params):
+        self.state.open_coupon()
+
+    def _add_item(self, name, params):
+        self.state.add_item(params['PrecoUnitario'], params['Quantidade'],
+                            taxcode=str(params['CodAliquota']))
+
+    def _adjust_item(self, name, params):
+        value = params['ValorAcrescimo']
+        if value < 0:
+            self.state.adjust_item(discount=-value)
+        else:
+            self.state.adjust_item(surcharge=value)
+
+    def _cancel_item(self, name, params):
+        self.state.cancel_item(params['NumItem'])
+
+    def _cancel_coupon(self, name, params):
+        self.state.cancel_coupon()
+
+    def _totalize(self, name, params):
+        value = params['ValorAcrescimo']
+        if value < 0:
+            self.state.totalize(discount=-value)
+        else:
+            self.state.totalize(surcharge=value)
+
+    def _add_payment(self, name, params):
+        if not self.state.has_open_coupon():
+            # Paying a non fiscal coupon
+            if self.state.document is None:
+                raise EmulatorError(COUPON_NOT_OPEN)
+            return
+        # The first payment totalizes the coupon
+        if not self.state.totalized:
+            self.state.totalize()
+        code = params['CodMeioPagamento']
+        method = code == MONEY and 0 or code + 1
+        self.state.add_payment(params['Valor'], method)
+
+    def _close_document(self, name, params):
+        if self.state.has_open_coupon():
+            self.state.close_coupon()
+        else:
+            self.state.close_document()
+
+    def _read_x(self, name, params):
+        self.state.read_x()
+
+    def _reduce_z(self, name, params):
+        self.state.reduce_z()
+
+    def _open_non_fiscal(self, name, params):
+        self.state.open_document(NON_FISCAL)
+
+    def _add_non_fiscal_item(self, name, params):
+        self.state.documents[-1].update(
+            total=params['Valor'],
+            cash_in=params['NomeNaoFiscal'] == _NON_FISCAL_NAMES[0])
+
+    def _open_report(self, name, params):
+        self.state.open_document(REPORT)
+
+    #
+    # Framing
+    #
+
+    def _build_reply(self, command_id, error, values):
+        retvals = ' '.join(['%s=%s' % item for item in sorted(values.items())])
+        return '%s%s;%d;%s;%s' % (START, command_id, error, retvals, END)
+
+    def extract(self, data):
+        start = data.find(START)
+        if start == -1:
+            return None, ''
+        quoted = False
+        for i in range(start + 1, len(data)):
+            c = data[i]
+            if c == '"' and data[i - 1] != '\\':
+                quoted = not quoted
+            elif c == END and not quoted:
+                return data[start + 1:i], data[i + 1:]
+        return None, data[start:]
+
+    def process(self, request):
+        command_id, name, parameters = request.split(';', 2)
+        params = {}
+        for key, value in _PARAM_RE.findall(parameters.rstrip(';')):
+            params[key] = _parse_value(value)
+        # Commands that only configure the printer are accepted silently
+        handler = self._handlers.get(name, lambda name, params: None)
+        try:
+            values = handler(name, params) or {}
+        except EmulatorError, e:
+            error = _error_codes.get(e.reason, ERROR_INVALID_STATE)
+            values = dict(NomeErro='"%s"' % e.reason,
+                          Circunstancia='"%s"' % e.reason)
+            return name, self._build_reply(command_id, error, values)
+        except _Error, e:
+            values = dict(NomeErro='"%s"' % e.reason,
+                          Circunstancia='"%s"' % e.reason)
+            return name, self._build_reply(command_id, e.code, values)
+        return name, self._build_reply(command_id, 0, values)
@@ -0,0 +1,62 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Maps the printer models to their protocol emulators.
+"""
+
+# (brand, model, protocol class)
+_PROTOCOLS = [
+    ('bematech', 'MP25', 'bematech.MP25Protocol'),
+    ('bematech', 'MP2100', 'bematech.MP25Protocol'),
+    ('bematech', 'MP20', 'bematech.MP20Protocol'),
+    ('bematech', 'MP4000', 'bematech.MP4000Protocol'),
+    ('epson', 'FBII', 'epson.FBIIProtocol'),
+    ('epson', 'FBIII', 'epson.FBIIIProtocol'),
+    ('daruma', 'FS345', 'daruma.FS345Protocol'),
+    ('daruma', 'FS2100', 'daruma.FS2100Protocol'),
+    ('dataregis', 'EP375', 'dataregis.EP375Protocol'),
+    ('fiscnet', 'FiscNetECF', 'fiscnet.FiscNetProtocol'),
+]
+
+
+def get_protocols():
+    """ Returns a list of (brand, model) tuples with an emulator. """
+    return [(brand, model) for brand, model, path in _PROTOCOLS]
+
+
+def get_protocol(brand, model, state=None):
+    """ Creates the protocol emulator for a printer model.
+
+    @param state: a L{stoqdrivers.emulator.base.FiscalState} to share
+        between emulators, a new one is created if not given
+    """
+    for protocol_brand, protocol_model, path in _PROTOCOLS:
+        if (protocol_brand, protocol_model) == (brand, model):
+            break
+    else:
+        raise ValueError("There is no emulator for %s %s" % (brand, model))
+    module_name, class_name = path.split('.')
+    module = __import__('stoqdrivers.emulator.' + module_name, {}, {}, ' ')
+    return getattr(module, class_name)(state)
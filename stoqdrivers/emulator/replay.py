@@ -0,0 +1,203 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Replays the conversations recorded with a device.
+
+A transcript has one line per read (R) or write (W), with the bytes
+escaped as in a python string literal. It is parsed once into a buffer
+holding everything the driver is expected to write and another holding
+everything the device replied, which the L{ReplayPort} walks with a
+cursor each.
+"""
+
+import bisect
+import os
+
+from zope.interface import implements
+
+from stoqdrivers.interfaces import ISerialPort
+
+# How many bytes around a mismatch are shown
+CONTEXT_SIZE = 16
+
+_transcripts = {}
+
+
+class ReplayMismatch(ValueError):
+    """ Raised when the driver writes something different from what was
+    recorded.
+
+    @ivar offset: the offset of the first unexpected byte in the writes
+    @ivar lineno: the line of the transcript holding that byte
+    """
+
+    def __init__(self, filename, offset, lineno, written, expected):
+        ValueError.__init__(
+            self, "Written data differs from the expected at offset %d "
+            "(%s:%d):\nWROTE:    %r\nRECORDED: %r" % (
+                offset, filename, lineno, written, expected))
+        self.filename = filename
+        self.offset = offset
+        self.lineno = lineno
+
+
+def _read_lines(filename):
+    fd = open(filename)
+    try:
+        for n, line in enumerate(fd):
+            if line[0] not in 'RW':
+                raise TypeError("Unrecognized entry type at %s:%d: %r"
+                                % (filename, n + 1, line[0]))
+            yield n + 1, line[0], line[2:].rstrip('\n').decode('string_escape')
+    finally:
+        fd.close()
+
+
+class Transcript(object):
+    """ A parsed transcript.
+
+    @ivar writes: all the bytes written by the driver
+    @ivar reads: all the bytes replied by the device
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        writes = []
+        reads = []
+        # The offsets in writes where each write line starts, and the
+        # number of these lines, to report mismatches.
+        self._offsets = []
+        self._linenos = []
+        offset = 0
+        for lineno, direction, data in _read_lines(filename):
+            if direction == 'W':
+                self._offsets.append(offset)
+                self._linenos.append(lineno)
+                writes.append(data)
+                offset += len(data)
+            else:
+                reads.append(data)
+        self.writes = ''.join(writes)
+        self.reads = ''.join(reads)
+
+    def get_records(self):
+        """ Returns a generator of (direction, data) for each line. """
+        for lineno, direction, data in _read_lines(self.filename):
+            yield direction, data
+
+    def get_lineno(self, offset):
+        """ Returns the line of the transcript writing the byte at offset. """
+        index = bisect.bisect_right(self._offsets, offset) - 1
+        if index < 0:
+            return 0
+        return self._linenos[index]
+
+
+def get_transcript(filename):
+    """ Returns the parsed transcript, parsing it only once per process
+    unless the file changes.
+    """
+    mtime = os.stat(filename).st_mtime
+    cached = _transcripts.get(filename)
+    if cached is None or cached[0] != mtime:
+        cached = _transcripts[filename] = (mtime, Transcript(filename))
+    return cached[1]
+
+
+class ReplayPort(object):
+    """ A serial port replaying a transcript.
+
+    Writes are checked against the recorded ones and reads return the
+    recorded replies, regardless of how the driver splits them.
+    """
+    implements(ISerialPort)
+
+    def __init__(self, transcript):
+        if isinstance(transcript, basestring):
+            transcript = get_transcript(transcript)
+        self.transcript = transcript
+        self._write_offset = 0
+        self._read_offset = 0
+
+    def setDTR(self, value=True):
+        pass
+
+    def getDSR(self):
+        return True
+
+    def waitDSR(self, timeout=None):
+        return True
+
+    def setBaudrate(self, baudrate):
+        pass
+
+    def setByteSize(self, bytesize):
+        pass
+
+    def setParity(self, parity):
+        pass
+
+    def setStopbits(self, stopbits):
+        pass
+
+    def setTimeout(self, read_timeout):
+        pass
+
+    def setWriteTimeout(self, write_timeout):
+        pass
+
+    def write(self, data):
+        start = self._write_offset
+        end = start + len(data)
+        expected = self.transcript.writes[start:end]
+        if data != expected:
+            offset = start
+            for a, b in zip(data, expected):
+                if a != b:
+                    break
+                offset += 1
+            context = max(offset - CONTEXT_SIZE, start)
+            raise ReplayMismatch(
+                self.transcript.filename, offset,
+                self.transcript.get_lineno(offset),
+                data[context - start:offset - start + CONTEXT_SIZE],
+                self.transcript.writes[context:offset + CONTEXT_SIZE])
+        self._write_offset = end
+
+    def read(self, n_bytes=1):
+        start = self._read_offset
+        data = self.transcript.reads[start:start + n_bytes]
+        if not data:
+            return None
+        self._read_offset += len(data)
+        return data
+
+    def close(self):
+        pass
+
+    def is_done(self):
+        """ Returns True if everything recorded was written and read. """
+        return (self._write_offset == len(self.transcript.writes) and
+                self._read_offset == len(self.transcript.reads))
@@ -42,10 +42,17 @@ class CommError(Exception):
 
 class PrinterError(Exception):
     "General printer errors"
+    # The frames exchanged with the device before the error, see
+    # stoqdrivers.flightrecorder
+    frames = None
 
 
 class DriverError(Exception):
     "Base exception for all printer errors"
+    # The frames exchanged with the device before the error, see
+    # stoqdrivers.flightrecorder
+    frames = None
+
     def __init__(self, error='', code=-1):
         if code != -1:
             error = '%d: %s' % (code, error)
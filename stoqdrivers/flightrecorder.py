@@ -0,0 +1,120 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+"""
+A flight recorder of the last frames exchanged with a device.
+
+Every driver keeps a L{FlightRecorder} which records the bytes written
+to and read from its port in a fixed size ring, so that the conversation
+which led to an error can be inspected even if debug logging was off.
+Consecutive reads, or writes, are merged in a single frame, since most
+drivers read the replies a byte at a time.
+
+The frames are attached to the L{stoqdrivers.exceptions.DriverError} and
+L{stoqdrivers.exceptions.PrinterError} raised while sending a command,
+as their I{frames} attribute, and can be saved with L{FlightRecorder.dump}
+in the capture format of L{stoqdrivers.capture}.
+"""
+
+import time
+
+from stoqdrivers.capture import READ, WRITE, CaptureWriter
+
+# Number of frames kept by default
+DEFAULT_SIZE = 64
+# A frame longer than this is continued in a new one
+MAX_FRAME_SIZE = 4096
+
+
+class FlightRecorder(object):
+    """ Records the last frames written to and read from a port
+
+    @ivar size: the number of frames kept
+    """
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self._directions = [None] * size
+        self._times = [0.0] * size
+        self._data = [''] * size
+        self._index = -1
+
+    def record(self, direction, data):
+        """ Records bytes read from or written to the port
+
+        @param direction: L{READ} or L{WRITE}
+        @param data: the bytes
+        """
+        index = self._index
+        if (index >= 0 and self._directions[index] == direction and
+            len(self._data[index]) < MAX_FRAME_SIZE):
+            self._data[index] += data
+            return
+        index = (index + 1) % self.size
+        self._directions[index] = direction
+        # The wall clock is much cheaper to read than the monotonic one
+        self._times[index] = time.time()
+        self._data[index] = data
+        self._index = index
+
+    def get_frames(self):
+        """ Returns the frames recorded, the oldest first
+
+        @returns: a list of (direction, time, data) tuples
+        """
+        if self._index < 0:
+            return []
+        start = (self._index + 1) % self.size
+        frames = []
+        for i in range(start, start + self.size):
+            i %= self.size
+            direction = self._directions[i]
+            if direction is None:
+                continue
+            frames.append((direction, self._times[i], self._data[i]))
+        return frames
+
+    def clear(self):
+        for i in range(self.size):
+            self._directions[i] = None
+            self._data[i] = ''
+        self._index = -1
+
+    def dump(self, filename):
+        """ Saves the frames recorded as a capture file, which can be read
+        with L{stoqdrivers.capture.read_capture} or converted to a
+        transcript.
+
+        @param filename: the file to write
+        """
+        frames = self.get_frames()
+        if frames:
+            origin = frames[0][1]
+        else:
+            origin = time.time()
+        writer = CaptureWriter(filename, start_time=origin)
+        try:
+            for direction, timestamp, data in frames:
+                writer.record(direction, data, timestamp - origin)
+        finally:
+            writer.close()
@@ -0,0 +1,168 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+"""
+Fail fast when a device stops replying.
+
+A device which is powered off or unplugged makes each command wait for
+all the retries of the driver before failing. Every driver has a
+L{CircuitBreaker} which opens after a number of consecutive timeouts;
+while it is open the commands fail at once with a
+L{stoqdrivers.exceptions.PrinterOfflineError}. After a cool-down period
+one command is let through to check if the device is back.
+
+L{stoqdrivers.serialbase.SerialBase.check_health} probes the device
+with the modem status lines and a status query with a short timeout,
+closing the breaker when the device replies.
+
+Some devices also refuse commands for a while when they are doing
+internal work, like the Daruma printers compacting their memory. A
+L{BusyWindow} learns how long that usually takes so that the driver
+knows when to try again.
+"""
+
+from stoqdrivers.utils import monotonic
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """ Counts the consecutive timeouts of a device
+
+    @ivar threshold: the number of consecutive timeouts which opens it
+    @ivar cooldown: the seconds it stays open before a command is tried
+    """
+
+    def __init__(self, threshold=2, cooldown=15.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._state = CLOSED
+        self._opened_at = None
+
+    def get_state(self):
+        """ Returns L{CLOSED}, L{OPEN} or L{HALF_OPEN} """
+        if (self._state == OPEN and
+            monotonic() - self._opened_at >= self.cooldown):
+            return HALF_OPEN
+        return self._state
+
+    def get_failures(self):
+        """ Returns the number of consecutive timeouts """
+        return self._failures
+
+    def get_remaining(self):
+        """ Returns the seconds left until a command is tried again """
+        if self._state != OPEN:
+            return 0.0
+        return max(0.0, self.cooldown - (monotonic() - self._opened_at))
+
+    def allow(self):
+        """ Returns if a command can be sent to the device. When the
+        cool-down period is over the commands are allowed again, but the
+        next timeout opens it for another period.
+        """
+        if self._state == OPEN:
+            self._state = self.get_state()
+        return self._state != OPEN
+
+    def add_success(self):
+        self._failures = 0
+        self._state = CLOSED
+        self._opened_at = None
+
+    def add_failure(self):
+        self._failures += 1
+        if self._state != CLOSED or self._failures >= self.threshold:
+            self._state = OPEN
+            self._opened_at = monotonic()
+
+    def reset(self):
+        self.add_success()
+
+
+class BusyWindow(object):
+    """ Learns how long a device stays busy and estimates when it will
+    accept commands again
+
+    @ivar estimate: the expected length of a busy period in seconds, it
+      is a moving average of the periods seen
+    @ivar weight: how much the last period counts in the average
+    @ivar interval: the first delay of the retries, doubled on each one
+    """
+
+    def __init__(self, estimate=1.0, weight=0.3, interval=0.05):
+        self.estimate = estimate
+        self.weight = weight
+        self.interval = interval
+        self._since = None
+
+    def is_busy(self):
+        return self._since is not None
+
+    def get_busy_time(self):
+        """ Returns the seconds since the device became busy """
+        if self._since is None:
+            return 0.0
+        return monotonic() - self._since
+
+    def get_busy_until(self):
+        """ Returns the monotonic time the device is expected to be
+        ready, or None if it is not busy
+        """
+        if self._since is None:
+            return None
+        return self._since + self.estimate
+
+    def get_delay(self, attempt, urgent=True):
+        """ Returns the seconds to wait before trying again
+
+        Urgent commands are retried with an exponential backoff which
+        never goes past the estimated end of the busy period, the others
+        wait for it at once.
+
+        @param attempt: the number of retries done so far
+        @param urgent: if the caller is waiting for the command
+        """
+        remaining = self.estimate - self.get_busy_time()
+        if not urgent and remaining > self.interval:
+            return remaining
+        delay = self.interval * 2 ** attempt
+        if remaining > self.interval:
+            delay = min(delay, remaining)
+        return min(delay, max(self.estimate, self.interval))
+
+    def add_busy(self):
+        """ Tells that the device refused a command for being busy """
+        if self._since is None:
+            self._since = monotonic()
+
+    def add_ready(self):
+        """ Tells that the device accepted a command """
+        if self._since is None:
+            return
+        period = monotonic() - self._since
+        self.estimate += self.weight * (period - self.estimate)
+        self._since = None
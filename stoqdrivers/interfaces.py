@@ -56,6 +56,14 @@ class ISerialPort(Interface):
         read.
         """
 
+    def waitDSR(timeout=None):
+        """ Blocks until getDSR() returns True, without using the CPU
+        while waiting.
+
+        @param timeout: the seconds to wait, None to wait forever
+        @returns: True if DSR was set, False on timeout
+        """
+
     def setDTR(value):
         """ Set to True when the driver is going to send data to the device
         """
@@ -0,0 +1,255 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+"""
+A local index of the invoices read from the journal of a printer.
+
+Reading the journal from the printer is slow, so the invoices read once are
+kept in a SQLite database, indexed by COO, date and payment method, where
+later queries about past invoices can be answered without asking the
+printer again.
+
+L{sync} keeps an index up to date: the last COO read from each printer is
+recorded in the index, so every sync only reads what was emitted since the
+previous one.
+"""
+
+from decimal import Decimal
+from itertools import islice
+import sqlite3
+
+# Invoices committed together by sync, an interrupted sync loses at most
+# these and resumes after the last ones committed
+SYNC_BATCH_SIZE = 100
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoice (
+    coo INTEGER PRIMARY KEY,
+    ccf INTEGER,
+    date TIMESTAMP NOT NULL,
+    cancelled TIMESTAMP);
+CREATE INDEX IF NOT EXISTS invoice_date ON invoice (date);
+CREATE TABLE IF NOT EXISTS payment (
+    coo INTEGER NOT NULL REFERENCES invoice (coo),
+    method TEXT NOT NULL,
+    value INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS payment_coo ON payment (coo);
+CREATE INDEX IF NOT EXISTS payment_method ON payment (method, coo);
+CREATE TABLE IF NOT EXISTS checkpoint (
+    serial TEXT PRIMARY KEY,
+    coo INTEGER NOT NULL,
+    crz INTEGER NOT NULL);
+"""
+
+
+class Invoice(object):
+    """ An invoice of the journal
+
+    @ivar coo: the coupon number
+    @ivar ccf: the fiscal coupon counter, or None
+    @ivar date: the datetime it was emitted
+    @ivar payments: a tuple of (method, value) pairs
+    @ivar cancelled: the datetime it was cancelled, or None
+    """
+
+    __slots__ = ('coo', 'ccf', 'date', 'payments', 'cancelled')
+
+    def __init__(self, coo, ccf, date, payments=(), cancelled=None):
+        self.coo = coo
+        self.ccf = ccf
+        self.date = date
+        self.payments = payments
+        self.cancelled = cancelled
+
+    def __eq__(self, other):
+        if not isinstance(other, Invoice):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name)
+                   for name in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<Invoice COO %d %s>' % (self.coo, self.date)
+
+
+class InvoiceIndex(object):
+    """ Keeps invoices in a SQLite database
+
+    @ivar filename: the database file, or ':memory:'
+    """
+
+    def __init__(self, filename=':memory:'):
+        self.filename = filename
+        self._conn = sqlite3.connect(filename,
+                                     detect_types=sqlite3.PARSE_DECLTYPES)
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def add(self, invoices, checkpoint=None):
+        """ Adds invoices, replacing the ones already indexed with the
+        same COO. They are committed at once.
+
+        @param invoices: an iterable of L{Invoice}, which is consumed
+          as the invoices are stored
+        @param checkpoint: a (serial, crz) tuple, if given the checkpoint
+          of that printer is moved to the last invoice in the same commit
+        @returns: the number of invoices added
+        """
+        conn = self._conn
+        count = 0
+        try:
+            for invoice in invoices:
+                conn.execute("DELETE FROM payment WHERE coo = ?",
+                             (invoice.coo, ))
+                conn.execute("INSERT OR REPLACE INTO invoice "
+                             "(coo, ccf, date, cancelled) VALUES (?, ?, ?, ?)",
+                             (invoice.coo, invoice.ccf, invoice.date,
+                              invoice.cancelled))
+                conn.executemany("INSERT INTO payment (coo, method, value) "
+                                 "VALUES (?, ?, ?)",
+                                 [(invoice.coo, method, int(value * 100))
+                                  for method, value in invoice.payments])
+                count += 1
+            if checkpoint is not None and count:
+                serial, crz = checkpoint
+                self._set_checkpoint(serial, invoice.coo, crz)
+        except:
+            conn.rollback()
+            raise
+        conn.commit()
+        return count
+
+    def get(self, coo):
+        """ Returns the L{Invoice} with the given COO, or None """
+        invoices = self.find(coo=coo)
+        return invoices and invoices[0] or None
+
+    def get_checkpoint(self, serial):
+        """ Returns the last COO and CRZ synced from a printer
+
+        @param serial: the serial number of the printer
+        @returns: a (coo, crz) tuple, or None if it was never synced
+        """
+        return self._conn.execute(
+            "SELECT coo, crz FROM checkpoint WHERE serial = ?",
+            (serial, )).fetchone()
+
+    def set_checkpoint(self, serial, coo, crz):
+        """ Records the last COO and CRZ synced from a printer """
+        self._set_checkpoint(serial, coo, crz)
+        self._conn.commit()
+
+    def _set_checkpoint(self, serial, coo, crz):
+        self._conn.execute("INSERT OR REPLACE INTO checkpoint "
+                           "(serial, coo, crz) VALUES (?, ?, ?)",
+                           (serial, coo, crz))
+
+    def get_last_coo(self):
+        """ Returns the highest COO indexed, or None if it is empty """
+        return self._conn.execute("SELECT MAX(coo) FROM invoice").fetchone()[0]
+
+    def find(self, start=None, end=None, method=None, coo=None):
+        """ Returns the invoices matching all the given criteria, by COO
+
+        @param start: the first datetime
+        @param end: the last datetime
+        @param method: the name of a payment method used
+        @param coo: a coupon number
+        @returns: a list of L{Invoice}
+        """
+        where, args = self._get_where(start, end, method, coo)
+        rows = self._conn.execute(
+            "SELECT coo, ccf, date, cancelled FROM invoice%s "
+            "ORDER BY coo" % where, args).fetchall()
+        payments = {}
+        for coo, method, value in self._conn.execute(
+            "SELECT coo, method, value FROM payment WHERE coo IN "
+            "(SELECT coo FROM invoice%s) ORDER BY rowid" % where, args):
+            payments.setdefault(coo, []).append(
+                (method, Decimal(value) / 100))
+        return [Invoice(coo, ccf, date, tuple(payments.get(coo, ())),
+                        cancelled)
+                for coo, ccf, date, cancelled in rows]
+
+    def get_total(self, start=None, end=None, method=None):
+        """ Returns the sum of the payments of the invoices which were not
+        cancelled, see L{find} for the parameters
+        """
+        where, args = self._get_where(start, end, None, None)
+        query = ("SELECT SUM(value) FROM payment WHERE coo IN "
+                 "(SELECT coo FROM invoice%s%s cancelled IS NULL)" % (
+                     where, where and ' AND' or ' WHERE'))
+        if method is not None:
+            query += " AND method = ?"
+            args.append(method)
+        total = self._conn.execute(query, args).fetchone()[0]
+        return Decimal(total or 0) / 100
+
+    def _get_where(self, start, end, method, coo):
+        clauses = []
+        args = []
+        if coo is not None:
+            clauses.append("coo = ?")
+            args.append(coo)
+        if start is not None:
+            clauses.append("date >= ?")
+            args.append(start)
+        if end is not None:
+            clauses.append("date <= ?")
+            args.append(end)
+        if method is not None:
+            clauses.append("coo IN (SELECT coo FROM payment WHERE method = ?)")
+            args.append(method)
+        if not clauses:
+            return '', args
+        return ' WHERE ' + ' AND '.join(clauses), args
+
+
+def sync(driver, index, batch_size=SYNC_BATCH_SIZE):
+    """ Adds to an index the invoices a printer emitted since it was last
+    synced, and moves its checkpoint to the current COO and CRZ.
+
+    @param driver: a driver with get_serial, get_coo, get_crz and
+      iter_invoices(first_coo, last_coo) methods
+    @param index: an L{InvoiceIndex}
+    @returns: the number of invoices added
+    """
+    serial = driver.get_serial()
+    checkpoint = index.get_checkpoint(serial)
+    first = checkpoint and checkpoint[0] + 1 or 1
+    last = driver.get_coo()
+    crz = driver.get_crz()
+    count = 0
+    if first <= last:
+        invoices = driver.iter_invoices(first, last)
+        while True:
+            added = index.add(islice(invoices, batch_size), (serial, crz))
+            if not added:
+                break
+            count += added
+    index.set_checkpoint(serial, max(last, first - 1), crz)
+    return count
@@ -0,0 +1,267 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+"""
+A local ledger of the sales done through a fiscal printer.
+
+A L{SalesLedger} set in a L{stoqdrivers.printers.fiscal.FiscalPrinter}
+records in SQLite every coupon emitted, with its items, payments and
+cancellations, and the cash added to and removed from the till. Each call
+is committed as soon as the printer accepts it, so the ledger survives a
+crash, and the daily reports can be answered from it, leaving the printer
+to reconcile the totals.
+"""
+
+import datetime
+from decimal import Decimal, ROUND_HALF_UP
+import sqlite3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS coupon (
+    id INTEGER PRIMARY KEY,
+    coo INTEGER,
+    opened TIMESTAMP NOT NULL,
+    closed TIMESTAMP,
+    cancelled TIMESTAMP,
+    discount INTEGER NOT NULL DEFAULT 0,
+    surcharge INTEGER NOT NULL DEFAULT 0,
+    total INTEGER);
+CREATE INDEX IF NOT EXISTS coupon_coo ON coupon (coo);
+CREATE INDEX IF NOT EXISTS coupon_closed ON coupon (closed);
+CREATE TABLE IF NOT EXISTS item (
+    coupon INTEGER NOT NULL REFERENCES coupon (id),
+    item_id INTEGER NOT NULL,
+    code TEXT NOT NULL,
+    description TEXT NOT NULL,
+    price TEXT NOT NULL,
+    quantity TEXT NOT NULL,
+    taxcode TEXT NOT NULL,
+    discount TEXT NOT NULL,
+    surcharge TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    cancelled INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS item_coupon ON item (coupon, item_id);
+CREATE INDEX IF NOT EXISTS item_taxcode ON item (taxcode);
+CREATE TABLE IF NOT EXISTS payment (
+    coupon INTEGER NOT NULL REFERENCES coupon (id),
+    method TEXT NOT NULL,
+    value INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS payment_coupon ON payment (coupon);
+CREATE INDEX IF NOT EXISTS payment_method ON payment (method);
+CREATE TABLE IF NOT EXISTS cash (
+    date TIMESTAMP NOT NULL,
+    value INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS cash_date ON cash (date);
+"""
+
+# The coupons which count as sales
+_SOLD = "closed IS NOT NULL AND cancelled IS NULL"
+
+
+def _cents(value):
+    return int((value * 100).quantize(Decimal('1'), ROUND_HALF_UP))
+
+
+def _value(cents):
+    return Decimal(cents or 0) / 100
+
+
+class SalesLedger(object):
+    """ Records the sales done through a fiscal printer in SQLite
+
+    @ivar filename: the database file, or ':memory:'
+    """
+
+    def __init__(self, filename=':memory:'):
+        self.filename = filename
+        self._conn = sqlite3.connect(filename,
+                                     detect_types=sqlite3.PARSE_DECLTYPES)
+        self._conn.executescript(_SCHEMA)
+        # A coupon left open by the last run is still the current one
+        row = self._conn.execute(
+            "SELECT MAX(id) FROM coupon WHERE closed IS NULL AND "
+            "cancelled IS NULL").fetchone()
+        self._coupon = row[0]
+
+    def close(self):
+        self._conn.close()
+
+    def _execute(self, query, args=()):
+        cursor = self._conn.execute(query, args)
+        self._conn.commit()
+        return cursor
+
+    #
+    # Recording, called by the FiscalPrinter
+    #
+
+    def open_coupon(self):
+        if self._coupon is not None:
+            # The printer only opens a coupon when the last one is done
+            self._conn.execute("UPDATE coupon SET cancelled = ? WHERE id = ?",
+                               (datetime.datetime.now(), self._coupon))
+        self._coupon = self._execute(
+            "INSERT INTO coupon (opened) VALUES (?)",
+            (datetime.datetime.now(), )).lastrowid
+
+    def add_item(self, item_id, code, description, price, taxcode,
+                 quantity, discount, surcharge):
+        """ Records an item, discount and surcharge are percentages """
+        total = price * quantity * (100 - discount + surcharge) / 100
+        self._execute(
+            "INSERT INTO item (coupon, item_id, code, description, price, "
+            "quantity, taxcode, discount, surcharge, total) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (self._coupon, item_id, code, description, str(price),
+             str(quantity), taxcode, str(discount), str(surcharge),
+             _cents(total)))
+
+    def cancel_item(self, item_id):
+        self._execute("UPDATE item SET cancelled = 1 "
+                      "WHERE coupon = ? AND item_id = ?",
+                      (self._coupon, item_id))
+
+    def totalize(self, discount, surcharge, total):
+        self._execute("UPDATE coupon SET discount = ?, surcharge = ?, "
+                      "total = ? WHERE id = ?",
+                      (_cents(discount), _cents(surcharge), _cents(total),
+                       self._coupon))
+
+    def add_payment(self, method, value):
+        self._execute("INSERT INTO payment (coupon, method, value) "
+                      "VALUES (?, ?, ?)",
+                      (self._coupon, method, _cents(value)))
+
+    def close_coupon(self, coo):
+        self._execute("UPDATE coupon SET coo = ?, closed = ? WHERE id = ?",
+                      (coo, datetime.datetime.now(), self._coupon))
+        self._coupon = None
+
+    def cancel_coupon(self):
+        self._execute("UPDATE coupon SET cancelled = ? WHERE id = ?",
+                      (datetime.datetime.now(), self._coupon))
+        self._coupon = None
+
+    def cancel_last_coupon(self):
+        self._execute(
+            "UPDATE coupon SET cancelled = ? WHERE id = "
+            "(SELECT MAX(id) FROM coupon WHERE %s)" % _SOLD,
+            (datetime.datetime.now(), ))
+
+    def add_cash(self, value):
+        """ Records cash added to the till, or removed if negative """
+        self._execute("INSERT INTO cash (date, value) VALUES (?, ?)",
+                      (datetime.datetime.now(), _cents(value)))
+
+    #
+    # Reports
+    #
+
+    def _get_period(self, start, end, column='closed'):
+        clauses = []
+        args = []
+        if start is not None:
+            clauses.append("%s >= ?" % column)
+            args.append(start)
+        if end is not None:
+            clauses.append("%s <= ?" % column)
+            args.append(end)
+        return ''.join(' AND ' + clause for clause in clauses), args
+
+    def get_last_coo(self):
+        """ Returns the COO of the last coupon closed, or None """
+        row = self._conn.execute(
+            "SELECT coo FROM coupon WHERE closed IS NOT NULL "
+            "ORDER BY id DESC LIMIT 1").fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_coupon(self, coo):
+        """ Returns a coupon closed with the given COO
+
+        @returns: a dict with the coo, opened, closed, cancelled, discount,
+          surcharge and total of the coupon, its items, a list of dicts,
+          and its payments, a list of (method, value) tuples; or None
+        """
+        conn = self._conn
+        row = conn.execute(
+            "SELECT id, opened, closed, cancelled, discount, surcharge, "
+            "total FROM coupon WHERE coo = ? ORDER BY id DESC LIMIT 1",
+            (coo, )).fetchone()
+        if row is None:
+            return None
+        id, opened, closed, cancelled, discount, surcharge, total = row
+        items = [dict(item_id=item_id, code=code, description=description,
+                      price=Decimal(price), quantity=Decimal(quantity),
+                      taxcode=taxcode, total=_value(item_total),
+                      cancelled=bool(item_cancelled))
+                 for (item_id, code, description, price, quantity, taxcode,
+                      item_total, item_cancelled) in conn.execute(
+            "SELECT item_id, code, description, price, quantity, taxcode, "
+            "total, cancelled FROM item WHERE coupon = ? ORDER BY rowid",
+            (id, ))]
+        payments = [(method, _value(value)) for method, value in conn.execute(
+            "SELECT method, value FROM payment WHERE coupon = ? "
+            "ORDER BY rowid", (id, ))]
+        return dict(coo=coo, opened=opened, closed=closed,
+                    cancelled=cancelled, discount=_value(discount),
+                    surcharge=_value(surcharge), total=_value(total),
+                    items=items, payments=payments)
+
+    def get_sales(self, start=None, end=None):
+        """ Returns the number and the total of the coupons sold, which were
+        closed and not cancelled, between two datetimes
+        """
+        period, args = self._get_period(start, end)
+        count, total = self._conn.execute(
+            "SELECT COUNT(*), SUM(total) FROM coupon WHERE %s%s" % (
+                _SOLD, period), args).fetchone()
+        return count, _value(total)
+
+    def get_tax_totals(self, start=None, end=None):
+        """ Returns a dict with the total of the items sold by tax code,
+        before the discounts and surcharges of the coupons
+        """
+        period, args = self._get_period(start, end)
+        return dict(
+            (taxcode, _value(total)) for taxcode, total in self._conn.execute(
+                "SELECT taxcode, SUM(total) FROM item WHERE cancelled = 0 "
+                "AND coupon IN (SELECT id FROM coupon WHERE %s%s) "
+                "GROUP BY taxcode" % (_SOLD, period), args))
+
+    def get_payment_totals(self, start=None, end=None):
+        """ Returns a dict with the total paid by payment method """
+        period, args = self._get_period(start, end)
+        return dict(
+            (method, _value(total)) for method, total in self._conn.execute(
+                "SELECT method, SUM(value) FROM payment WHERE "
+                "coupon IN (SELECT id FROM coupon WHERE %s%s) "
+                "GROUP BY method" % (_SOLD, period), args))
+
+    def get_cash_total(self, start=None, end=None):
+        """ Returns the cash added to the till minus the cash removed """
+        period, args = self._get_period(start, end, 'date')
+        return _value(self._conn.execute(
+            "SELECT SUM(value) FROM cash WHERE 1%s" % period,
+            args).fetchone()[0])
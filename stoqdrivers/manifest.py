@@ -0,0 +1,259 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Static manifest of the drivers shipped with stoqdrivers.
+
+Listing the available devices does not need to import any driver module,
+the driver class is only imported when L{DriverInfo.load} is called or
+when an attribute which is not in the manifest is accessed.
+
+The manifest must be kept in sync with the driver classes, use
+L{validate_manifest} to check it and L{generate_manifest} (or run this
+module as a script) to regenerate it after adding or changing a driver.
+"""
+
+import os
+import sys
+
+DEVICE_INTERFACES = ('ICouponPrinter', 'IChequePrinter', 'IScale',
+                     'IBarcodeReader')
+
+# device_dirname, brand, model, model_name, interfaces, supported
+_MANIFEST = [
+    ('printers', 'bematech', 'DP20C', 'Bematech DP20C',
+     ('IChequePrinter',), False),
+    ('printers', 'bematech', 'MP20', 'Bematech MP20 TH FI',
+     ('ICouponPrinter',), True),
+    ('printers', 'bematech', 'MP2100', 'Bematech MP2100 TH FI',
+     ('ICouponPrinter',), True),
+    ('printers', 'bematech', 'MP25', 'Bematech MP25 FI',
+     ('ICouponPrinter',), True),
+    ('printers', 'bematech', 'MP4000', 'Bematech MP4000 TH FI',
+     ('ICouponPrinter',), True),
+    ('printers', 'daruma', 'FS2100', 'Daruma FS 2100',
+     ('ICouponPrinter',), True),
+    ('printers', 'daruma', 'FS345', 'Daruma FS 345',
+     ('ICouponPrinter',), True),
+    ('printers', 'daruma', 'FS600MFD', 'Daruma FS 600 MFD',
+     ('ICouponPrinter',), True),
+    ('printers', 'dataregis', 'EP375', 'Dataregis 375 EP',
+     ('ICouponPrinter', 'IChequePrinter'), False),
+    ('printers', 'dataregis', 'Quick', 'Dataregis ECF-IF 3202DT (Quick)',
+     ('ICouponPrinter', 'IChequePrinter'), True),
+    ('printers', 'elgin', 'KFiscal', 'Elgin K Fiscal',
+     ('ICouponPrinter', 'IChequePrinter'), True),
+    ('printers', 'epson', 'FBII', 'Epson FBII',
+     ('ICouponPrinter',), True),
+    ('printers', 'epson', 'FBIII', 'Epson FBIII',
+     ('ICouponPrinter',), True),
+    ('printers', 'fiscnet', 'FiscNetECF', None,
+     ('ICouponPrinter', 'IChequePrinter'), False),
+    ('printers', 'perto', 'Pay2023', 'Pertopay Fiscal 2023',
+     ('ICouponPrinter', 'IChequePrinter'), True),
+    ('printers', 'virtual', 'Simple', 'Virtual Printer',
+     ('ICouponPrinter',), False),
+    ('readers.barcode', 'metrologic', 'MC630', 'Metrologic MC630',
+     ('IBarcodeReader',), False),
+    ('scales', 'toledo', 'PrixIII', 'Toledo Prix III',
+     ('IScale',), False),
+]
+
+
+class DriverInfo(object):
+    """ A manifest entry describing a driver.
+
+    @ivar device_dirname: the package the driver lives in, relative to
+        stoqdrivers, eg 'printers' or 'readers.barcode'
+    @ivar brand: the brand, which is also the name of the driver package
+    @ivar model: the model, which is also the name of the module and of
+        the driver class
+    @ivar model_name: a string describing briefly the device
+    @ivar interfaces: names of the device interfaces (see
+        L{DEVICE_INTERFACES}) implemented by the driver
+    @ivar supported: if the driver is supported, ie, should be offered
+        to the user
+    """
+
+    def __init__(self, device_dirname, brand, model, model_name,
+                 interfaces, supported):
+        self.device_dirname = device_dirname
+        self.brand = brand
+        self.model = model
+        self.model_name = model_name
+        self.interfaces = interfaces
+        self.supported = supported
+        self.__name__ = model
+        self._driver_class = None
+
+    def __repr__(self):
+        return '<DriverInfo %s.%s.%s>' % (self.device_dirname, self.brand,
+                                          self.model)
+
+    def __getattr__(self, attr):
+        # Only called for attributes which are not in the manifest
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self.load(), attr)
+
+    def get_module_name(self):
+        return 'stoqdrivers.%s.%s.%s' % (self.device_dirname, self.brand,
+                                         self.model)
+
+    def implements(self, interface):
+        """ Returns True if the driver implements the interface, without
+        loading it.
+        """
+        return interface.__name__ in self.interfaces
+
+    def is_loaded(self):
+        return self._driver_class is not None
+
+    def load(self):
+        """ Imports the driver module and returns the driver class """
+        if self._driver_class is None:
+            name = self.get_module_name()
+            module = __import__(name, {}, {}, ' ')
+            try:
+                self._driver_class = getattr(module, self.model)
+            except AttributeError:
+                raise ImportError("Can't find class %s for module %s"
+                                  % (self.model, name))
+        return self._driver_class
+
+
+_drivers = [DriverInfo(*entry) for entry in _MANIFEST]
+
+
+def get_drivers(device_dirname, interface=None, supported_only=True):
+    """ Returns a dictionary mapping each brand to a list of
+    L{DriverInfo} of the given device type. None of the driver modules
+    is imported.
+
+    @param device_dirname: 'printers', 'scales' or 'readers.barcode'
+    @param interface: if specified, only return drivers implementing it
+    @param supported_only: if only supported drivers should be returned
+    """
+    result = {}
+    for info in _drivers:
+        if info.device_dirname != device_dirname:
+            continue
+        if supported_only and not info.supported:
+            continue
+        if interface is not None and not info.implements(interface):
+            continue
+        result.setdefault(info.brand, []).append(info)
+    return result
+
+
+def get_driver_info(device_dirname, brand, model):
+    """ Looks up a driver in the manifest.
+
+    @returns: the L{DriverInfo} or None if there is no such driver
+    """
+    for info in _drivers:
+        if (info.device_dirname == device_dirname and
+                info.brand == brand and info.model == model):
+            return info
+    return None
+
+
+#
+# Generation and validation
+#
+
+
+def _find_driver_modules():
+    root = os.path.dirname(os.path.abspath(__file__))
+    for device_dirname in ['printers', 'readers.barcode', 'scales']:
+        device_dir = os.path.join(root, *device_dirname.split('.'))
+        for brand in sorted(os.listdir(device_dir)):
+            brand_dir = os.path.join(device_dir, brand)
+            if not os.path.exists(os.path.join(brand_dir, '__init__.py')):
+                continue
+            for filename in sorted(os.listdir(brand_dir)):
+                model, ext = os.path.splitext(filename)
+                # Driver modules are named after the class they define
+                if ext != '.py' or not model[0].isupper():
+                    continue
+                yield device_dirname, brand, model
+
+
+def generate_manifest():
+    """ Imports all the driver modules found in the source tree and
+    returns the manifest entries describing them.
+    """
+    from stoqdrivers import interfaces
+
+    entries = []
+    for device_dirname, brand, model in _find_driver_modules():
+        info = DriverInfo(device_dirname, brand, model, None, (), False)
+        driver_class = info.load()
+        ifaces = tuple([name for name in DEVICE_INTERFACES
+                        if getattr(interfaces, name).implementedBy(
+                            driver_class)])
+        entries.append((device_dirname, brand, model,
+                        driver_class.model_name, ifaces,
+                        bool(getattr(driver_class, 'supported', False))))
+    return entries
+
+
+def validate_manifest():
+    """ Compares the static manifest with the one generated from the
+    driver classes.
+
+    @returns: a list of strings describing the differences, empty if the
+        manifest is up to date
+    """
+    errors = []
+    static = dict([(entry[:3], entry) for entry in _MANIFEST])
+    generated = dict([(entry[:3], entry) for entry in generate_manifest()])
+    for key in sorted(set(static) | set(generated)):
+        name = '.'.join(key)
+        if key not in generated:
+            errors.append('%s is in the manifest but does not exist' % name)
+        elif key not in static:
+            errors.append('%s is missing from the manifest' % name)
+        elif static[key] != generated[key]:
+            errors.append('%s is outdated, should be %r'
+                          % (name, generated[key]))
+    return errors
+
+
+def main(args):
+    if '--check' in args:
+        errors = validate_manifest()
+        for error in errors:
+            print error
+        return len(errors) and 1
+
+    print '_MANIFEST = ['
+    for entry in generate_manifest():
+        print '    %r,' % (entry,)
+    print ']'
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -28,13 +28,13 @@ Generic base class implementation for all printers
 """
 
 from zope.interface import providedBy, implements
-from kiwi.python import namedAny
 
 from stoqdrivers.interfaces import (ICouponPrinter,
                                     IDriverConstants,
                                     IChequePrinter)
 from stoqdrivers.base import BaseDevice
 from stoqdrivers.enum import DeviceType
+from stoqdrivers.manifest import get_drivers
 from stoqdrivers.translation import stoqdrivers_gettext
 
 _ = stoqdrivers_gettext
@@ -82,9 +82,6 @@ class BasePrinter(BaseDevice):
             if enum == item:
                 return constant
 
-    def get_model_name(self):
-        return self._driver.model_name
-
 
 def get_virtual_printer():
     from stoqdrivers.printers.fiscal import FiscalPrinter
@@ -92,27 +89,11 @@ def get_virtual_printer():
 
 
 def get_supported_printers():
-    result = {}
-    for brand, module_names in [
-        ('bematech', ['DP20C', 'MP20', 'MP2100', 'MP25', 'MP4000']),
-            ('daruma', ['FS2100', 'FS345', 'FS600MFD']),
-            ('dataregis', ['EP375', 'Quick']),
-            ('elgin', ['KFiscal']),
-            ('epson', ['FBII', 'FBIII']),
-            ('fiscnet', ['FiscNetECF']),
-            ('perto', ['Pay2023'])]:
-        result[brand] = []
-        for module_name in module_names:
-            try:
-                obj = namedAny("stoqdrivers.printers.%s.%s.%s"
-                               % (brand, module_name, module_name))
-            except AttributeError:
-                raise ImportError("Can't find class %s for module %s"
-                                  % (module_name, module_name))
-            if not hasattr(obj, 'supported'):
-                continue
-            result[brand].append(obj)
-    return result
+    """ Returns a dictionary mapping each brand to a list of the supported
+    printers. The printers are L{stoqdrivers.manifest.DriverInfo} entries,
+    the driver modules are only imported when needed.
+    """
+    return get_drivers('printers')
 
 
 def get_supported_printers_by_iface(interface):
@@ -121,16 +102,7 @@ def get_supported_printers_by_iface(interface):
     if not interface in (ICouponPrinter, IChequePrinter):
         raise TypeError("Interface specified (`%r') is not a valid "
                         "printer interface" % interface)
-    all_printers_supported = get_supported_printers()
-    result = {}
-    for model, driver_list in all_printers_supported.items():
-        drivers = []
-        for driver in driver_list:
-            if interface.implementedBy(driver):
-                drivers.append(driver)
-        if drivers:
-            result[model] = drivers
-    return result
+    return get_drivers('printers', interface=interface)
 
 
 def get_baudrate_values():
@@ -39,7 +39,9 @@ from kiwi.log import Logger
 from kiwi.python import Settable
 from zope.interface import implements
 
+from stoqdrivers import wirelog
 from stoqdrivers.serialbase import SerialBase
+from stoqdrivers.stats import instrumented
 from stoqdrivers.exceptions import (DriverError, OutofPaperError, PrinterError,
                                     CommandError, CouponOpenError,
                                     HardwareFailure,
@@ -49,6 +51,7 @@ from stoqdrivers.exceptions import (DriverError, OutofPaperError, PrinterError,
 from stoqdrivers.interfaces import ICouponPrinter
 from stoqdrivers.printers.capabilities import Capability
 from stoqdrivers.printers.base import BaseDriverConstants
+from stoqdrivers.provisioning import Table
 from stoqdrivers.enum import TaxType, UnitType
 from stoqdrivers.translation import stoqdrivers_gettext
 
@@ -237,8 +240,8 @@ class MP25Status(object):
                 raise error_codes[key]
 
     def check_error(self):
-        log.debug("status: st1=%s st2=%s st3=%s" %
-                  (self.st1, self.st2, self.st3))
+        log.debug("status: st1=%s st2=%s st3=%s",
+                  self.st1, self.st2, self.st3)
 
         if self.st1 != 0:
             self._check_error_in_dict(self.st1_codes, self.st1)
@@ -282,6 +285,52 @@ def dec2bin(n, trim=-1):
             a = ("0" * (trim - len(a))) + a
     return a
 
+
+class _TaxTable(Table):
+    # New taxes take the next free totalizer
+
+    def read(self):
+        status = self.driver._read_register(self.driver.registers.TOTALIZERS)
+        status = struct.unpack('>H', status)[0]
+        length, data = self.driver._send_command(CMD_READ_TAXCODES,
+                                                 response='b32s')
+        taxes = {}
+        for i in range(16):
+            value = bcd2dec(data[i * 2:i * 2 + 2])
+            if value:
+                taxes[i] = (Decimal(value) / 100, bool(1 << 15 - i & status))
+        return taxes
+
+    def write(self, slot, entry):
+        value, service = entry
+        self.driver._send_command(CMD_ADD_TAX, '%04d%d' % (
+            int(value * Decimal('1e2')), bool(service)))
+
+
+class _PaymentMethodTable(Table):
+    # New methods take the next free slot, the printer does not report
+    # if they can be bound to payment receipts
+
+    def read(self):
+        status = self.driver._read_register(
+            self.driver.registers.PAYMENT_METHODS)[1]
+        charset = self.driver.coupon_printer_charset
+        methods = {}
+        for i in range(20):
+            method = status[i * 16:i * 16 + 16]
+            if method != '\x00' * 16:
+                methods[i] = (method.strip().decode(charset), None)
+        return methods
+
+    def write(self, slot, entry):
+        name, vinculated = entry
+        name = name.encode(self.driver.coupon_printer_charset)
+        self.driver._send_command(CMD_PROGRAM_PAYMENT_METHOD,
+                                  '%-16s%d' % (name[:16], bool(vinculated)))
+
+    def get_key(self, entry):
+        return entry[0][:16].strip()
+
 #
 # Driver implementation
 #
@@ -345,8 +394,7 @@ class MP25(SerialBase):
         data = ''
         while True:
             if a > RETRIES_BEFORE_TIMEOUT:
-                raise DriverError(_("Timeout communicating with fiscal "
-                                    "printer"))
+                raise self.get_timeout_error()
 
             a += 1
             reply = self.read(size)
@@ -357,13 +405,15 @@ class MP25(SerialBase):
             if len(data) < size:
                 continue
 
-            log.debug("<<< %r (%d bytes)" % (data, len(data)))
+            if wirelog.is_enabled(log):
+                log.debug("<<< %s (%d bytes)", wirelog.frame(data), len(data))
             return data
 
     def _check_error(self, retval=None):
         status = self.get_status(retval)
         status.check_error()
 
+    @instrumented()
     def _send_command(self, command, *args, **kwargs):
         fmt = ''
         if 'response' in kwargs:
@@ -437,6 +487,9 @@ class MP25(SerialBase):
 
         return MP25Status(val)
 
+    def _probe(self):
+        self._send_command(CMD_STATUS, raw=True)
+
     def _add_voucher(self, type, value):
         assert len(type) == 2
 
@@ -448,7 +501,7 @@ class MP25(SerialBase):
 
     def _setup_constants(self):
         return
-        # Do one at a time, if you need it.
+        # Do one at a time, if you need it, or use FiscalPrinter.provision()
         #self._send_command(CMD_PROGRAM_PAYMENT_METHOD,
         #                         '%-16s1' % 'Cartao Credito', raw=True)
         #self._send_command(CMD_PROGRAM_PAYMENT_METHOD,
@@ -502,18 +555,12 @@ class MP25(SerialBase):
                                       end.strftime('%d%m%y')))
 
     def _till_read_memory_to_serial(self, start, end):
+        return u''.join(self.till_iter_memory(start, end))
+
+    def till_iter_memory(self, start, end):
         self._send_command(CMD_READ_MEMORY, '%s%sR' % (
             start.strftime('%d%m%y'), end.strftime('%d%m%y')))
-
-        data = ''
-        while True:
-            c = self.read(1)
-            if ord(c) == 0x03:
-                break
-
-            data += unicode(c, self.coupon_printer_charset)
-
-        return data
+        return self.iter_until('\x03', self.coupon_printer_charset)
 
     def till_read_memory_by_reductions(self, start, end):
         self._send_command(CMD_READ_MEMORY,
@@ -696,6 +743,10 @@ class MP25(SerialBase):
     def get_constants(self):
         return self._consts
 
+    def get_provisioning_tables(self):
+        return dict(taxes=_TaxTable(self),
+                    payment_methods=_PaymentMethodTable(self))
+
     def query_status(self):
         #return '\x02\x05\x00\x1b#(f\x00'
         query = self._create_packet(chr(CMD_READ_REGISTER) +
@@ -720,6 +771,9 @@ class MP25(SerialBase):
     def get_crz(self):
         return self._read_register(self.registers.NUMBER_REDUCTIONS_Z)
 
+    def get_last_item_id(self):
+        return self._get_last_item_id()
+
     def get_tax_constants(self):
         status = self._read_register(self.registers.TOTALIZERS)
         status = struct.unpack('>H', status)[0]
@@ -768,7 +822,7 @@ class MP25(SerialBase):
         total_discount = self._read_register(self.registers.TOTAL_DISCOUNT)
 
         # Avbr function TACBrECFBematech.GetVendaBruta
-        registers = self._send_command(62, 55, response='308s')
+        registers = self._get_last_z()
         coupon_end = int(bcd2hex(registers)[568:568 + 6])
 
         grande_total = self._read_register(self.registers.TOTAL)
@@ -821,6 +875,9 @@ class MP25(SerialBase):
         firmware = "%s:%s:%s" % (ret[0:2], ret[2:4], ret[4:6])
         return firmware
 
+    def _get_last_z(self):
+        return self._send_command(62, 55, response='308s')
+
     def _get_rif(self):
         return self._read_register(self.registers.RIF)
 
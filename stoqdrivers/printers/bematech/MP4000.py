@@ -7,7 +7,10 @@ Created on Thu Sep  6 17:12:46 2012
 
 from stoqdrivers.printers.bematech.MP25 import MP25
 from stoqdrivers.printers.bematech.MP25 import *
+from stoqdrivers import wirelog
 from stoqdrivers.exceptions import AlmostOutofPaper
+from stoqdrivers.journal import Invoice
+from stoqdrivers.stats import instrumented
 import re
 import datetime
 log = Logger('stoqdrivers.bematech.MP4000')
@@ -68,7 +71,8 @@ class MP4000Registers(object):
         FISCAL_FLAGS: ('1s', False),
         EMISSION_DATE: ('6s', False),
         TRUNC_FLAG: ('1s', False),
-        TOTALIZERS: ('2s', True),
+        # ISS flags, one bit per tax, like on the MP25
+        TOTALIZERS: ('2s', False),
         #  1 + (52 * 16) + (52 * 10) + (52 * 10) + (52 * 1)
         #  1 + 832 + 520 + 520 + 52: 1925
         PAYMENT_METHODS: ('b832s520s520s52s', False),
@@ -88,6 +92,123 @@ class MP4000Registers(object):
     
 
 
+_PAYMENT_VALUE_RE = re.compile(r'^-?[0-9]+,[0-9]+$')
+
+
+def _parse_datetime(date, time):
+    # dd/mm/YYYY HH:MM:SS, strptime is too slow to call for every invoice
+    return datetime.datetime(int(date[6:10]), int(date[3:5]), int(date[:2]),
+                             int(time[:2]), int(time[3:5]), int(time[6:8]))
+
+
+def _get_invoice_dict(invoice):
+    # The format returned by MP4000._get_transactions
+    cancel = {}
+    if invoice.cancelled is not None:
+        cancel = {'COO': '%06d' % invoice.coo, 'date': invoice.cancelled}
+    return {'COO': '%06d' % invoice.coo,
+            'CCF': '%06d' % invoice.ccf,
+            'date': invoice.date,
+            'payments': dict((method, float(value))
+                             for method, value in invoice.payments),
+            'cancel': cancel}
+
+
+class TransactionParser(object):
+    """
+    Parses the transactions journal line by line, as it is read
+
+    @ivar summary: the totals found in the journal, start, end, ninvoices,
+      ncancels, till and store
+    """
+    # Lines before the first invoice
+    HEADER_LINES = 11
+
+    def __init__(self):
+        self.summary = {}
+        self._lines = 0
+        self._invoice = None
+        self._payments = []
+
+    def parse(self, lines):
+        """
+        Yields the invoices of the journal, as soon as each one ends
+
+        @param lines: an iterable of lines
+        @returns: an iterator of L{Invoice}
+        """
+        try:
+            for line in lines:
+                invoice = self.feed(line)
+                if invoice is not None:
+                    yield invoice
+        finally:
+            # Lets a reader stopped early drop the rest of the journal
+            close = getattr(lines, 'close', None)
+            if close is not None:
+                close()
+        invoice = self.close()
+        if invoice is not None:
+            yield invoice
+
+    def feed(self, line):
+        """
+        Parses a line
+
+        @returns: the L{Invoice} the line ended, or None
+        """
+        self._lines += 1
+        if self._lines <= self.HEADER_LINES:
+            return
+        conts = line.split()
+        if not conts:
+            return
+        summary = self.summary
+        if 'COO:' in conts[0]:
+            invoice = self.close()
+            date = _parse_datetime(conts[2], conts[3])
+            self._invoice = Invoice(int(conts[0].split(':')[1]),
+                                    int(conts[1].split(':')[1]), date)
+            return invoice
+        elif (len(conts) > 1 and conts[-2] == '=' and
+              _PAYMENT_VALUE_RE.match(conts[-1])):
+            # Totals before the first invoice look the same
+            if self._invoice is None:
+                return
+            self._payments.append((' '.join(conts[:-2]),
+                                   Decimal(conts[-1].replace(',', '.'))))
+        elif 'ANULACI' in conts[0]:
+            if self._invoice is not None:
+                self._invoice.cancelled = _parse_datetime(conts[2], conts[3])
+        elif len(conts) < 3:
+            return
+        elif 'Factura' in conts[0] and 'Inicial' in conts[1]:
+            summary['start'] = int(conts[2])
+        elif 'Factura' in conts[0] and 'Final' in conts[1]:
+            summary['end'] = int(conts[2])
+        elif len(conts) > 3 and 'Facturas' in conts[2] and 'mero' in conts[0]:
+            if 'Anuladas' in conts[3]:
+                summary['ncancels'] = int(conts[4])
+            else:
+                summary['ninvoices'] = int(conts[3])
+        elif ('VERSI' in conts[0] and 'CAJA' in conts[1] and
+              'TIENDA' in conts[2]):
+            summary['till'] = int(conts[1].split(':')[1])
+            summary['store'] = int(conts[2].split(':')[1])
+
+    def close(self):
+        """
+        Ends the invoice being parsed
+
+        @returns: the L{Invoice}, or None if there was none
+        """
+        invoice = self._invoice
+        if invoice is not None:
+            invoice.payments = tuple(self._payments)
+        self._invoice = None
+        self._payments = []
+        return invoice
+
 
 class MP4000(MP25):
     model_name = "Bematech MP4000 TH FI"
@@ -156,8 +277,7 @@ class MP4000(MP25):
         data = ''
         while True:
             if a > RETRIES_BEFORE_TIMEOUT:
-                raise DriverError(_("Timeout communicating with fiscal "
-                                    "printer"))
+                raise self.get_timeout_error()
 
             a += 1
             reply = self.read(size)
@@ -168,7 +288,8 @@ class MP4000(MP25):
             if len(data) < size:
                 continue
 
-            log.debug("<<< %r (%d bytes)" % (data, len(data)))
+            if wirelog.is_enabled(log):
+                log.debug("<<< %s (%d bytes)", wirelog.frame(data), len(data))
             return data
             
     def _get_bytes(self, number):
@@ -188,6 +309,7 @@ class MP4000(MP25):
                 ret = chr(b) + ret
         return ret
         
+    @instrumented()
     def _send_command(self, command, *args, **kwargs):
         fmt = ''
         if 'response' in kwargs:
@@ -366,74 +488,61 @@ class MP4000(MP25):
         """
         Returns a string with all transactions from a given range
         """
+        if dest == 'I':
+            self._request_transactions(start, end, dest)
+            return True
+        return u''.join(self._iter_transactions(start, end))
+
+    def _request_transactions(self, start, end, dest):
         cmd = self._get_bytes(CMD_TRANSACTIONS)
         if isinstance(start, datetime.datetime) and isinstance(end, datetime.datetime): 
             cmd += '%6s%6s'%(start.strftime('%d%m%y'), end.strftime('%d%m%y'))
         else:
-            cmd += '00%04d00%04d'%(start, end)
+            # A COO range, each COO takes the 6 digits a date would
+            cmd += '%06d%06d' % (start, end)
         cmd += dest
-        print cmd
         data = self._create_packet(cmd)
         self.write(data)
-        if dest == 'I':
-            return True
-        res = ''
-        c = '0'
-        while True:
-            c = self.read(1)
-            if c == chr(ECK):
-                break
-            res += unicode(c, self.coupon_printer_charset)
-        res = res[3:]
-        return res
+
+    def _iter_transactions(self, start, end):
+        """
+        Yields the lines of the transactions from a given range as they
+        are read
+        """
+        self._request_transactions(start, end, 'R')
+        # The report starts after a 3 bytes header
+        self._read_reply(3)
+        return self.iter_until(chr(ECK), self.coupon_printer_charset)
 
     def _get_transactions(self, start, end):
         """
         Returns a dictionary with all transactions in a given period
         """
-        res = self._read_transactions(start, end)
-        res = res.split('\n')
-        data = {'invoices' : []}
-        f = {}
-        for t in res[11:]:
-            conts = [ m for m in t.split(' ') if m]
-            if conts:
-                # print "Linea ", conts
-                if 'COO:' in conts[0]:
-                    if f:
-                        data['invoices'].append(f)
-                    f = {'payments':{}, 'cancel':{}}
-                    temp = conts[0].split(':')
-                    f.update({temp[0]:temp[1]})
-                    temp = conts[1].split(':')
-                    f.update({temp[0]:temp[1]})
-                    temp = ['date', datetime.datetime.strptime('%s %s'%(conts[2], conts[3]), '%d/%m/%Y %H:%M:%S')]
-                    f.update({temp[0]:temp[1]})
-                elif re.search(r'^(-|)[0-9]{1,},[0-9]{1,}$', conts[-1]) and conts[-2] =='=':
-                    temp = [' '.join(conts[:-2]), float(conts[-1].replace(',', '.'))]
-                    f['payments'].update({temp[0]:temp[1]})
-                elif 'ANULACI' in conts[0]:
-                    temp = conts[1].split(':')
-                    f['cancel'].update({temp[0]:temp[1]})
-                    temp = ['date', datetime.datetime.strptime('%s %s'%(conts[2], conts[3]), '%d/%m/%Y %H:%M:%S')]
-                    f['cancel'].update({temp[0]:temp[1]})
-                elif 'Factura' in conts[0] and 'Inicial' in conts[1]:
-                    data.update({'start':int(conts[2])})
-                elif 'Factura' in conts[0] and 'Final' in conts[1]:
-                    data.update({'end':int(conts[2])})
-                elif len(conts) > 3 and 'Facturas' in conts[2] and 'mero' in conts[0] and 'Anuladas' in conts[3]:
-                    data.update({'ncancels':int(conts[4])})
-                elif len(conts) > 3 and 'Facturas' in conts[2] and 'mero' in conts[0]:
-                    data.update({'ninvoices':int(conts[3])})
-                elif 'VERSI' in conts[0] and 'CAJA' in conts[1] and 'TIENDA' in conts[2]:
-                    temp = conts[1].split(':')
-                    data.update({'till':int(temp[1])})
-                    temp = conts[2].split(':')
-                    data.update({'store':int(temp[1])})
-        if f:
-            data['invoices'].append(f)
+        parser = TransactionParser()
+        invoices = [_get_invoice_dict(invoice) for invoice in
+                    parser.parse(self._iter_transactions(start, end))]
+        data = dict(parser.summary)
+        data['invoices'] = invoices
         return data
-        
+
+    def index_transactions(self, start, end, index):
+        """
+        Reads the transactions of a given period into an index, as they
+        arrive
+
+        @param index: a L{stoqdrivers.journal.InvoiceIndex}
+        @returns: the number of invoices indexed
+        """
+        return index.add(self.iter_invoices(start, end))
+
+    def iter_invoices(self, start, end):
+        """
+        Yields the invoices of a given period, or COO range, as they are
+        read, see L{stoqdrivers.journal.sync}
+        """
+        parser = TransactionParser()
+        return parser.parse(self._iter_transactions(start, end))
+
     def get_capabilities(self):
         """
         Fields size for this printer
@@ -528,8 +637,8 @@ class MP4000Status(object):
                 raise error_codes[key]
 
     def check_error(self):
-        log.debug("status: st=%s st1=%s st2=%s" %
-                    (self.st, self.st1, self.st2))
+        log.debug("status: st=%s st1=%s st2=%s",
+                  self.st, self.st1, self.st2)
         # print "status: st=%s st1=%s st2=%s" % (self.st_descr, self.st1, self.st2)
         #if self.st != ACK:
             
@@ -44,6 +44,17 @@ class capcheck(argcheck):
         kwargs = kwargs.copy()
         kwargs.update(dict(keyvalues))
         self._check_capabilities(cargs[0], **kwargs)
+        self._trace(cargs[0])
+
+    def _trace(self, inst):
+        # This is the last check, so the validation phase of the traced
+        # call ends here, see stoqdrivers.tracing
+        get_tracer = getattr(inst, 'get_tracer', None)
+        if get_tracer is None:
+            return
+        tracer = get_tracer()
+        if tracer is not None:
+            tracer.add_phase('validate')
 
     def _check_capabilities(self, inst, **kwargs):
         caps = inst.get_capabilities()
@@ -29,7 +29,6 @@ from ConfigParser import ConfigParser
 import datetime
 
 from zope.interface.exceptions import DoesNotImplement
-from zope.interface import providedBy
 from kiwi.argcheck import argcheck, number
 from kiwi.environ import environ
 
@@ -137,10 +136,11 @@ class ChequePrinter(BasePrinter):
                  *args, **kwargs):
         BasePrinter.__init__(self, brand, model, device, config_file, *args,
                              **kwargs)
-        if not IChequePrinter in providedBy(self._driver):
+        if not IChequePrinter.implementedBy(self._driver_class):
             raise DoesNotImplement("The driver %r doesn't implements the "
-                                   "IChequePrinter interface" % self._driver)
-        self._charset = self._driver.cheque_printer_charset
+                                   "IChequePrinter interface"
+                                   % self._driver_class)
+        self._charset = self._driver_class.cheque_printer_charset
 
     def _format_text(self, text):
         return encode_text(text, self._charset)
@@ -31,10 +31,17 @@ import operator
 from decimal import Decimal
 import time
 
+from stoqdrivers import wirelog
+from stoqdrivers.health import BusyWindow
 from stoqdrivers.printers.base import BaseDriverConstants
-from stoqdrivers.printers.daruma.FS345 import FS345, CMD_GET_TAX_CODES
+from stoqdrivers.printers.daruma.FS345 import (
+    FS345, CMD_GET_MODEL, CMD_GET_FIRMWARE, CMD_GET_X, CMD_READ_MEMORY,
+    CMD_GET_CONFIGURATION, CMD_GET_TAX_CODES, CMD_GET_IDENTIFIER,
+    CMD_GET_PERSONAL_MESSAGES, CMD_GET_DOCUMENT_STATUS,
+    CMD_GET_FISCAL_REGISTRIES, CMD_GET_REGISTRIES, CMD_GET_DATES)
 from stoqdrivers.enum import UnitType, TaxType
 from stoqdrivers.exceptions import DriverError
+from stoqdrivers.stats import instrumented
 
 from kiwi.log import Logger
 
@@ -51,6 +58,18 @@ FF = 255
 
 CMD_ADD_ITEM = 201
 
+# The errors replied while the MFD is being compacted
+BUSY_ERRORS = (35, 99)
+_BUSY_REPLIES = [':E%02d' % error for error in BUSY_ERRORS]
+
+# Commands that only read reports and status, while the MFD is being
+# compacted they wait for the expected end of it instead of polling
+_DEFERRABLE_COMMANDS = set([
+    CMD_GET_MODEL, CMD_GET_FIRMWARE, CMD_GET_X, CMD_READ_MEMORY,
+    CMD_GET_CONFIGURATION, CMD_GET_TAX_CODES, CMD_GET_IDENTIFIER,
+    CMD_GET_PERSONAL_MESSAGES, CMD_GET_DOCUMENT_STATUS,
+    CMD_GET_FISCAL_REGISTRIES, CMD_GET_REGISTRIES, CMD_GET_DATES])
+
 
 class FS2100Constants(BaseDriverConstants):
     _constants = {
@@ -63,10 +82,22 @@ class FS2100Constants(BaseDriverConstants):
 
 class FS2100(FS345):
     model_name = "Daruma FS 2100"
+    # Seconds to wait for the compaction of the MFD before giving up
+    compaction_timeout = 30
+
+    # The replies the printer still owes for the refused commands
+    _late_replies = 0
 
     def __init__(self, port, consts=None):
         consts = consts or FS2100Constants
         FS345.__init__(self, port, consts)
+        self._busy = BusyWindow()
+
+    def set_busy_window(self, busy):
+        """ Replaces the L{stoqdrivers.health.BusyWindow} that learns how
+        long the compaction of the MFD takes, eg to change its delays
+        """
+        self._busy = busy
 
     def setup(self):
         # Check printer to see how many decimal places it uses for price and
@@ -130,43 +161,77 @@ class FS2100(FS345):
         Segundo o Suporte Técnico da Daruma, quando este problema ocorre,
         devemos aguardar até que ele consiga responder corretamente.
 
-        Esta rotina irá tentar enviar o comando por 10 vezes. Caso ela
-        recebe os erros 35 ou 99... ele aguarda 100 milisegundos e tenta um
-        novo envio...
+        The command is sent again while the printer replies with these
+        errors, see L{_wait_compaction}. How long the compaction takes is
+        learnt, so the commands that only read reports and status wait for
+        its expected end instead of polling the printer.
         """
-
-        for t in range(10):
+        urgent = command not in _DEFERRABLE_COMMANDS
+        self._defer(urgent)
+        attempt = 0
+        while True:
             try:
                 retval = FS345.send_command(self, command, extra)
             except DriverError, e:
-                if e.code == 99 or e.code == 35:
-                    log.debug('FS2100 >>> Error 99. Sleeping for 0.1')
-                    time.sleep(0.1)
-                    continue
-
-                raise
+                if e.code not in BUSY_ERRORS:
+                    self._busy.add_ready()
+                    self._read_late_replies()
+                    raise
+                # The printer still replies once for each time the
+                # command was refused, after the next one it accepts, so
+                # the fewer retries the fewer replies to read
+                self._late_replies += 1
+                if not self._wait_compaction(attempt, urgent):
+                    raise
+                attempt += 1
+                continue
             break
+        self._busy.add_ready()
+        self._read_late_replies()
+        return retval
 
-        # After we have tried to send the command T times, we need to read
-        # all the responses. This is really crap
-        for i in range(t):
+    def _read_late_replies(self):
+        late, self._late_replies = self._late_replies, 0
+        for i in range(late):
             reply = self._read_reply()
-            log.debug('Ignoring reply: %r' % reply)
-
-        return retval
+            log.debug('Ignoring reply: %r', reply)
+
+    def _defer(self, urgent):
+        if not urgent and self._busy.is_busy():
+            time.sleep(self._busy.get_delay(0, urgent))
+
+    def _wait_compaction(self, attempt, urgent):
+        # Called when the printer replied that it is busy, returns False
+        # when it has been busy for too long
+        busy = self._busy
+        busy.add_busy()
+        if busy.get_busy_time() >= self.compaction_timeout:
+            return False
+        delay = busy.get_delay(attempt, urgent)
+        log.debug('FS2100 >>> Compacting the MFD, sleeping for %.2f', delay)
+        time.sleep(delay)
+        return True
+
+    def get_busy_until(self):
+        """ Returns the monotonic time the compaction of the MFD is
+        expected to end, or None if the printer is not compacting it
+        """
+        return self._busy.get_busy_until()
 
     def _check_response(self, retcode, raw):
         # Compatible with the fs345/fs2100
         compatible_error = retcode[1:3]
         extended_error = retcode[3:6]
         warning_code = retcode[6:8]
-        log.debug('FS2100 >>> Error %s - Extended: %s - Warning: %s' %
-                  (compatible_error, extended_error, warning_code))
+        log.debug('FS2100 >>> Error %s - Extended: %s - Warning: %s',
+                  compatible_error, extended_error, warning_code)
         if int(compatible_error):
             # Mimic FS345 error format
             error_code = ':E%s' % compatible_error
             self.handle_error(error_code, raw)
 
+    @instrumented(lambda prefix, command, *args, **kwargs:
+                  prefix + chr(command))
     def send_new_command(self, prefix, command, extra='', ignore_error=False):
         """ This method is used to send especific commands to model FS2100.
         Note that the main differences are the prefix (0x1c + 'F', since we
@@ -175,21 +240,28 @@ class FS2100(FS345):
         """
         data = chr(command) + extra
 
-        log.debug('FS2100 >>> %r %d' % (data, len(data)))
+        if wirelog.is_enabled(log):
+            log.debug('FS2100 >>> %s %d', wirelog.frame(data), len(data))
         data = chr(FS) + prefix + data
 
         checksum = reduce(operator.xor, [ord(d) for d in data], 0)
 
-        for t in range(10):
+        # See send_command for more details
+        urgent = prefix != 'R'
+        self._defer(urgent)
+        attempt = 0
+        while True:
+            self._status = None
             self.write(data + chr(checksum))
             retval = self.readline()
-
-            # See send_command for more details
-            if retval == ':E99' or retval == ':E35':
-                log.debug('FS2100 >>> Error 99. Sleeping for 0.1')
-                time.sleep(0.1)
-            else:
+            if retval not in _BUSY_REPLIES:
+                self._busy.add_ready()
                 break
+            # Unlike the ESC commands, these are not replied again once
+            # the printer is ready, so there are no late replies to read
+            if not self._wait_compaction(attempt, urgent):
+                self.handle_error(retval, data)
+            attempt += 1
 
         # After the CR, there is still one byte for the checksum
         retval_checksum = self.read(1)
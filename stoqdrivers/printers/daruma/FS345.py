@@ -36,11 +36,13 @@ from kiwi.log import Logger
 from kiwi.python import Settable
 from zope.interface import implements
 
-from stoqdrivers import abicomp
+from stoqdrivers import abicomp, wirelog
 from stoqdrivers.serialbase import SerialBase
+from stoqdrivers.stats import instrumented
 from stoqdrivers.interfaces import ICouponPrinter
 from stoqdrivers.printers.capabilities import Capability
 from stoqdrivers.printers.base import BaseDriverConstants
+from stoqdrivers.provisioning import Table, provision
 from stoqdrivers.enum import TaxType, UnitType
 from stoqdrivers.exceptions import (DriverError, PendingReduceZ,
                                     HardwareFailure, ReduceZError,
@@ -49,6 +51,7 @@ from stoqdrivers.exceptions import (DriverError, PendingReduceZ,
                                     CouponOpenError, CancelItemError,
                                     CloseCouponError)
 from stoqdrivers.translation import stoqdrivers_gettext
+from stoqdrivers.utils import monotonic
 
 abicomp.register_codec()
 
@@ -122,6 +125,9 @@ CASH_OUT_TYPE = 'A'
 
 RETRIES_BEFORE_TIMEOUT = 5
 
+# Seconds a status reply is reused for, as long as no command is sent
+STATUS_TTL = 0.5
+
 # Document status
 OPENED_FISCAL_COUPON = '1'
 CLOSED_COUPON = '2'
@@ -139,6 +145,87 @@ def ifset(value, bit, false='', true=''):
         return true
 
 
+class FS345Status(object):
+    """ A status reply of the printer, decoded once. It is immutable, a
+    new one is taken for each status query. The codes are on pages 57-59.
+
+    @ivar raw: the reply, starting with ':'
+    @ivar taken: the monotonic time the reply was read
+    """
+
+    def __init__(self, raw, taken=None):
+        if not raw or raw[0] != ':':
+            raise HardwareFailure('Broken status reply')
+        if taken is None:
+            taken = monotonic()
+        self.__dict__.update(
+            raw=raw,
+            taken=taken,
+            drawer_open=isbitset(raw[1], 3),
+            mechanical_failure=isbitset(raw[1], 2),
+            authenticated=isbitset(raw[1], 1),
+            out_of_paper=isbitset(raw[1], 0),
+            offline=isbitset(raw[2], 3),
+            pending_reduce_z=isbitset(raw[2], 1),
+            almost_out_of_paper=isbitset(raw[2], 0),
+            coupon_open=isbitset(raw[4], 2),
+            reduce_z_done=isbitset(raw[6], 1),
+            needs_read_x=not isbitset(raw[6], 2))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % type(self).__name__)
+
+    def get_age(self):
+        return monotonic() - self.taken
+
+
+class _TaxTable(Table):
+    # New taxes take the next free letter
+
+    def read(self):
+        tax_codes = self.driver.send_command(CMD_GET_TAX_CODES)[1:]
+        taxes = {}
+        for i in range(14):
+            value = tax_codes[i * 5 + 1:i * 5 + 5]
+            if value == '////':
+                continue
+            service = tax_codes[i * 5] in 'abcdefghijklmnop'
+            taxes[i] = (Decimal(value.replace('.', '')) / 100, service)
+        return taxes
+
+    def write(self, slot, entry):
+        value, service = entry
+        self.driver.send_command(CMD_CONFIGURE_TAXES, '%s%04d' % (
+            service and 'S' or '', int(value * Decimal('1e2'))))
+
+
+class _PaymentMethodTable(Table):
+    size = 16
+
+    def read(self):
+        # Page 48
+        raw = self.driver.send_command(CMD_GET_PERSONAL_MESSAGES)[708:]
+        charset = self.driver.coupon_printer_charset
+        methods = {}
+        for i in range(self.size):
+            method = raw[i * 18:i * 18 + 18]
+            if method[2] == '\xff':
+                continue
+            name = method[1:].strip().decode(charset)
+            methods[i] = (name, method[0] == 'V')
+        return methods
+
+    def write(self, slot, entry):
+        name, vinculated = entry
+        name = name.encode(self.driver.coupon_printer_charset)
+        self.driver.send_command(CMD_DESCRIBE_MESSAGES, 'PG%s%s%-17s' % (
+            vinculated and 'V' or 'X', 'ABCDEFGHIJKLMNOP'[slot], name[:17]))
+
+    def get_key(self, entry):
+        name, vinculated = entry
+        return name[:17].strip(), vinculated
+
+
 class FS345Constants(BaseDriverConstants):
     _constants = {
         UnitType.WEIGHT: 'Kg',
@@ -162,6 +249,7 @@ class FS345(SerialBase):
     def __init__(self, port, consts=None):
         self._consts = consts or FS345Constants
         SerialBase.__init__(self, port)
+        self._status = None
         self._reset()
 
     def _reset(self):
@@ -169,9 +257,12 @@ class FS345(SerialBase):
         self._customer_document = u""
         self._customer_address = u""
 
+    @instrumented()
     def send_command(self, command, extra=''):
         raw = chr(command) + extra
         while True:
+            # Any command may change the status
+            self._status = None
             self.write(self.CMD_PREFIX + raw + self.CMD_SUFFIX)
             retval = self._read_reply()
             if retval.startswith(':E'):
@@ -192,8 +283,7 @@ class FS345(SerialBase):
 
         while True:
             if timeouts > RETRIES_BEFORE_TIMEOUT:
-                raise DriverError(_("Timeout communicating with fiscal "
-                                    "printer"))
+                raise self.get_timeout_error()
 
             c = self.read(1)
             if len(c) != 1:
@@ -201,7 +291,8 @@ class FS345(SerialBase):
                 continue
 
             if c == self.EOL_DELIMIT:
-                log.debug("<<< %r" % rep)
+                if wirelog.is_enabled(log):
+                    log.debug("<<< %s", wirelog.frame(rep))
                 return rep
 
             rep += c
@@ -211,44 +302,57 @@ class FS345(SerialBase):
         self.write(CMD_STATUS)
         return self._read_reply()
 
+    def _probe(self):
+        self._get_status()
+
+    def get_status(self, max_age=STATUS_TTL):
+        """ Returns a L{FS345Status} of the printer. The last one is
+        reused if it is not older than max_age seconds and no command was
+        sent since it was taken, so that the checks done by one operation
+        query the printer once.
+        """
+        status = self._status
+        if status is None or status.get_age() > max_age:
+            status = self._status = FS345Status(self._get_status())
+        return status
+
     def status_check(self, S, byte, bit):
         return isbitset(S[byte], bit)
 
     def _check_status(self, verbose=False):
-        status = self._get_status()
-        if status[0] != ':':
-            raise HardwareFailure('Broken status reply')
+        status = self.get_status()
 
         if verbose:
             print '== STATUS =='
 
             # Codes found on page 57-59
-            print 'Raw status code:', status
-            print 'Cashier drawer is', ifset(status[1], 3, 'closed', 'open')
+            print 'Raw status code:', status.raw
+            print 'Cashier drawer is', (status.drawer_open and 'open' or
+                                        'closed')
 
-        if self.has_pending_reduce():
+        if status.pending_reduce_z:
             raise PendingReduceZ(_('Pending Reduce Z'))
-        if self.status_check(status, 1, 2):
+        if status.mechanical_failure:
             raise HardwareFailure(_('Mechanical failure'))
-        if not self.status_check(status, 1, 1):
+        if not status.authenticated:
             raise AuthenticationFailure(_('Not properly authenticated'))
-        if self.status_check(status, 1, 0):
+        if status.out_of_paper:
             raise OutofPaperError(_('No paper'))
-        if self.status_check(status, 2, 3):
+        if status.offline:
             raise PrinterOfflineError(_("Offline"))
-        #if not self.status_check(status, 2, 2):
+        #if not self.status_check(status.raw, 2, 2):
         #     raise CommError(_("Peripheral is not connected to AUX"))
-        if self.status_check(status, 2, 0):
+        if status.almost_out_of_paper:
             log.info('Almost out of paper')
 
         if verbose:
-            S3 = status[3]
+            S3 = status.raw[3]
             print ifset(S3, 3, 'Maintenance', 'Operational'), 'mode'
             print 'Authentication', ifset(S3, 2, 'disabled', 'enabled')
             print 'Guillotine', ifset(S3, 1, 'disabled', 'enabled')
             print 'Auto close CF?', ifset(S3, 0, 'no', 'yes')
 
-        if self.status_check(status, 6, 1):
+        if status.reduce_z_done:
             raise ReduceZError(_("readZ is already emitted"))
 
         # FIXME: I am not sure we should be doing this here. This method
@@ -260,14 +364,13 @@ class FS345(SerialBase):
 
     def has_pending_reduce(self, status=None):
         if not status:
-            status = self._get_status()
-        return self.status_check(status, 2, 1)
+            status = self.get_status()
+        return status.pending_reduce_z
 
     def needs_read_x(self, status=None):
         if not status:
-            status = self._get_status()
-
-        return not self.status_check(status, 6, 2)
+            status = self.get_status()
+        return status.needs_read_x
 
     # Error handling
 
@@ -358,11 +461,11 @@ class FS345(SerialBase):
 
     # High level commands
     def _verify_coupon_open(self):
-        if not self.status_check(self._get_status(), 4, 2):
+        if not self._is_open(self.get_status()):
             raise CouponNotOpenError(_("Coupon is not open"))
 
     def _is_open(self, status):
-        return self.status_check(status, 4, 2)
+        return status.coupon_open
 
     # Helper commands
 
@@ -389,25 +492,27 @@ class FS345(SerialBase):
         self.send_command(CMD_OPEN_VOUCHER, data)
 
     def _configure_taxes(self):
-        self.send_command(CMD_CONFIGURE_TAXES, '1800')
-        self.send_command(CMD_CONFIGURE_TAXES, '1500')
-        self.send_command(CMD_CONFIGURE_TAXES, '2500')
-        self.send_command(CMD_CONFIGURE_TAXES, '0800')
-        self.send_command(CMD_CONFIGURE_TAXES, '0500')
-        self.send_command(CMD_CONFIGURE_TAXES, '0327')
-        self.send_command(CMD_CONFIGURE_TAXES, '0592')
-        self.send_command(CMD_CONFIGURE_TAXES, 'S0200')
-        self.send_command(CMD_CONFIGURE_TAXES, 'S0300')
-        self.send_command(CMD_CONFIGURE_TAXES, 'S0400')
+        provision(self.get_provisioning_tables(), dict(taxes=[
+            (Decimal('18.00'), False),
+            (Decimal('15.00'), False),
+            (Decimal('25.00'), False),
+            (Decimal('8.00'), False),
+            (Decimal('5.00'), False),
+            (Decimal('3.27'), False),
+            (Decimal('5.92'), False),
+            (Decimal('2.00'), True),
+            (Decimal('3.00'), True),
+            (Decimal('4.00'), True)]))
 
     def _configure_payment_methods(self):
-        self.send_command(CMD_DESCRIBE_MESSAGES, 'PGXADinheiro         ')
-        self.send_command(CMD_DESCRIBE_MESSAGES, 'PGXBCheque           ')
-        self.send_command(CMD_DESCRIBE_MESSAGES, 'PGXCBoleto           ')
-        self.send_command(CMD_DESCRIBE_MESSAGES, 'PGVDCartao Credito   ')
-        self.send_command(CMD_DESCRIBE_MESSAGES, 'PGVECartao Debito    ')
-        self.send_command(CMD_DESCRIBE_MESSAGES, 'PGVFFinanceira       ')
-        self.send_command(CMD_DESCRIBE_MESSAGES, 'PGVGVale Compra      ')
+        provision(self.get_provisioning_tables(), dict(payment_methods=[
+            (u'Dinheiro', False),
+            (u'Cheque', False),
+            (u'Boleto', False),
+            (u'Cartao Credito', True),
+            (u'Cartao Debito', True),
+            (u'Financeira', True),
+            (u'Vale Compra', True)]))
 
     def _configure_bound_receipts(self):
         self.send_command(CMD_DESCRIBE_NON_FISCAL_RECEIPT, 'VCartao Credito       ')
@@ -535,7 +640,7 @@ class FS345(SerialBase):
         self.summarize()
 
     def close_till(self, previous_day=False):
-        status = self._get_status()
+        status = self.get_status()
         if self._is_open(status):
             self.send_command(CMD_CANCEL_COUPON)
 
@@ -610,18 +715,31 @@ class FS345(SerialBase):
                                                       end.strftime('%d%m%y')))
 
     def _till_read_memory_to_serial(self, start, end):
+        ret = self._read_memory_to_serial(start, end)
+        return (ret, u''.join(self._iter_lines()))
+
+    def _read_memory_to_serial(self, start, end):
         # Page 39
-        ret = self.send_command(CMD_READ_MEMORY, 's%s%s' % (start.strftime('%d%m%y'),
-                                                            end.strftime('%d%m%y')))
-        data = ''
-        while True:
-            line = self.readline()
-            if line[-1] == '\xff':
-                break
-            data += line
+        return self.send_command(CMD_READ_MEMORY, 's%s%s' % (
+            start.strftime('%d%m%y'), end.strftime('%d%m%y')))
 
-        data = unicode(data, 'cp860')
-        return (ret, data)
+    def _iter_lines(self):
+        # The last line of the report ends with 0xff
+        line = self.readline()
+        try:
+            while line[-1] != '\xff':
+                yield unicode(line, 'cp860')
+                line = self.readline()
+        except GeneratorExit:
+            # Stopped early, the rest is dropped so that the next command
+            # does not get it as its reply
+            while line[-1] != '\xff':
+                line = self.readline()
+            raise
+
+    def till_iter_memory(self, start, end):
+        self._read_memory_to_serial(start, end)
+        return self._iter_lines()
 
     def till_read_memory_by_reductions(self, start, end):
         # Page 39
@@ -647,6 +765,10 @@ class FS345(SerialBase):
     def get_constants(self):
         return self._consts
 
+    def get_provisioning_tables(self):
+        return dict(taxes=_TaxTable(self),
+                    payment_methods=_PaymentMethodTable(self))
+
     def query_status(self):
         return CMD_STATUS
 
@@ -34,6 +34,7 @@ import time
 from zope.interface import implements
 
 from stoqdrivers.serialbase import SerialBase
+from stoqdrivers.stats import instrumented
 from stoqdrivers.interfaces import (IChequePrinter,
                                     ICouponPrinter)
 from stoqdrivers.exceptions import (DriverError, PendingReduceZ, PendingReadX,
@@ -41,7 +42,7 @@ from stoqdrivers.exceptions import (DriverError, PendingReduceZ, PendingReadX,
                                     CommandParametersError, ReduceZError,
                                     HardwareFailure, OutofPaperError,
                                     CouponNotOpenError, CancelItemError,
-                                    CouponOpenError)
+                                    CouponOpenError, InvalidReply)
 from stoqdrivers.enum import PaymentMethodType, TaxType, UnitType
 from stoqdrivers.printers.cheque import (BaseChequePrinter,
                                          BankConfiguration)
@@ -55,6 +56,9 @@ ACK = 0x06
 CR = 0x0D
 SUB = 0x1A
 
+# How many times a broken package is asked again before giving up
+MAX_RETRANSMISSIONS = 5
+
 _ = stoqdrivers_gettext
 
 #
@@ -270,6 +274,11 @@ class EP375(SerialBase, BaseChequePrinter):
 
     CMD_PREFIX = '\xfe'
 
+    # The printer keeps DSR off while it is busy or powered off
+    MODEM_STATUS_LINES = True
+    # Seconds to wait for the printer to set DSR before a command
+    DSR_TIMEOUT = 30
+
     #
     # IChequePrinter commands specification
     #
@@ -322,63 +331,64 @@ class EP375(SerialBase, BaseChequePrinter):
         self._item_counter += 1
         return self._item_counter
 
-    def _unpack(self, package):
-        if package[0] != EP375.CMD_PREFIX:
-            raise ValueError("Received inconsistent data")
+    def _get_params_size(self, package):
+        # Returns the size of the parameters of the package, or -1 if it
+        # is broken. Package format:
+        #     STX|CMD_COUNTER|CMD_ID|PARAMS_SZ|[PARAMS]|CHECKSUM
+        # so the minimum package size is 5 bytes.
+        if len(package) < 5 or package[0] != EP375.CMD_PREFIX:
+            return -1
         n_params = ord(package[3])
-        params = package[4:4 + n_params]
-        if len(params) != n_params:
-            raise ValueError("Received inconsistent data")
-        return params
-
-    def _is_valid_package(self, package):
-        # minimum package size:
-        #     STX|CMD_COUNTER|CMD_ID|PARAMS_SZ|CHECKSUM => 5 bytes
-        if len(package) < 5:
-            return False
-        try:
-            params = self._unpack(package)
-        except ValueError:
-            return False
-        cmdid = package[2]
-        checksum = ord(package[4 + len(params)])
-        new_checksum = ord(self._get_packed(cmdid, params)[-1])
-        return new_checksum == checksum
+        end = 4 + n_params
+        if len(package) <= end:
+            return -1
+        # The checksum goes from CMD_ID to the last byte of PARAMS
+        checksum = sum(bytearray(buffer(package, 2, end - 2))) & 0xff
+        if checksum != ord(package[end]):
+            return -1
+        return n_params
 
     def _get_and_parse_error(self):
         self._get_status().parse_error()
 
     def _parse_reply(self, reply):
-        result = ""
-        firstbyte = ord(reply[0])
-        # When ACK+CR is received the command wasn't executed.  In this
-        # case, we need call the printer status and manage the reason.
-        if firstbyte == ACK:
-            return self._get_and_parse_error()
-        # When EOT is received, no reply is required (the printer will
-        # send us nothing)
-        elif firstbyte == EOT:
-            return ""
-        # When BS is received, the printer will send data yet, so we need
-        # only executed the loop below
-        elif firstbyte == BS:
-            pass
-        # Hmmm, if a broken package was sent we need manage this sending
-        # ACK to the printer ("hey printer, you give me a broken package")
-        # and so we need append the new reply in the current one and call
-        # recursively this method.
-        elif not self._is_valid_package(reply):
-            self.write(chr(ACK))
-            return self._parse_reply(reply + self.readline())
-        else:
-            result = self._unpack(reply)
+        # A reply is made of lines, each one with a package or a control
+        # byte, the last one ending with SUB. The parameters of all the
+        # packages are joined once in the end. Each broken package is
+        # asked again at most MAX_RETRANSMISSIONS times.
+        params = []
+        retransmissions = 0
         while True:
-            lastbyte = ord(reply[-1])
-            if lastbyte == SUB:
+            firstbyte = ord(reply[0])
+            # When ACK+CR is received the command wasn't executed. In this
+            # case, we need call the printer status and manage the reason.
+            if firstbyte == ACK:
+                return self._get_and_parse_error()
+            # When EOT is received, no reply is required (the printer will
+            # send us nothing)
+            elif firstbyte == EOT:
+                break
+            # When BS is received, the printer will send data yet, so we
+            # only need to check if this is the last line
+            elif firstbyte != BS:
+                n_params = self._get_params_size(reply)
+                # If a broken package was sent we need to send ACK to the
+                # printer ("hey printer, you give me a broken package") and
+                # append the next line to the current one.
+                if n_params == -1:
+                    retransmissions += 1
+                    if retransmissions > MAX_RETRANSMISSIONS:
+                        raise InvalidReply(
+                            _("Received a broken package from the printer"))
+                    self.write(chr(ACK))
+                    reply += self.readline()
+                    continue
+                params.append(reply[4:4 + n_params])
+                retransmissions = 0
+            if ord(reply[-1]) == SUB:
                 break
             reply = self.readline()
-            return result + self._parse_reply(reply)
-        return result
+        return ''.join(params)
 
     def _get_coupon_remaining_value(self):
         #
@@ -409,8 +419,8 @@ class EP375(SerialBase, BaseChequePrinter):
     #
 
     def writeline(self, data):
-        while not self._port.getDSR():
-            pass
+        if not self._port.waitDSR(self.DSR_TIMEOUT):
+            raise self.get_timeout_error()
         return SerialBase.writeline(self, data)
 
     def readline(self):
@@ -447,6 +457,7 @@ class EP375(SerialBase, BaseChequePrinter):
                               data, checksum)
         return package
 
+    @instrumented()
     def _send_command(self, command, *params):
         reply = self.writeline(self._get_packed(command, *params))
         result = self._parse_reply(reply)
@@ -457,9 +468,15 @@ class EP375(SerialBase, BaseChequePrinter):
         result = self._send_command(self.CMD_GET_STATUS)
         return EP375Status(result)
 
+    def _probe(self):
+        self._get_status()
+
     #
     # ICouponPrinter implementation
     #
+    def setup(self):
+        pass
+
     def coupon_identify_customer(self, customer, address, document):
         # The printer Dataregis 375-EP doesn't supports customer
         # identification
@@ -36,7 +36,9 @@ from kiwi.log import Logger
 from kiwi.python import Settable
 from zope.interface import implements
 
+from stoqdrivers import wirelog
 from stoqdrivers.serialbase import SerialBase
+from stoqdrivers.stats import instrumented
 from stoqdrivers.interfaces import ICouponPrinter
 from stoqdrivers.exceptions import (DriverError, PrinterError, CommandError,
                                     CommandParametersError, OutofPaperError,
@@ -125,7 +127,8 @@ class Reply(object):
         checksum = string[-4:]
         self.string = string[:-4]
 
-        log.debug('reply %s' % repr(string))
+        if wirelog.is_enabled(log):
+            log.debug('reply %s', wirelog.frame(string))
         cs = '%04X' % sum([ord(i) for i in self.string])
         if cs != checksum:
             raise DriverError('Erro de checksum')
@@ -168,7 +171,7 @@ class Reply(object):
         #for f in self.fields: print f
 
     def check_error(self):
-        log.debug("reply_status %s" % self.reply_status)
+        log.debug("reply_status %s", self.reply_status)
         error_code = self.reply_status
         # Success, do nothing
         if error_code == '0000':
@@ -247,7 +250,7 @@ class FBII(SerialBase):
     #
 
     def _get_next_command_id(self):
-        if self._command_id == 256:
+        if self._command_id == 0xff:
             self._command_id = FIRST_COMMAND_ID - 1
 
         self._command_id += 1
@@ -276,8 +279,7 @@ class FBII(SerialBase):
 
         while True:
             if timeouts > RETRIES_BEFORE_TIMEOUT:
-                raise DriverError(_("Timeout communicating with fiscal "
-                                    "printer"))
+                raise self.get_timeout_error()
 
             c = self.read(1)
             if len(c) != 1:
@@ -287,7 +289,7 @@ class FBII(SerialBase):
             # STX is always the first char in the reply. Ignore garbage
             # until STX is received.
             if len(reply) == 0 and c != STX:
-                log.info('ignoring garbage in reply: %r' % c)
+                log.info('ignoring garbage in reply: %r', c)
                 continue
 
             reply += c
@@ -296,10 +298,12 @@ class FBII(SerialBase):
                 break
 
         reply += self.read(4)
-        log.debug("<<< %s" % repr(reply))
+        if wirelog.is_enabled(log):
+            log.debug("<<< %s", wirelog.frame(reply))
 
         return Reply(reply, self._command_id)
 
+    @instrumented()
     def _send_command(self, command, extension='0000', *args):
         cmd = self._get_package(command, extension, args)
         #log.debug("> %s" % repr(cmd))
@@ -308,8 +312,7 @@ class FBII(SerialBase):
         # Printer should reply with an ACK imediataly
         ack = self.read(1)
         if not ack:
-            raise DriverError(_("Timeout communicating with fiscal "
-                                "printer"))
+            raise self.get_timeout_error()
         assert ack == ACK, repr(ack)
 
         reply = self._read_reply()
@@ -748,6 +751,9 @@ class FBII(SerialBase):
         reply = self._send_command('0001')
         return reply.check_printer_status()
 
+    def _probe(self):
+        self._send_command('0001')
+
     def _get_coupon_status(self):
         # Last four digits of fiscal status, show coupon status
         return self._get_fiscal_status()[12:16]
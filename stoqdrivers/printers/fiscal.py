@@ -25,6 +25,7 @@
 ##              Henrique Romano  <henrique@async.com.br>
 ##
 
+import codecs
 import datetime
 from decimal import Decimal
 
@@ -33,11 +34,16 @@ from kiwi.currency import currency
 from kiwi.log import Logger
 
 from stoqdrivers.exceptions import (CloseCouponError, PaymentAdditionError,
-                                    AlreadyTotalized, InvalidValue)
+                                    AlreadyTotalized, DriverError,
+                                    InvalidValue)
+from stoqdrivers import couponjournal, wirelog
 from stoqdrivers.enum import PaymentMethodType, TaxType, UnitType
 from stoqdrivers.printers.base import BasePrinter
 from stoqdrivers.printers.capabilities import capcheck
-from stoqdrivers.utils import encode_text
+from stoqdrivers.journal import sync
+from stoqdrivers.provisioning import provision
+from stoqdrivers.tracing import traced, traced_iter
+from stoqdrivers.utils import encode_text, monotonic
 from stoqdrivers.translation import stoqdrivers_gettext
 
 _ = stoqdrivers_gettext
@@ -80,48 +86,193 @@ class payment_method(number):
 class FiscalPrinter(BasePrinter):
     def __init__(self, brand=None, model=None, device=None, config_file=None,
                  *args, **kwargs):
+        self._capabilities = None
+        self._tracer = None
+        self._ledger = None
+        self._coupon_journal = None
         BasePrinter.__init__(self, brand, model, device, config_file, *args,
                              **kwargs)
         self._has_been_totalized = False
         self.payments_total_value = Decimal("0.0")
         self.totalized_value = Decimal("0.0")
+        self._charset = self._driver_class.coupon_printer_charset
+
+    def _driver_connected(self):
+        if self._tracer is not None:
+            self._attach_tracer()
         self._capabilities = self._driver.get_capabilities()
-        self._charset = self._driver.coupon_printer_charset
         self.setup()
 
     def get_capabilities(self):
+        self.connect()
         return self._capabilities
 
     def _format_text(self, text):
-        return encode_text(text, self._charset)
+        if self._tracer is None:
+            return encode_text(text, self._charset)
+        start = monotonic()
+        text = encode_text(text, self._charset)
+        self._tracer.add_phase('encode', start)
+        return text
+
+    def enable_tracing(self, tracer):
+        """ Starts tracing the calls to the printer, see L{stoqdrivers.tracing}
+
+        The tracer is set as the statistics of the driver, wrapping the
+        ones that were enabled before. On a printer which is not connected
+        yet this happens once it connects.
+
+        @param tracer: a L{stoqdrivers.tracing.Tracer} or None to stop
+        """
+        connected = self.is_connected()
+        if self._tracer is not None and connected:
+            self.enable_stats(self._tracer.stats)
+        self._tracer = tracer
+        if tracer is not None and connected:
+            self._attach_tracer()
+
+    def _attach_tracer(self):
+        tracer = self._tracer
+        tracer.stats = self.get_stats()
+        if tracer.baudrate is None:
+            get_baudrate = getattr(self.get_port(), 'getBaudrate', None)
+            if get_baudrate is not None:
+                tracer.baudrate = get_baudrate()
+        self.enable_stats(tracer)
+
+    def get_tracer(self):
+        return self._tracer
+
+    def set_ledger(self, ledger):
+        """ Starts recording the sales in a local ledger, see
+        L{stoqdrivers.ledger}
+
+        @param ledger: a L{stoqdrivers.ledger.SalesLedger} or None to stop
+        """
+        self._ledger = ledger
+
+    def get_ledger(self):
+        return self._ledger
+
+    def set_coupon_journal(self, journal):
+        """ Starts recording the steps of the coupons, so that they can be
+        resumed after a crash, see L{resume_coupon}
+
+        @param journal: a L{stoqdrivers.couponjournal.CouponJournal} or
+          None to stop
+        """
+        self._coupon_journal = journal
+
+    def get_coupon_journal(self):
+        return self._coupon_journal
+
+    @traced
+    def resume_coupon(self):
+        """ Continues the coupon which was being emitted when the process
+        stopped, as recorded by the coupon journal. The journal is checked
+        against the printer with a status query and, if an item was being
+        added, a read of the last item id.
+
+        @returns: the operations done in the coupon, as returned by
+          L{stoqdrivers.couponjournal.CouponJournal.get_operations}, or None
+          if there is no coupon to resume
+        """
+        log.info('resume_coupon()')
+        journal = self._coupon_journal
+        if journal is None:
+            return None
+        operations = journal.get_operations()
+        if not operations:
+            return None
+        if not self._driver.has_open_coupon():
+            # It was closed or cancelled before the journal was cleared
+            journal.clear()
+            return None
+
+        if operations[-1][0] == couponjournal.ADDING:
+            get_last_item_id = getattr(self._driver, 'get_last_item_id', None)
+            if get_last_item_id is None:
+                raise DriverError(
+                    _("%s can not tell if the last item was added") %
+                    self._driver.model_name)
+            adding = operations.pop()
+            item_ids = [op[1] for op in operations
+                        if op[0] == couponjournal.ITEM]
+            item_id = get_last_item_id()
+            if item_id > max(item_ids or [0]):
+                journal.add_item(item_id)
+                operations.append((couponjournal.ITEM, item_id) + adding[1:])
+
+        totals = [op[1] for op in operations
+                  if op[0] == couponjournal.TOTALIZE]
+        self._has_been_totalized = bool(totals)
+        self.totalized_value = totals and totals[-1] or Decimal("0.0")
+        self.payments_total_value = sum(
+            [op[2] for op in operations if op[0] == couponjournal.PAYMENT],
+            Decimal("0.0"))
+        wirelog.start_coupon()
+        return operations
+
+    def get_busy_until(self):
+        """ Returns the monotonic time the printer is expected to accept
+        commands again when it is doing internal work, like compacting its
+        memory, or None if it is not known to be busy
+        """
+        get_busy_until = getattr(self._driver, 'get_busy_until', None)
+        if get_busy_until is None:
+            return None
+        return get_busy_until()
+
+    def _check_health(self):
+        # Long operations wait for all the retries of the driver before
+        # failing, so when the printer timed out lately check with a
+        # cheap status query if it is back first.
+        breaker = self.get_breaker()
+        if breaker is not None and breaker.get_failures():
+            self.check_health()
 
     def setup(self):
         log.info('setup()')
         self._driver.setup()
 
+    @traced
     @capcheck(basestring, basestring, basestring)
     def identify_customer(self, customer_name, customer_address, customer_id):
         log.info('identify_customer(customer_name=%r, '
-                 'customer_address=%r, customer_id=%r)' % (
-                     customer_name, customer_address, customer_id))
-
-        self._driver.coupon_identify_customer(
-            self._format_text(customer_name),
-            self._format_text(customer_address),
-            self._format_text(customer_id))
+                 'customer_address=%r, customer_id=%r)',
+                 wirelog.redacted(customer_name),
+                 wirelog.redacted(customer_address),
+                 wirelog.redacted(customer_id))
+
+        wirelog.start_coupon()
+        values = [self._format_text(customer_name),
+                  self._format_text(customer_address),
+                  self._format_text(customer_id)]
+        for value in values:
+            wirelog.add_secret(value)
+        self._driver.coupon_identify_customer(*values)
 
     def coupon_is_customer_identified(self):
         return self._driver.coupon_is_customer_identified()
 
+    @traced
     def has_open_coupon(self):
         log.info('has_open_coupon()')
         return self._driver.has_open_coupon()
 
+    @traced
     def open(self):
         log.info('coupon_open()')
+        wirelog.start_coupon()
 
-        return self._driver.coupon_open()
+        retval = self._driver.coupon_open()
+        if self._ledger is not None:
+            self._ledger.open_coupon()
+        if self._coupon_journal is not None:
+            self._coupon_journal.open_coupon()
+        return retval
 
+    @traced
     @capcheck(basestring, basestring, Decimal, str, Decimal, unit,
               Decimal, Decimal, basestring)
     def add_item(self, item_code, item_description, item_price, taxcode,
@@ -130,9 +281,9 @@ class FiscalPrinter(BasePrinter):
                  unit_desc=""):
         log.info("add_item(code=%r, description=%r, price=%r, "
                  "taxcode=%r, quantity=%r, unit=%r, discount=%r, "
-                 "surcharge=%r, unit_desc=%r)" % (
-                     item_code, item_description, item_price, taxcode,
-                     items_quantity, unit, discount, surcharge, unit_desc))
+                 "surcharge=%r, unit_desc=%r)",
+                 item_code, item_description, item_price, taxcode,
+                 items_quantity, unit, discount, surcharge, unit_desc)
 
         if self._has_been_totalized:
             raise AlreadyTotalized("the coupon is already totalized, you "
@@ -155,16 +306,28 @@ class FiscalPrinter(BasePrinter):
         if discount < 0:
             raise ValueError('Discount cannot be negative')
 
-        return self._driver.coupon_add_item(
+        if self._coupon_journal is not None:
+            self._coupon_journal.adding_item(
+                item_code, item_description, item_price, taxcode,
+                items_quantity, unit, discount, surcharge, unit_desc)
+        item_id = self._driver.coupon_add_item(
             self._format_text(item_code), self._format_text(item_description),
             item_price, taxcode, items_quantity, unit, discount, surcharge,
             unit_desc=self._format_text(unit_desc))
-
+        if self._ledger is not None:
+            self._ledger.add_item(item_id, item_code, item_description,
+                                  item_price, taxcode, items_quantity,
+                                  discount, surcharge)
+        if self._coupon_journal is not None:
+            self._coupon_journal.add_item(item_id)
+        return item_id
+
+    @traced
     @capcheck(Decimal, Decimal, taxcode)
     def totalize(self, discount=currency(0), surcharge=currency(0),
                  taxcode=TaxType.NONE):
-        log.info('totalize(discount=%r, surcharge=%r, taxcode=%r)' % (
-            discount, surcharge, taxcode))
+        log.info('totalize(discount=%r, surcharge=%r, taxcode=%r)',
+                 discount, surcharge, taxcode)
 
         if discount and surcharge:
             raise TypeError("discount and surcharge can not be used together")
@@ -174,12 +337,17 @@ class FiscalPrinter(BasePrinter):
         result = self._driver.coupon_totalize(discount, surcharge, taxcode)
         self._has_been_totalized = True
         self.totalized_value = result
+        if self._ledger is not None:
+            self._ledger.totalize(discount, surcharge, result)
+        if self._coupon_journal is not None:
+            self._coupon_journal.totalize(result)
         return result
 
+    @traced
     @capcheck(basestring, Decimal, basestring)
     def add_payment(self, payment_method, payment_value, description=''):
-        log.info("add_payment(method=%r, value=%r, description=%r)" % (
-            payment_method, payment_value, description))
+        log.info("add_payment(method=%r, value=%r, description=%r)",
+                 payment_method, payment_value, description)
 
         if not self._has_been_totalized:
             raise PaymentAdditionError(_("You must totalize the coupon "
@@ -188,31 +356,51 @@ class FiscalPrinter(BasePrinter):
             payment_method, payment_value,
             self._format_text(description))
         self.payments_total_value += payment_value
+        if self._ledger is not None:
+            self._ledger.add_payment(payment_method, payment_value)
+        if self._coupon_journal is not None:
+            self._coupon_journal.add_payment(payment_method, payment_value)
         return result
 
+    @traced
     def cancel(self):
         log.info('coupon_cancel()')
         retval = self._driver.coupon_cancel()
+        if self._ledger is not None:
+            self._ledger.cancel_coupon()
+        if self._coupon_journal is not None:
+            self._coupon_journal.clear()
+        wirelog.end_coupon()
         self._has_been_totalized = False
         self.payments_total_value = Decimal("0.0")
         self.totalized_value = Decimal("0.0")
         return retval
 
+    @traced
     def cancel_last_coupon(self):
         """Cancel the last non fiscal coupon or the last sale."""
         log.info('cancel_last_coupon()')
         self._driver.cancel_last_coupon()
+        if self._ledger is not None:
+            self._ledger.cancel_last_coupon()
 
+    @traced
     @capcheck(int)
     def cancel_item(self, item_id):
-        log.info('coupon_cancel_item(item_id=%r)' % (item_id,))
+        log.info('coupon_cancel_item(item_id=%r)', item_id)
 
-        return self._driver.coupon_cancel_item(item_id)
+        retval = self._driver.coupon_cancel_item(item_id)
+        if self._ledger is not None:
+            self._ledger.cancel_item(item_id)
+        if self._coupon_journal is not None:
+            self._coupon_journal.cancel_item(item_id)
+        return retval
 
+    @traced
     @capcheck(basestring)
     def close(self, promotional_message=''):
-        log.info('coupon_close(promotional_message=%r)' % (
-            promotional_message))
+        log.info('coupon_close(promotional_message=%r)',
+                 promotional_message)
 
         if not self._has_been_totalized:
             raise CloseCouponError(_("You must totalize the coupon before "
@@ -228,95 +416,180 @@ class FiscalPrinter(BasePrinter):
                                       self.totalized_value))
         res = self._driver.coupon_close(
             self._format_text(promotional_message))
+        if self._ledger is not None:
+            self._ledger.close_coupon(res)
+        if self._coupon_journal is not None:
+            self._coupon_journal.clear()
+        wirelog.end_coupon()
         self._has_been_totalized = False
         self.payments_total_value = Decimal("0.0")
         self.totalized_value = Decimal("0.0")
         return res
 
+    @traced
     def summarize(self):
         log.info('summarize()')
+        self._check_health()
 
         return self._driver.summarize()
 
     def has_pending_reduce(self):
         pending = self._driver.has_pending_reduce()
-        log.info('has_pending_reduce() = %s' % pending)
+        log.info('has_pending_reduce() = %s', pending)
         return pending
 
+    @traced
     def open_till(self):
         log.info('open_till()')
         return self._driver.open_till()
 
+    @traced
     def close_till(self, previous_day=False):
-        log.info('close_till(previous_day=%r)' % (previous_day,))
+        log.info('close_till(previous_day=%r)', previous_day)
+        self._check_health()
 
         return self._driver.close_till(previous_day)
 
+    @traced
     @capcheck(Decimal)
     def till_add_cash(self, add_cash_value):
-        log.info('till_add_cash(add_cash_value=%r)' % (add_cash_value,))
+        log.info('till_add_cash(add_cash_value=%r)', add_cash_value)
 
-        return self._driver.till_add_cash(add_cash_value)
+        retval = self._driver.till_add_cash(add_cash_value)
+        if self._ledger is not None:
+            self._ledger.add_cash(add_cash_value)
+        return retval
 
+    @traced
     @capcheck(Decimal)
     def till_remove_cash(self, remove_cash_value):
-        log.info('till_remove_cash(remove_cash_value=%r)' % (
-            remove_cash_value,))
+        log.info('till_remove_cash(remove_cash_value=%r)',
+                 remove_cash_value)
 
-        return self._driver.till_remove_cash(remove_cash_value)
+        retval = self._driver.till_remove_cash(remove_cash_value)
+        if self._ledger is not None:
+            self._ledger.add_cash(-remove_cash_value)
+        return retval
 
+    @traced
     @capcheck(datetime.date, datetime.date)
     def till_read_memory(self, start, end):
         assert start <= end <= datetime.date.today(), (
             "start must be less then end and both must be less today")
-        log.info('till_read_memory(start=%r, end=%r)' % (
-            start, end))
+        log.info('till_read_memory(start=%r, end=%r)', start, end)
+        self._check_health()
 
         return self._driver.till_read_memory(start, end)
 
+    @traced
     @capcheck(datetime.date, datetime.date)
     def till_read_memory_to_serial(self, start, end):
         assert start <= end <= datetime.date.today(), (
             "start must be less then end and both must be less today")
-        log.info('till_read_memory(start=%r, end=%r)' % (
-            start, end))
+        log.info('till_read_memory(start=%r, end=%r)', start, end)
+        self._check_health()
 
         return self._driver.till_read_memory_to_serial(start, end)
 
+    @traced_iter
+    @capcheck(datetime.date, datetime.date, object)
+    def till_iter_memory(self, start, end, progress=None):
+        """ Reads the fiscal memory between two dates through the serial
+        port. The text is yielded as it arrives and the printer is only read
+        as fast as it is consumed, so the memory used does not depend on the
+        period.
+
+        Closing the iterator before the end reads and drops the rest of
+        the report.
+
+        @param progress: if given, called after each line with the number
+          of characters read so far
+        @returns: an iterator of unicode strings, which joined are the
+          whole report
+        """
+        assert start <= end <= datetime.date.today(), (
+            "start must be less then end and both must be less today")
+        log.info('till_iter_memory(start=%r, end=%r)', start, end)
+        iter_memory = getattr(self._driver, 'till_iter_memory', None)
+        if iter_memory is None:
+            raise NotImplementedError(
+                _("%s can not send its memory through the serial port") %
+                self._driver.model_name)
+        return self._iter_memory(iter_memory, start, end, progress)
+
+    def _iter_memory(self, iter_memory, start, end, progress):
+        self._check_health()
+        read = 0
+        lines = iter_memory(start, end)
+        try:
+            for line in lines:
+                if progress is not None:
+                    read += len(line)
+                    progress(read)
+                yield line
+        finally:
+            lines.close()
+
+    @traced
+    def till_read_memory_to_file(self, start, end, filename, progress=None):
+        """ Like L{till_iter_memory}, but writes the report to a file,
+        encoded in utf-8, as it is read.
+
+        @returns: the number of characters written
+        """
+        written = 0
+        fp = codecs.open(filename, 'w', 'utf-8')
+        try:
+            for line in self.till_iter_memory(start, end, progress):
+                fp.write(line)
+                written += len(line)
+        finally:
+            fp.close()
+        return written
+
+    @traced
     @capcheck(int, int)
     def till_read_memory_by_reductions(self, start, end):
         assert end >= start > 0, ("start must be less then end "
                                   "and both must be positive")
-        log.info('till_read_memory_by_reductions(start=%r, end=%r)' % (
-            start, end))
+        log.info('till_read_memory_by_reductions(start=%r, end=%r)',
+                 start, end)
+        self._check_health()
 
         self._driver.till_read_memory_by_reductions(start, end)
 
+    @traced
     def gerencial_report_open(self):
         log.info('gerencial_report_open')
         return self._driver.gerencial_report_open()
 
+    @traced
     def gerencial_report_print(self, text):
-        log.info('gerencial_report_print(text=%s)' % text)
+        log.info('gerencial_report_print(text=%s)', text)
         return self._driver.gerencial_report_print(text)
 
+    @traced
     def gerencial_report_close(self):
         log.info('gerencial_report_close')
         return self._driver.gerencial_report_close()
 
+    @traced
     def payment_receipt_open(self, identifier, coo, method, value):
-        log.info('payment_receipt_open(identifier=%s, coo=%s, method=%s, value=%s)'
-                 % (identifier, coo, method, value))
+        log.info('payment_receipt_open(identifier=%s, coo=%s, method=%s, '
+                 'value=%s)', identifier, coo, method, value)
         return self._driver.payment_receipt_open(identifier, coo, method, value)
 
+    @traced
     def payment_receipt_print(self, text):
-        log.info('payment_receipt_print(text=%s)' % text)
+        log.info('payment_receipt_print(text=%s)', text)
         return self._driver.payment_receipt_print(text)
 
+    @traced
     def payment_receipt_close(self):
         log.info('payment_receipt_close()')
         return self._driver.payment_receipt_close()
 
+    @traced
     def payment_receipt_print_duplicate(self):
         log.info('payment_receipt_print_duplicate()')
         return self._driver.payment_receipt_print_duplicate()
@@ -332,7 +605,7 @@ class FiscalPrinter(BasePrinter):
         return self._driver.query_status()
 
     def status_reply_complete(self, reply):
-        log.info('status_reply_complete(%s)' % (reply,))
+        log.info('status_reply_complete(%s)', reply)
         return self._driver.status_reply_complete(reply)
 
     def get_tax_constants(self):
@@ -345,10 +618,53 @@ class FiscalPrinter(BasePrinter):
 
         return self._driver.get_payment_constants()
 
+    @traced
+    def provision(self, taxes=None, payment_methods=None):
+        """ Makes the tax and payment method tables of the printer equal
+        to the given ones, sending only the commands needed to change what
+        is different, see L{stoqdrivers.provisioning}
+
+        @param taxes: a list of (value, service) tuples, or None to leave
+          the taxes untouched
+        @param payment_methods: a list of (name, vinculated) tuples, or
+          None to leave the payment methods untouched
+        @returns: a list of (table name, action, slot, entry) tuples with
+          the changes that were made
+        """
+        log.info('provision(taxes=%r, payment_methods=%r)',
+                 taxes, payment_methods)
+        get_tables = getattr(self._driver, 'get_provisioning_tables', None)
+        if get_tables is None:
+            raise NotImplementedError(
+                _("%s can not be provisioned") % self._driver.model_name)
+        desired = {}
+        if taxes is not None:
+            desired['taxes'] = taxes
+        if payment_methods is not None:
+            desired['payment_methods'] = payment_methods
+        return provision(get_tables(), desired)
+
+    @traced
+    def sync_journal(self, index):
+        """ Adds to an index the invoices emitted since the printer was last
+        synced to it, see L{stoqdrivers.journal.sync}
+
+        @param index: a L{stoqdrivers.journal.InvoiceIndex}
+        @returns: the number of invoices added
+        """
+        log.info('sync_journal(index=%r)', index)
+        if getattr(self._driver, 'iter_invoices', None) is None:
+            raise NotImplementedError(
+                _("%s can not send its journal through the serial port") %
+                self._driver.model_name)
+        self._check_health()
+        return sync(self._driver, index)
+
     def get_payment_receipt_identifier(self, method):
-        log.info('get_payment_receipt_identifier(method=%s)' % method)
+        log.info('get_payment_receipt_identifier(method=%s)', method)
         return self._driver.get_payment_receipt_identifier(method)
 
+    @traced
     def get_ccf(self):
         """Fiscal Coupon Counter
 
@@ -359,6 +675,7 @@ class FiscalPrinter(BasePrinter):
 
         return self._driver.get_ccf()
 
+    @traced
     def get_coo(self):
         """Operation Order Counter
 
@@ -369,6 +686,7 @@ class FiscalPrinter(BasePrinter):
 
         return self._driver.get_coo()
 
+    @traced
     def get_gnf(self):
         """Nonfiscal Operation General Counter
 
@@ -379,6 +697,7 @@ class FiscalPrinter(BasePrinter):
 
         return self._driver.get_gnf()
 
+    @traced
     def get_crz(self):
         """Z Reduction Counter
 
@@ -389,8 +708,10 @@ class FiscalPrinter(BasePrinter):
 
         return self._driver.get_crz()
 
+    @traced
     def get_sintegra(self):
         log.info('get_sintegra()')
+        self._check_health()
 
         return self._driver.get_sintegra()
 
@@ -44,13 +44,16 @@ from stoqdrivers.exceptions import (DriverError, PendingReduceZ,
                                     CouponTotalizeError, PaymentAdditionError,
                                     CancelItemError, CouponOpenError,
                                     InvalidState, PendingReadX,
-                                    CloseCouponError, CouponNotOpenError)
+                                    CloseCouponError, CouponNotOpenError,
+                                    InvalidReply)
 from stoqdrivers.interfaces import ICouponPrinter, IChequePrinter
 from stoqdrivers.printers.capabilities import Capability
 from stoqdrivers.printers.cheque import BaseChequePrinter, BankConfiguration
 from stoqdrivers.printers.base import BaseDriverConstants
+from stoqdrivers.provisioning import Table, provision
 from stoqdrivers.translation import stoqdrivers_gettext
 from stoqdrivers.serialbase import SerialBase
+from stoqdrivers.stats import instrumented
 
 _ = stoqdrivers_gettext
 
@@ -109,12 +112,145 @@ class FiscNetConstants(BaseDriverConstants):
         #         PaymentMethodType.GIFT_CERTIFICATE: '5,
     }
 
-_RETVAL_TOKEN_RE = re.compile(r"^\s*([^=\s;]+)")
-_RETVAL_QUOTED_VALUE_RE = re.compile(r"^\s*=\s*\"([^\"\\]*(?:\\.[^\"\\]*)*)\"")
-_RETVAL_VALUE_RE = re.compile(r"^\s*=\s*([^\s;]*)")
+# A name, optionally followed by a quoted or an unquoted value
+_RETVAL_RE = re.compile(r"""\s*([^=\s;]+)
+                            (?:\s*=\s*(?:\"([^\"\\]*(?:\\.[^\"\\]*)*)\"
+                                      |([^\s;]*)))?""", re.VERBOSE)
 _RETVAL_ESCAPE_RE = re.compile(r"\\(.)")
 
 
+def _iter_return_values(text):
+    """ Scans the return values of a command, yielding a (name, value)
+    tuple for each one. Quoted values are unescaped and names without a
+    value get None.
+    """
+    match = _RETVAL_RE.match
+    pos = 0
+    end = len(text)
+    while pos < end:
+        m = match(text, pos)
+        if m is None:
+            raise AssertionError
+        name, quoted, value = m.groups()
+        if quoted is not None:
+            value = quoted
+            if '\\' in value:
+                value = _RETVAL_ESCAPE_RE.sub(r"\1", value)
+        yield name, value
+        pos = m.end()
+
+
+class _ReturnValues(dict):
+    """ The values returned by a command, kept as the printer sent them
+    and converted only when asked for
+    """
+
+    def get_int(self, name):
+        return int(self[name])
+
+    def get_decimal(self, name):
+        # "1.234,56" -> Decimal("1234.56")
+        value = self[name].replace('.', '')
+        return Decimal(value.replace(',', '.'))
+
+    def get_date(self, name):
+        value = self[name]
+        # This happens the first time we send a ReducaoZ after
+        # opening the printer and removing the jumper.
+        if value == '#00/00/0000#':
+            return datetime.date.today()
+        # "#29/03/2007#" -> datetime.date(2007, 3, 29)
+        d, m, y = map(int, value[1:-1].split('/'))
+        return datetime.date(y, m, d)
+
+    def get_text(self, name):
+        # '"string"' -> 'string'
+        return self[name].strip('"')
+
+    def get_bool(self, name):
+        return bool(int(self[name]))
+
+
+# The command, parameter and return value used to read each register type
+_REGISTER_COMMANDS = {
+    int: ('LeInteiro', 'NomeInteiro', 'ValorInteiro',
+          _ReturnValues.get_int),
+    Decimal: ('LeMoeda', 'NomeDadoMonetario', 'ValorMoeda',
+              _ReturnValues.get_decimal),
+    datetime.date: ('LeData', 'NomeData', 'ValorData',
+                    _ReturnValues.get_date),
+    str: ('LeTexto', 'NomeTexto', 'ValorTexto', _ReturnValues.get_text),
+    bool: ('LeIndicador', 'NomeIndicador', 'ValorNumericoIndicador',
+           _ReturnValues.get_bool),
+}
+
+
+class _TaxTable(Table):
+    size = 16
+    can_delete = True
+
+    def read(self):
+        retdicts = self.driver._send_commands(
+            [('LeAliquota', dict(CodAliquotaProgramavel=reg))
+             for reg in range(self.size)],
+            ignore=[8005])  # Aliquota nao carregada
+        taxes = {}
+        for reg, retdict in enumerate(retdicts):
+            if retdict is None:
+                continue
+            value = Decimal(retdict['PercentualAliquota'].replace(',', '.'))
+            taxes[reg] = (value, retdict['AliquotaICMS'] != 'Y')
+        return taxes
+
+    def write(self, slot, entry):
+        value, service = entry
+        self.driver._send_command(
+            'DefineAliquota',
+            CodAliquotaProgramavel=slot,
+            DescricaoAliquota='%2.2f%%' % value,
+            PercentualAliquota=value,
+            AliquotaICMS=not service)
+
+    def delete(self, slot):
+        self.driver._send_command('ExcluiAliquota',
+                                  CodAliquotaProgramavel=slot)
+
+
+class _PaymentMethodTable(Table):
+    size = 15
+    can_delete = True
+
+    def read(self):
+        retdicts = self.driver._send_commands(
+            [('LeMeioPagamento', dict(CodMeioPagamentoProgram=reg))
+             for reg in range(self.size)],
+            ignore=[8014])  # Meio de pagamento nao carregado
+        charset = self.driver.coupon_printer_charset
+        methods = {}
+        for reg, retdict in enumerate(retdicts):
+            if retdict is None:
+                continue
+            name = retdict.get_text('NomeMeioPagamento').decode(charset)
+            methods[reg] = (name, retdict.get('PermiteVinculado') == 'Y')
+        return methods
+
+    def write(self, slot, entry):
+        name, vinculated = entry
+        name = name.encode(self.driver.coupon_printer_charset)
+        self.driver._send_command(
+            'DefineMeioPagamento',
+            CodMeioPagamentoProgram=slot, DescricaoMeioPagamento=name,
+            NomeMeioPagamento=name, PermiteVinculado=vinculated)
+
+    def delete(self, slot):
+        self.driver._send_command('ExcluiMeioPagamento',
+                                  CodMeioPagamentoProgram=slot)
+
+
+# Commands sent by _send_commands() before waiting for the first reply
+PIPELINE_DEPTH = 8
+
+
 class FiscNetECF(SerialBase):
     implements(IChequePrinter, ICouponPrinter)
 
@@ -171,39 +307,9 @@ class FiscNetECF(SerialBase):
     # Helper methods
     #
     def _parse_return_value(self, text):
+        return _ReturnValues(_iter_return_values(text))
 
-        # Based on cookielib.split_header_words
-        def unmatched(match):
-            start, end = match.span(0)
-            return match.string[:start] + match.string[end:]
-
-        result = {}
-        while text:
-            m = _RETVAL_TOKEN_RE.search(text)
-            if m:
-                text = unmatched(m)
-                name = m.group(1)
-                m = _RETVAL_QUOTED_VALUE_RE.search(text)
-                if m:  # quoted value
-                    text = unmatched(m)
-                    value = m.group(1)
-                    value = _RETVAL_ESCAPE_RE.sub(r"\1", value)
-                else:
-                    m = _RETVAL_VALUE_RE.search(text)
-                    if m:  # unquoted value
-                        text = unmatched(m)
-                        value = m.group(1)
-                        value = value.rstrip()
-                    else:
-                        # no value, a lone token
-                        value = None
-                result[name] = value
-            else:
-                raise AssertionError
-
-        return result
-
-    def _send_command(self, command, **params):
+    def _format_command(self, command_id, command, params):
         # Page 38-39
         parameters = []
         for param, value in params.items():
@@ -221,9 +327,10 @@ class FiscNetECF(SerialBase):
 
             parameters.append('%s=%s' % (param, value))
 
-        reply = self.writeline("%d;%s;%s;" % (self._command_id,
-                                              command,
-                                              ' '.join(parameters)))
+        return "%d;%s;%s;" % (command_id, command, ' '.join(parameters))
+
+    def _parse_reply(self, reply):
+        # Returns a (command id, error code, return values) tuple
         if reply[0] != '{':
             # This happened once after the first command issued after
             # the power returned, it should probably be handled gracefully
@@ -235,7 +342,9 @@ class FiscNetECF(SerialBase):
             raise AssertionError
 
         retdict = self._parse_return_value(sections[2])
-        errorcode = int(sections[1])
+        return int(sections[0]), int(sections[1]), retdict
+
+    def _check_error(self, errorcode, retdict):
         if errorcode != 0:
             errordesc = retdict['Circunstancia']
             try:
@@ -244,61 +353,105 @@ class FiscNetECF(SerialBase):
                 raise DriverError(errordesc, errorcode)
             raise exception(errordesc, errorcode)
 
+    @instrumented()
+    def _send_command(self, command, **params):
+        reply = self.writeline(self._format_command(self._command_id,
+                                                    command, params))
+        command_id, errorcode, retdict = self._parse_reply(reply)
+        self._check_error(errorcode, retdict)
         return retdict
 
+    @instrumented(lambda *args, **kwargs: 'batch')
+    def _send_commands(self, commands, ignore=()):
+        """ Sends several commands without waiting for the reply of each
+        one before sending the next, at most PIPELINE_DEPTH at a time. The
+        replies are matched to the commands by their command id. When a
+        command fails no more commands are sent, and its error is raised
+        once the replies of the ones already sent are read.
+
+        @param commands: a list of (command, params) tuples, where params
+          is a dict with the parameters of the command
+        @param ignore: error codes which are not raised, the return values
+          of the commands failing with them are None
+        @returns: a list with the return values of each command
+        """
+        first_id = self._command_id + 1
+        retdicts = {}
+        error = unknown_id = None
+        sent = received = 0
+        while True:
+            while (error is None and unknown_id is None and
+                   sent < len(commands) and
+                   sent - received < PIPELINE_DEPTH):
+                command, params = commands[sent]
+                self.write(self.CMD_PREFIX +
+                           self._format_command(first_id + sent, command,
+                                                params) +
+                           self.CMD_SUFFIX)
+                sent += 1
+            if received == sent:
+                break
+            command_id, errorcode, retdict = self._parse_reply(
+                self.readline())
+            if not first_id <= command_id < first_id + sent:
+                # Not one of the replies in flight, which are still read
+                # before raising, so the next command gets its own one
+                if unknown_id is None:
+                    unknown_id = command_id
+                continue
+            if errorcode in ignore:
+                retdict = None
+            elif errorcode != 0 and error is None:
+                error = errorcode, retdict
+            retdicts[command_id] = retdict
+            received += 1
+
+        if unknown_id is not None:
+            raise InvalidReply(
+                _("Reply to an unknown command: %d") % unknown_id)
+        if error is not None:
+            self._check_error(*error)
+        return [retdicts[first_id + i] for i in range(len(commands))]
+
     def _read_register(self, name, regtype):
-        if regtype == int:
-            cmd = 'LeInteiro'
-            argname = 'NomeInteiro'
-            retname = 'ValorInteiro'
-        elif regtype == Decimal:
-            cmd = 'LeMoeda'
-            argname = 'NomeDadoMonetario'
-            retname = 'ValorMoeda'
-        elif regtype == datetime.date:
-            cmd = 'LeData'
-            argname = 'NomeData'
-            retname = 'ValorData'
-        elif regtype == str:
-            cmd = 'LeTexto'
-            argname = 'NomeTexto'
-            retname = 'ValorTexto'
-        elif regtype == bool:
-            cmd = 'LeIndicador'
-            argname = 'NomeIndicador'
-            retname = 'ValorNumericoIndicador'
-        else:
+        try:
+            cmd, argname, retname, get_value = _REGISTER_COMMANDS[regtype]
+        except KeyError:
             raise AssertionError
 
         retdict = self._send_command(cmd, **dict([(argname, name)]))
         assert retname in retdict
-        retval = retdict[retname]
-        if regtype == int:
-            return int(retval)
-        elif regtype == Decimal:
-            retval = retval.replace('.', '')
-            retval = retval.replace(',', '.')
-            return Decimal(retval)
-        elif regtype == datetime.date:
-            # This happens the first time we send a ReducaoZ after
-            # opening the printer and removing the jumper.
-            if retval == '#00/00/0000#':
-                return datetime.date.today()
-            else:
-                # "29/03/2007" -> datetime.date(2007, 3, 29)
-                d, m, y = map(int, retval[1:-1].split('/'))
-                return datetime.date(y, m, d)
-        elif regtype == str:
-            # '"string"' -> 'string'
-            return retval.strip('"')
-        elif regtype == bool:
-            return bool(int(retval))
-        else:
-            raise AssertionError
+        return get_value(retdict, retname)
+
+    def _read_registers(self, registers):
+        """ Reads several registers in one burst, see L{_send_commands}
+
+        @param registers: a list of (name, type) tuples, where type is
+          int, Decimal, datetime.date, str or bool
+        @returns: a list with the value of each register
+        """
+        commands = []
+        for name, regtype in registers:
+            try:
+                cmd, argname, retname, get_value = _REGISTER_COMMANDS[regtype]
+            except KeyError:
+                raise AssertionError
+            commands.append((cmd, {argname: name}))
+
+        values = []
+        for (name, regtype), retdict in zip(registers,
+                                            self._send_commands(commands)):
+            cmd, argname, retname, get_value = _REGISTER_COMMANDS[regtype]
+            assert retname in retdict
+            values.append(get_value(retdict, retname))
+        return values
 
     def _get_status(self):
         return self._read_register('Indicadores', int)
 
+    def _probe(self):
+        self._get_status()
+
     def _get_last_item_id(self):
         return self._read_register('ContadorDocUltimoItemVendido', int)
 
@@ -306,8 +459,9 @@ class FiscNetECF(SerialBase):
         return self._read_register('TotalDocLiquido', Decimal)
 
     def _get_coupon_remainder_value(self):
-        value = self._read_register('TotalDocValorPago', Decimal)
-        result = self._get_coupon_total_value() - value
+        value, total = self._read_registers([('TotalDocValorPago', Decimal),
+                                             ('TotalDocLiquido', Decimal)])
+        result = total - value
         if result < 0.0:
             result = 0.0
         return result
@@ -345,74 +499,6 @@ class FiscNetECF(SerialBase):
             if e.code != 8057:  # Not configured
                 raise
 
-    def _define_payment_method(self, code, name, vinculated=False):
-        try:
-            retdict = self._send_command(
-                'LeMeioPagamento', CodMeioPagamentoProgram=code)
-        except DriverError, e:
-            if e.code != 8014:  # Not configured
-                raise
-        else:
-            configure = False
-            for retname in ['NomeMeioPagamento', 'DescricaoMeioPagamento']:
-                configured_name = retdict[retname]
-                if configured_name != name:
-                    configure = True
-
-            if not configure:
-                return
-
-        try:
-            self._send_command(
-                'DefineMeioPagamento',
-                CodMeioPagamentoProgram=code, DescricaoMeioPagamento=name,
-                NomeMeioPagamento=name, PermiteVinculado=vinculated)
-        except DriverError, e:
-            raise
-
-    def _delete_payment_method(self, code):
-        try:
-            self._send_command(
-                'ExcluiMeioPagamento', CodMeioPagamentoProgram=code)
-        except DriverError, e:
-            if e.code != 8014:  # Not configured
-                raise
-
-    def _define_tax_code(self, code, value, service=False):
-        try:
-            retdict = self._send_command(
-                'LeAliquota', CodAliquotaProgramavel=code)
-        except DriverError, e:
-            if e.code != 8005:  # Not configured
-                raise
-        else:
-            configure = False
-            for retname in ['PercentualAliquota']:
-                configured_name = retdict[retname]
-                if configured_name != value:
-                    configure = True
-
-            if not configure:
-                return
-
-        try:
-            self._send_command(
-                'DefineAliquota',
-                CodAliquotaProgramavel=code,
-                DescricaoAliquota='%2.2f%%' % value,
-                PercentualAliquota=value,
-                AliquotaICMS=not service)
-        except DriverError, e:
-            raise
-
-    def _delete_tax_code(self, code):
-        try:
-            self._send_command(
-                'ExcluiAliquota', CodAliquotaProgramavel=code)
-        except DriverError, e:
-            if e.code != 8005:  # Not configured
-                raise
-
     def _get_taxes(self):
         taxes = []
         taxes.append(('CANC', Decimal(0), 'ICMS'))
@@ -421,29 +507,36 @@ class FiscNetECF(SerialBase):
         taxes.append(('N', Decimal(0), 'ICMS'))
         taxes.append(('F', Decimal(0), 'ICMS'))
 
-        read_r = lambda x: self._read_register(x, Decimal)
+        names = ['TotalDiaIsencaoICMS',
+                 'TotalDiaSubstituicaoTributariaICMS',
+                 'TotalDiaNaoTributadoICMS',
+                 'TotalDiaDescontos',
+                 'TotalDiaCancelamentosICMS']
+        names.extend(['TotalDiaValorAliquota[%d]' % reg
+                      for reg in range(16)])
+        values = self._read_registers([(name, Decimal) for name in names])
 
         taxes = [
-            ('I', read_r('TotalDiaIsencaoICMS'), 'ICMS'),
-            ('F', read_r('TotalDiaSubstituicaoTributariaICMS'), 'ICMS'),
-            ('N', read_r('TotalDiaNaoTributadoICMS'), 'ICMS'),
-            ('DESC', read_r('TotalDiaDescontos'), 'ICMS'),
-            ('CANC', read_r('TotalDiaCancelamentosICMS'), 'ICMS'),
+            ('I', values[0], 'ICMS'),
+            ('F', values[1], 'ICMS'),
+            ('N', values[2], 'ICMS'),
+            ('DESC', values[3], 'ICMS'),
+            ('CANC', values[4], 'ICMS'),
         ]
 
-        for reg in range(16):
-            value = read_r('TotalDiaValorAliquota[%d]' % reg)
-            if value:
-                retdict = self._send_command(
-                    'LeAliquota', CodAliquotaProgramavel=reg)
-
-                if retdict['AliquotaICMS'] == 'Y':
-                    type = "ICMS"
-                else:
-                    type = "ISS"
+        totals = [(reg, value) for reg, value in enumerate(values[5:])
+                  if value]
+        retdicts = self._send_commands(
+            [('LeAliquota', dict(CodAliquotaProgramavel=reg))
+             for reg, value in totals])
+        for (reg, value), retdict in zip(totals, retdicts):
+            if retdict['AliquotaICMS'] == 'Y':
+                type = "ICMS"
+            else:
+                type = "ISS"
 
-                desc = retdict['PercentualAliquota'].replace(',', '')
-                taxes.append(('%04d' % int(desc), value, type))
+            desc = retdict['PercentualAliquota'].replace(',', '')
+            taxes.append(('%04d' % int(desc), value, type))
         return taxes
 
     def _configure_printer(self):
@@ -454,31 +547,19 @@ class FiscNetECF(SerialBase):
         for code in range(2, 15):
             self._delete_tax_name(code)
 
-        self._define_payment_method(0,
-                                    u'Cheque'.encode(self.coupon_printer_charset))
-        self._define_payment_method(1,
-                                    u'Boleto'.encode(self.coupon_printer_charset))
-        self._define_payment_method(2,
-                                    u'Cartão credito'.encode(self.coupon_printer_charset),
-                                    vinculated=True)
-        self._define_payment_method(3,
-                                    u'Cartão debito'.encode(self.coupon_printer_charset),
-                                    vinculated=True)
-        self._define_payment_method(4,
-                                    u'Financeira'.encode(self.coupon_printer_charset))
-        self._define_payment_method(5,
-                                    u'Vale compra'.encode(self.coupon_printer_charset))
-        for code in range(6, 15):
-            self._delete_payment_method(code)
-
-        self._define_tax_code(0, Decimal("17.00"))
-        self._define_tax_code(1, Decimal("12.00"))
-        self._define_tax_code(2, Decimal("25.00"))
-        self._define_tax_code(3, Decimal("8.00"))
-        self._define_tax_code(4, Decimal("5.00"))
-        self._define_tax_code(5, Decimal("3.00"), service=True)
-        for code in range(6, 16):
-            self._delete_tax_code(code)
+        provision(self.get_provisioning_tables(), dict(
+            payment_methods=[(u'Cheque', False),
+                             (u'Boleto', False),
+                             (u'Cartão credito', True),
+                             (u'Cartão debito', True),
+                             (u'Financeira', False),
+                             (u'Vale compra', False)],
+            taxes=[(Decimal("17.00"), False),
+                   (Decimal("12.00"), False),
+                   (Decimal("25.00"), False),
+                   (Decimal("8.00"), False),
+                   (Decimal("5.00"), False),
+                   (Decimal("3.00"), True)]))
 
     def print_status(self):
         status = self._get_status()
@@ -663,6 +744,10 @@ class FiscNetECF(SerialBase):
     def get_constants(self):
         return self._consts
 
+    def get_provisioning_tables(self):
+        return dict(taxes=_TaxTable(self),
+                    payment_methods=_PaymentMethodTable(self))
+
     def query_status(self):
         return '{0;LeInteiro;NomeInteiro="Indicadores";}'
 
@@ -732,6 +817,9 @@ class FiscNetECF(SerialBase):
     def get_gnf(self):
         return self._read_register('GNF', int)
 
+    def get_last_item_id(self):
+        return self._get_last_item_id()
+
     def get_cro(self):
         return self._read_register('CRO', int)
 
@@ -742,17 +830,28 @@ class FiscNetECF(SerialBase):
         return self._read_register('VersaoSW', str)
 
     def get_sintegra(self):
+        (opening_date, serial, serial_id, coupon_start, coo, cro, crz,
+         period_total, total) = self._read_registers([
+            ('DataAbertura', datetime.date),
+            ('NumeroSerieECF', str),
+            ('ECF', int),
+            ('COOInicioDia', int),
+            ('COO', int),
+            ('CRO', int),
+            ('CRZ', int),
+            ('TotalDiaVendaBruta', Decimal),
+            ('GT', Decimal)])
         data = Settable(
-            opening_date=self._read_register('DataAbertura', datetime.date),
-            serial=self.get_serial(),
-            serial_id=self._read_register('ECF', int),
-            coupon_start=self._read_register('COOInicioDia', int),
-            coupon_end=self.get_coo(),
-            cro=self.get_cro(),
-            crz=self.get_crz(),
-            coo=self.get_coo(),
-            period_total=self._read_register('TotalDiaVendaBruta', Decimal),
-            total=self._read_register('GT', Decimal),
+            opening_date=opening_date,
+            serial=serial,
+            serial_id=serial_id,
+            coupon_start=coupon_start,
+            coupon_end=coo,
+            cro=cro,
+            crz=crz,
+            coo=coo,
+            period_total=period_total,
+            total=total,
             taxes=self._get_taxes())
 
         return data
@@ -32,8 +32,6 @@ from decimal import Decimal
 import json
 import os
 
-import gtk
-import pango
 from kiwi.python import Settable
 from zope.interface import implements
 
@@ -45,10 +43,17 @@ from stoqdrivers.exceptions import (CouponTotalizeError, PaymentAdditionError,
 from stoqdrivers.interfaces import ICouponPrinter
 from stoqdrivers.printers.base import BaseDriverConstants
 from stoqdrivers.printers.capabilities import Capability
+from stoqdrivers.printers.virtual.journal import StateJournal
+from stoqdrivers.printers.virtual.output import create_output
 from stoqdrivers.translation import stoqdrivers_gettext
 
 _ = stoqdrivers_gettext
 
+# Persisted in the state journal
+_STATE_FIELDS = ['till_closed', 'cro', 'crz', 'coo', 'gnf', 'ccf',
+                 'period_total', 'total', 'taxes']
+_DECIMAL_FIELDS = ['period_total', 'total']
+
 
 class CouponItem:
     def __init__(self, id, quantity, value):
@@ -97,64 +102,6 @@ class FakeConstants(BaseDriverConstants):
     ]
 
 
-class OutputWindow(gtk.Window):
-    columns = 60
-
-    def __init__(self, printer):
-        self._printer = printer
-        gtk.Window.__init__(self)
-        self.set_title(_("ECF Emulator"))
-        self.set_size_request(220, 320)
-        self.move(0, 0)
-        self.set_deletable(False)
-        self.vbox = gtk.VBox(0, False)
-        self.add(self.vbox)
-
-        self._create_ui()
-
-    def _create_ui(self):
-        sw = gtk.ScrolledWindow()
-        self.vbox.pack_start(sw, True, True)
-        sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_ALWAYS)
-
-        self.textview = gtk.TextView()
-        self.textview.modify_font(pango.FontDescription("Monospace 7"))
-        sw.add(self.textview)
-        self.buffer = self.textview.get_buffer()
-
-        buttonbox = gtk.HBox()
-        self.vbox.pack_start(buttonbox, False, False)
-
-        self.b = gtk.ToggleButton(_("Turn off"))
-        self.b.set_active(True)
-        buttonbox.pack_start(self.b)
-        self.b.connect("toggled", self._on_onoff__toggled)
-
-    def _on_onoff__toggled(self, button):
-        if button.get_active():
-            self.b.set_label(_("Turn off"))
-            self._printer.set_off(False)
-        else:
-            self.b.set_label(_("Turn on"))
-            self._printer.set_off(True)
-
-    def feed(self, text):
-        self.buffer.props.text += text
-        mark = self.buffer.get_insert()
-        self.textview.scroll_mark_onscreen(mark)
-
-    def feed_line(self, text=None):
-        if not text:
-            self.buffer.props.text += ('-' * self.columns) + '\n'
-            return
-
-        length = (self.columns - len(text) - 2) / 2
-        self.buffer.props.text += '%s %s %s\n' % (
-            '-' * length, text, '-' * length)
-        mark = self.buffer.get_insert()
-        self.textview.scroll_mark_onscreen(mark)
-
-
 class Simple(object):
     implements(ICouponPrinter)
 
@@ -164,12 +111,14 @@ class Simple(object):
     identify_customer_at_end = True
     supported = False
 
-    def __init__(self, port, consts=None):
+    def __init__(self, port, consts=None, output=None, state_dir=None):
         self._consts = consts or FakeConstants()
         self._customer_document = None
 
         self._off = False
-        self.output = OutputWindow(self)
+        if output is None:
+            output = create_output(self)
+        self.output = output
 
         # Internal state
         self.till_closed = False
@@ -183,11 +132,12 @@ class Simple(object):
         self.coo = 1
         self.gnf = 1
         self.ccf = 1
-        self.period_total = 0
-        self.total = 0
+        self.period_total = Decimal(0)
+        self.total = Decimal(0)
         self.taxes = []
 
         self._reset_flags()
+        self._journal = StateJournal(self._get_state_dir(state_dir))
         self._load_state()
 
         self.output.feed(
@@ -205,41 +155,53 @@ class Simple(object):
     # Helper methods
     #
 
-    def _get_state_filename(self):
-        dirname = os.path.join(os.environ['HOME'], '.stoq')
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        filename = os.path.join(dirname, 'virtual-printer.json')
-        return filename
-
-    def _load_state(self):
-        filename = self._get_state_filename()
+    def _get_state_dir(self, state_dir):
+        if state_dir is None:
+            state_dir = os.environ.get('STOQDRIVERS_VIRTUAL_STATE_DIR')
+        if state_dir is None:
+            state_dir = os.path.join(os.environ['HOME'], '.stoq',
+                                     'virtual-printer')
+        return state_dir
+
+    def _load_legacy_state(self):
+        # Versions before the journal saved everything in this file
+        filename = os.path.join(os.environ['HOME'], '.stoq',
+                                'virtual-printer.json')
         try:
             fp = open(filename, 'r')
         except (OSError, IOError):
-            return
+            return {}
         try:
             state = json.load(fp)
         except ValueError:
-            return
-
-        self.till_closed = state['till-closed']
+            return {}
+        finally:
+            fp.close()
 
-        fp.close()
+        return {'till_closed': state.get('till-closed', False)}
 
-    def _save_state(self):
-        filename = self._get_state_filename()
-        try:
-            fp = open(filename, 'w')
-        except (OSError, IOError):
-            return
-
-        state = {}
-        state['till-closed'] = self.till_closed
-
-        json.dump(state, fp)
-        fp.write('\n')
-        fp.close()
+    def _load_state(self):
+        state = self._journal.load()
+        if not state:
+            state = self._load_legacy_state()
+            if state:
+                self._journal.record(**state)
+        for field in _STATE_FIELDS:
+            if not field in state:
+                continue
+            value = state[field]
+            if field in _DECIMAL_FIELDS:
+                value = Decimal(value)
+            setattr(self, field, value)
+
+    def _save_state(self, *fields):
+        changes = {}
+        for field in fields:
+            value = getattr(self, field)
+            if field in _DECIMAL_FIELDS:
+                value = str(value)
+            changes[field] = value
+        self._journal.record(**changes)
 
     def set_off(self, off):
         self._off = off
@@ -344,6 +306,8 @@ class Simple(object):
         self.output.feed('    Cupom Cancelado\n')
         self.output.feed_line()
         self._reset_flags()
+        self.coo += 1
+        self._save_state('coo')
 
     def coupon_totalize(self, discount=Decimal("0.0"),
                         surcharge=Decimal("0.0"), taxcode=TaxType.NONE):
@@ -406,6 +370,11 @@ class Simple(object):
         if message:
             self.output.feed(message)
         self.output.feed('\n')
+        self.coo += 1
+        self.ccf += 1
+        self.period_total += self.totalized_value
+        self.total += self.totalized_value
+        self._save_state('coo', 'ccf', 'period_total', 'total')
         self._reset_flags()
         return 0
 
@@ -436,7 +405,9 @@ class Simple(object):
         self.output.feed('LEITURA X\n')
         self.output.feed_line()
         self.till_closed = False
-        self._save_state()
+        self.coo += 1
+        self.gnf += 1
+        self._save_state('till_closed', 'coo', 'gnf')
 
     def open_till(self):
         self.summarize()
@@ -447,7 +418,10 @@ class Simple(object):
             raise DriverError(
                 "Reduce Z was already sent today, try again tomorrow")
         self.till_closed = True
-        self._save_state()
+        self.coo += 1
+        self.crz += 1
+        self.period_total = Decimal(0)
+        self._save_state('till_closed', 'coo', 'crz', 'period_total')
         self.output.feed("REDUÇÃO Z\n")
         self.output.feed_line()
 
@@ -0,0 +1,92 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+A gtk window emulating the virtual printer paper.
+"""
+
+import gtk
+import pango
+
+from stoqdrivers.printers.virtual.output import BaseOutput, DEFAULT_MAX_LINES
+from stoqdrivers.translation import stoqdrivers_gettext
+
+_ = stoqdrivers_gettext
+
+
+class OutputWindow(gtk.Window, BaseOutput):
+    def __init__(self, printer, max_lines=DEFAULT_MAX_LINES):
+        self._printer = printer
+        self.max_lines = max_lines
+        gtk.Window.__init__(self)
+        self.set_title(_("ECF Emulator"))
+        self.set_size_request(220, 320)
+        self.move(0, 0)
+        self.set_deletable(False)
+        self.vbox = gtk.VBox(0, False)
+        self.add(self.vbox)
+
+        self._create_ui()
+
+    def _create_ui(self):
+        sw = gtk.ScrolledWindow()
+        self.vbox.pack_start(sw, True, True)
+        sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_ALWAYS)
+
+        self.textview = gtk.TextView()
+        self.textview.modify_font(pango.FontDescription("Monospace 7"))
+        sw.add(self.textview)
+        self.buffer = self.textview.get_buffer()
+        self._end_mark = self.buffer.create_mark(
+            'end', self.buffer.get_end_iter(), False)
+
+        buttonbox = gtk.HBox()
+        self.vbox.pack_start(buttonbox, False, False)
+
+        self.b = gtk.ToggleButton(_("Turn off"))
+        self.b.set_active(True)
+        buttonbox.pack_start(self.b)
+        self.b.connect("toggled", self._on_onoff__toggled)
+
+    def _on_onoff__toggled(self, button):
+        if button.get_active():
+            self.b.set_label(_("Turn off"))
+            self._printer.set_off(False)
+        else:
+            self.b.set_label(_("Turn on"))
+            self._printer.set_off(True)
+
+    def feed(self, text):
+        # Append at the end and drop the oldest lines, so feeding is not
+        # proportional to everything printed so far
+        self.buffer.insert(self.buffer.get_end_iter(), text)
+        lines = self.buffer.get_line_count()
+        if lines > self.max_lines:
+            self.buffer.delete(
+                self.buffer.get_start_iter(),
+                self.buffer.get_iter_at_line(lines - self.max_lines))
+        self.textview.scroll_mark_onscreen(self._end_mark)
+
+    def show_all(self):
+        gtk.Window.show_all(self)
@@ -0,0 +1,155 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Append-only state journal.
+
+The state is a dictionary of JSON serializable values. Each change is
+appended to a journal file as one JSON line and synced to disk, which is
+much cheaper than rewriting all the state. Every once in a while the
+journal is compacted: the whole state is written to a snapshot file,
+atomically replacing the old one, and the journal is emptied.
+"""
+
+import json
+import os
+
+SNAPSHOT_FILENAME = 'state.json'
+JOURNAL_FILENAME = 'journal.log'
+
+
+class StateJournal(object):
+    """ Persists a state dictionary in a directory.
+
+    @ivar dirname: the directory holding the snapshot and the journal
+    @ivar compact_every: the number of records after which the journal
+        is compacted
+    """
+
+    def __init__(self, dirname, compact_every=100):
+        self.dirname = dirname
+        self.compact_every = compact_every
+        self._snapshot = os.path.join(dirname, SNAPSHOT_FILENAME)
+        self._journal = os.path.join(dirname, JOURNAL_FILENAME)
+        self._state = None
+        self._records = 0
+        self._fp = None
+
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    def _read_snapshot(self):
+        try:
+            fp = open(self._snapshot, 'r')
+        except (OSError, IOError):
+            return {}
+        try:
+            return json.load(fp)
+        except ValueError:
+            return {}
+        finally:
+            fp.close()
+
+    def _read_journal(self, state):
+        try:
+            fp = open(self._journal, 'r')
+        except (OSError, IOError):
+            return 0
+        records = 0
+        size = 0
+        try:
+            for line in fp:
+                # A record which was being appended when the process
+                # died, everything after it is lost too
+                if not line.endswith('\n'):
+                    break
+                try:
+                    state.update(json.loads(line))
+                except ValueError:
+                    break
+                size += len(line)
+                records += 1
+        finally:
+            fp.close()
+        # Drop the broken tail, or the next record would be glued to it
+        if size < os.path.getsize(self._journal):
+            fp = open(self._journal, 'r+')
+            try:
+                fp.truncate(size)
+                fp.flush()
+                os.fsync(fp.fileno())
+            finally:
+                fp.close()
+        return records
+
+    def load(self):
+        """ Reads the state from disk
+
+        @returns: the state dictionary, empty if nothing was saved yet
+        """
+        state = self._read_snapshot()
+        self._records = self._read_journal(state)
+        self._state = state
+        return dict(state)
+
+    def record(self, **changes):
+        """ Appends the changes to the journal and syncs it to disk """
+        if self._state is None:
+            self.load()
+        self._state.update(changes)
+        if self._fp is None:
+            self._fp = open(self._journal, 'a')
+        self._fp.write(json.dumps(changes, sort_keys=True) + '\n')
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+        self._records += 1
+        if self._records >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """ Writes the whole state to the snapshot and empties the journal """
+        if self._state is None:
+            self.load()
+        tmp = self._snapshot + '.tmp'
+        fp = open(tmp, 'w')
+        try:
+            json.dump(self._state, fp, sort_keys=True)
+            fp.write('\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+        os.rename(tmp, self._snapshot)
+
+        # Only empty the journal after the snapshot is safely on disk,
+        # replaying it over the new snapshot gives the same state anyway
+        self.close()
+        open(self._journal, 'w').close()
+        self._records = 0
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
@@ -0,0 +1,145 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+"""
+Output sinks for the virtual printer.
+
+The virtual printer does not print anywhere by itself, everything it
+would print is fed to an output sink. The sink is chosen with the
+STOQDRIVERS_VIRTUAL_OUTPUT environment variable:
+
+  - gtk: a window emulating the printer paper (the default when there
+    is a display available)
+  - memory[:LINES]: keeps the last LINES lines (1000 by default) in
+    memory (the default when there is no display)
+  - file:FILENAME: appends everything to FILENAME
+  - null: discards everything
+
+Only the gtk sink imports gtk.
+"""
+
+import collections
+import os
+
+DEFAULT_MAX_LINES = 1000
+
+
+def _encode(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return text
+
+
+class BaseOutput(object):
+    """ Base class for the output sinks, subclasses must implement
+    L{feed}.
+    """
+    columns = 60
+
+    def feed(self, text):
+        raise NotImplementedError
+
+    def feed_line(self, text=None):
+        if not text:
+            self.feed(('-' * self.columns) + '\n')
+            return
+
+        length = (self.columns - len(text) - 2) / 2
+        self.feed('%s %s %s\n' % ('-' * length, text, '-' * length))
+
+    def show_all(self):
+        pass
+
+
+class NullOutput(BaseOutput):
+    def feed(self, text):
+        pass
+
+
+class MemoryOutput(BaseOutput):
+    """ Keeps the last max_lines printed lines in memory """
+
+    def __init__(self, max_lines=DEFAULT_MAX_LINES):
+        self._lines = collections.deque(maxlen=max_lines)
+        self._partial = ''
+
+    def feed(self, text):
+        lines = (self._partial + _encode(text)).split('\n')
+        self._partial = lines.pop()
+        self._lines.extend(lines)
+
+    def get_lines(self):
+        """ Returns the complete lines kept, oldest first """
+        return list(self._lines)
+
+    def get_text(self):
+        """ Returns the text kept, including the current unfinished line """
+        return ''.join([line + '\n' for line in self._lines]) + self._partial
+
+    def clear(self):
+        self._lines.clear()
+        self._partial = ''
+
+
+class FileOutput(BaseOutput):
+    def __init__(self, filename):
+        self.filename = filename
+        self._fp = open(filename, 'a')
+
+    def feed(self, text):
+        self._fp.write(_encode(text))
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+def create_output(printer, spec=None):
+    """ Creates the output sink for a virtual printer.
+
+    @param printer: the virtual printer
+    @param spec: the sink specification, see the module documentation.
+        If not specified, STOQDRIVERS_VIRTUAL_OUTPUT is used.
+    """
+    if spec is None:
+        spec = os.environ.get('STOQDRIVERS_VIRTUAL_OUTPUT')
+    if spec is None:
+        if os.environ.get('DISPLAY'):
+            spec = 'gtk'
+        else:
+            spec = 'memory'
+
+    name, arg = (spec.split(':', 1) + [''])[:2]
+    if name == 'gtk':
+        from stoqdrivers.printers.virtual.gtkoutput import OutputWindow
+        return OutputWindow(printer, max_lines=int(arg or DEFAULT_MAX_LINES))
+    elif name == 'memory':
+        return MemoryOutput(max_lines=int(arg or DEFAULT_MAX_LINES))
+    elif name == 'file':
+        if not arg:
+            raise ValueError("The file output needs a filename")
+        return FileOutput(arg)
+    elif name == 'null':
+        return NullOutput()
+    raise ValueError("Invalid virtual printer output: %r" % (spec, ))
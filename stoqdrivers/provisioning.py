@@ -0,0 +1,159 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+"""
+Provisioning of the tax and payment method tables of fiscal printers.
+
+Instead of sending a fixed sequence of configuration commands, the
+caller describes the tables the printer should have. The tables of the
+printer are read once, compared to the desired ones and only the
+commands needed to make them equal are sent, so provisioning a printer
+which is already configured sends nothing but the reads.
+
+The entries of the tables are:
+  - taxes: a (value, service) tuple, where value is a Decimal with the
+    percentage and service is True for ISS and False for ICMS
+  - payment_methods: a (name, vinculated) tuple, where vinculated tells
+    if payment receipts can be bound to the method
+
+Drivers supporting it implement C{get_provisioning_tables()}, returning
+a dict mapping the table names above to L{Table} subclasses.
+"""
+
+from stoqdrivers.exceptions import DriverError
+from stoqdrivers.translation import stoqdrivers_gettext
+
+_ = stoqdrivers_gettext
+
+ADD = 'add'
+WRITE = 'write'
+DELETE = 'delete'
+
+
+class Table(object):
+    """ A table of the printer, each slot of it holding an entry
+
+    @cvar size: the number of slots, or None when the printer picks the
+      slot of the new entries by itself
+    @cvar can_delete: if the printer can clear a slot
+    """
+
+    size = None
+    can_delete = False
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def read(self):
+        """ Returns a dict mapping the slots in use to their entries """
+        raise NotImplementedError
+
+    def write(self, slot, entry):
+        """ Stores an entry in a slot, or in the slot the printer picks
+        when the slot is None
+        """
+        raise NotImplementedError
+
+    def delete(self, slot):
+        raise NotImplementedError
+
+    def get_key(self, entry):
+        """ Returns what is compared to tell if two entries are equal,
+        which is where tables drop what the printer cannot store or report
+        """
+        return entry
+
+
+def get_changes(table, current, desired):
+    """ Computes the changes which turn the current entries of a table
+    into the desired ones. The entries which are already there are kept
+    in their slots, the others take the slots of the unwanted entries and
+    then the free ones. What is still unwanted is deleted, if the table
+    can delete entries.
+
+    @param table: a L{Table}
+    @param current: a dict mapping slots to entries, as returned by
+      L{Table.read}
+    @param desired: a list of entries
+    @returns: a list of (action, slot, entry) tuples, where action is
+      L{ADD}, L{WRITE} or L{DELETE}
+    """
+    missing = []
+    keys = set()
+    for entry in desired:
+        key = table.get_key(entry)
+        if key not in keys:
+            keys.add(key)
+            missing.append((key, entry))
+
+    unwanted = []
+    for slot in sorted(current):
+        key = table.get_key(current[slot])
+        for i, (missing_key, entry) in enumerate(missing):
+            if missing_key == key:
+                del missing[i]
+                break
+        else:
+            unwanted.append(slot)
+
+    if table.size is None:
+        return [(ADD, None, entry) for entry_key, entry in missing]
+
+    free = [i for i in range(table.size) if i not in current]
+    changes = []
+    for key, entry in missing:
+        if unwanted:
+            slot = unwanted.pop(0)
+        elif free:
+            slot = free.pop(0)
+        else:
+            raise DriverError(_("There is no free slot for %r") % (entry, ))
+        changes.append((WRITE, slot, entry))
+    if table.can_delete:
+        changes.extend([(DELETE, i, None) for i in unwanted])
+    return changes
+
+
+def provision(tables, desired):
+    """ Makes the tables of a printer equal to the desired ones
+
+    @param tables: a dict mapping table names to L{Table}s
+    @param desired: a dict mapping table names to lists of entries, the
+      tables which are not there are left untouched
+    @returns: a list of (table name, action, slot, entry) tuples with the
+      changes that were made
+    """
+    done = []
+    for name in sorted(desired):
+        try:
+            table = tables[name]
+        except KeyError:
+            raise DriverError(_("The printer can not provision %s") % name)
+        for action, slot, entry in get_changes(table, table.read(),
+                                               desired[name]):
+            if action == DELETE:
+                table.delete(slot)
+            else:
+                table.write(slot, entry)
+            done.append((name, action, slot, entry))
+    return done
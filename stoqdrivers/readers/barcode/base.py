@@ -24,10 +24,10 @@
 ## Author(s):   Henrique Romano  <henrique@async.com.br>
 ##
 
-from kiwi.python import namedAny
 from zope.interface import implements
 
 from stoqdrivers.interfaces import IBarcodeReader
+from stoqdrivers.manifest import get_drivers
 from stoqdrivers.serialbase import SerialBase
 
 
@@ -44,19 +44,5 @@ class BaseBarcodeReader(SerialBase):
 
 
 def get_supported_barcode_readers():
-    result = {}
-    for brand, module_names in [('metrologic', ['MC630'])]:
-        result[brand] = []
-        for module_name in module_names:
-            try:
-                obj = namedAny("stoqdrivers.readers.barcode.%s.%s.%s"
-                               % (brand, module_name, module_name))
-            except AttributeError:
-                raise ImportError("Can't find class %s for module %s"
-                                  % (module_name, module_name))
-            if not IBarcodeReader.implementedBy(obj):
-                raise TypeError("The driver %s %s doesn't implements a "
-                                "valid interface"
-                                % (brand, obj.model_name))
-            result[brand].append(obj)
-    return result
+    return get_drivers('readers.barcode', interface=IBarcodeReader,
+                       supported_only=False)
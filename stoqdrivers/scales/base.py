@@ -27,12 +27,12 @@
 Useful functions related to all scales supported by stoqdrivers
 """
 
-from kiwi.python import namedAny
 from zope.interface import providedBy
 
 from stoqdrivers.interfaces import IScale
 from stoqdrivers.base import BaseDevice
 from stoqdrivers.enum import DeviceType
+from stoqdrivers.manifest import get_drivers
 
 
 class BaseScale(BaseDevice):
@@ -47,20 +47,5 @@ class BaseScale(BaseDevice):
 
 
 def get_supported_scales():
-    result = {}
-
-    for brand, module_names in [(u'toledo', [u'PrixIII'])]:
-        result[brand] = []
-        for module_name in module_names:
-            try:
-                obj = namedAny("stoqdrivers.scales.%s.%s.%s"
-                               % (brand, module_name, module_name))
-            except AttributeError:
-                raise ImportError("Can't find class %s for module %s"
-                                  % (module_name, module_name))
-            if not IScale.implementedBy(obj):
-                raise TypeError("The driver %s %s doesn't implements a "
-                                "valid interface"
-                                % (brand, obj.model_name))
-            result[brand].append(obj)
-    return result
+    return get_drivers('scales', interface=IScale,
+                       supported_only=False)
@@ -25,13 +25,22 @@
 ##              Henrique Romano  <henrique@async.com.br>
 ##
 
+import codecs
+import fcntl
+import termios
+
 from kiwi.log import Logger
 from serial import Serial, EIGHTBITS, PARITY_NONE, STOPBITS_ONE
 from zope.interface import implements
 
+from stoqdrivers import wirelog
+from stoqdrivers.flightrecorder import FlightRecorder, READ, WRITE
+from stoqdrivers.health import CircuitBreaker
 from stoqdrivers.interfaces import ISerialPort
-from stoqdrivers.exceptions import DriverError
+from stoqdrivers.exceptions import (DriverError, PrinterError,
+                                    PrinterOfflineError)
 from stoqdrivers.translation import stoqdrivers_gettext
+from stoqdrivers.utils import monotonic, wait_until
 
 _ = stoqdrivers_gettext
 
@@ -44,6 +53,9 @@ class VirtualPort:
     def getDSR(self):
         return True
 
+    def waitDSR(self, timeout=None):
+        return True
+
     def setDTR(self, value):
         pass
 
@@ -73,6 +85,21 @@ class SerialPort(Serial):
         self.setTimeout(3)
         self.setWriteTimeout(0)
 
+    def waitDSR(self, timeout=None):
+        if self.getDSR():
+            return True
+        if timeout is None and hasattr(termios, 'TIOCMIWAIT'):
+            # Sleep in the kernel until a modem line changes, some
+            # adapters do not support it though. It has no timeout, so
+            # timed waits back off instead.
+            try:
+                while not self.getDSR():
+                    fcntl.ioctl(self.fd, termios.TIOCMIWAIT, termios.TIOCM_DSR)
+                return True
+            except IOError:
+                pass
+        return wait_until(self.getDSR, timeout)
+
 
 class SerialBase(object):
 
@@ -83,8 +110,18 @@ class SerialBase(object):
     # used by readline()
     EOL_DELIMIT = '\r'
 
+    # Set when the device keeps DSR off while it is not ready, so
+    # check_health() can tell it is offline without sending anything
+    MODEM_STATUS_LINES = False
+
+    _stats = None
+    _recorder = None
+    _breaker = None
+
     def __init__(self, port):
         self._port = port
+        self._recorder = FlightRecorder()
+        self._breaker = CircuitBreaker()
 
     def set_port(self, port):
         self._port = port
@@ -95,16 +132,133 @@ class SerialBase(object):
     def fileno(self):
         return self._port.fileno()
 
+    def enable_stats(self, stats):
+        """ Starts collecting the statistics of the commands sent
+
+        @param stats: a L{stoqdrivers.stats.DriverStats} or None to stop
+        """
+        self._stats = stats
+
+    def set_recorder(self, recorder):
+        """ Replaces the flight recorder of the port
+
+        @param recorder: a L{stoqdrivers.flightrecorder.FlightRecorder}
+          or None to stop recording
+        """
+        self._recorder = recorder
+
+    def get_recorder(self):
+        """ Returns the L{stoqdrivers.flightrecorder.FlightRecorder}
+        with the last frames exchanged with the device or None
+        """
+        return self._recorder
+
+    def get_stats(self):
+        """ Returns the L{stoqdrivers.stats.DriverStats} set by
+        L{enable_stats} or None
+        """
+        return self._stats
+
+    def set_breaker(self, breaker):
+        """ Replaces the circuit breaker of the port
+
+        @param breaker: a L{stoqdrivers.health.CircuitBreaker} or None
+          to always wait for the device
+        """
+        self._breaker = breaker
+
+    def get_breaker(self):
+        """ Returns the L{stoqdrivers.health.CircuitBreaker} of the
+        port or None
+        """
+        return self._breaker
+
+    def get_timeout_error(self):
+        """ Returns the exception drivers raise when the device stops
+        replying, accounting it in the statistics and in the circuit
+        breaker.
+        """
+        if self._stats is not None:
+            self._stats.add_timeout()
+        if self._breaker is not None:
+            self._breaker.add_failure()
+        error = PrinterOfflineError(
+            _("Timeout communicating with fiscal printer"))
+        if self._recorder is not None:
+            error.frames = self._recorder.get_frames()
+        return error
+
+    def check_health(self, timeout=0.5):
+        """ Checks if the device is replying, looking at the modem
+        status lines and sending it a status query which waits at most
+        I{timeout} seconds for each read. The circuit breaker is closed
+        if it replies.
+
+        @param timeout: the read timeout of the status query, in seconds
+        @raises PrinterOfflineError: if the device is not replying
+        """
+        breaker = self._breaker
+        if self.MODEM_STATUS_LINES and not self._port.getDSR():
+            if breaker is not None:
+                breaker.add_failure()
+            raise PrinterOfflineError(_("Printer is offline"))
+
+        port = self._port
+        old_timeout = None
+        if hasattr(port, 'getTimeout'):
+            old_timeout = port.getTimeout()
+            port.setTimeout(timeout)
+        # Let the probe through even if the breaker is open, its
+        # outcome is accounted below.
+        self._breaker = None
+        replied = False
+        try:
+            try:
+                self._probe()
+                replied = True
+            except PrinterOfflineError:
+                raise
+            except (DriverError, PrinterError):
+                # The device replied, even if it was an error
+                replied = True
+                raise
+        finally:
+            self._breaker = breaker
+            if old_timeout is not None:
+                port.setTimeout(old_timeout)
+            if breaker is not None:
+                if replied:
+                    breaker.add_success()
+                else:
+                    breaker.add_failure()
+
+    def _probe(self):
+        # Drivers send here the cheapest command that gets a reply
+        pass
+
     def writeline(self, data):
         self.write(self.CMD_PREFIX + data + self.CMD_SUFFIX)
         return self.readline()
 
     def write(self, data):
-        log.debug(">>> %r (%d bytes)" % (data, len(data)))
+        if wirelog.is_enabled(log):
+            log.debug(">>> %s (%d bytes)", wirelog.frame(data), len(data))
+        if self._recorder is not None:
+            self._recorder.record(WRITE, data)
+        if self._stats is None:
+            self._port.write(data)
+            return
+        started = monotonic()
         self._port.write(data)
+        self._stats.add_write(len(data), started, monotonic())
 
     def read(self, n_bytes):
-        return self._port.read(n_bytes)
+        data = self._port.read(n_bytes)
+        if data and self._recorder is not None:
+            self._recorder.record(READ, data)
+        if self._stats is not None:
+            self._stats.add_read(data and len(data) or 0, monotonic())
+        return data
 
     def readline(self):
         out = ''
@@ -112,16 +266,58 @@ class SerialBase(object):
         retries = 10
         while True:
             if a > retries:
-                raise DriverError(_("Timeout communicating with fiscal "
-                                    "printer"))
+                raise self.get_timeout_error()
 
-            c = self._port.read(1)
+            c = self.read(1)
             if not c:
                 a += 1
-                print 'take %s' % a
+                log.debug('no data read, retry %d', a)
                 continue
             a = 0
             if c == self.EOL_DELIMIT:
-                log.debug('<<< %r' % out)
+                if wirelog.is_enabled(log):
+                    log.debug('<<< %s', wirelog.frame(out))
                 return out
             out += c
+
+    def iter_until(self, terminator, charset, delimiter='\n'):
+        """ Reads until terminator, yielding the decoded lines as they
+        arrive, delimiter included. Nothing is read before the next line is
+        asked for, so a long download never sits whole in memory.
+
+        If the iterator is closed before the end, the rest is read and
+        dropped, so that the next command does not get it as its reply.
+        """
+        decoder = codecs.getincrementaldecoder(charset)()
+        line = ''
+        try:
+            for c in self._iter_chars(terminator):
+                line += c
+                if c == delimiter:
+                    yield decoder.decode(line)
+                    line = ''
+        except GeneratorExit:
+            for c in self._iter_chars(terminator):
+                pass
+            raise
+        text = decoder.decode(line, True)
+        if text:
+            yield text
+
+    def _iter_chars(self, terminator):
+        # Yields the bytes read before terminator, retrying like readline
+        a = 0
+        retries = 10
+        while True:
+            if a > retries:
+                raise self.get_timeout_error()
+
+            c = self.read(1)
+            if not c:
+                a += 1
+                log.debug('no data read, retry %d', a)
+                continue
+            a = 0
+            if c == terminator:
+                return
+            yield c
@@ -0,0 +1,378 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+"""
+Per-command counters and latency histograms for serial drivers.
+
+Statistics are collected only when a L{DriverStats} instance is set on a
+driver with L{stoqdrivers.serialbase.SerialBase.enable_stats}; otherwise
+the instrumented code paths only check an attribute.
+
+For every command code a driver sends, the number of commands, the bytes
+written and read, the retries (reads that returned nothing) and the
+timeouts are counted, and three latencies are kept in histograms with
+logarithmic buckets: the time spent writing, the time from the end of
+the first write to the first reply byte and the time to the last reply
+byte.
+"""
+
+import bisect
+import os
+import string
+
+from stoqdrivers.exceptions import (DriverError, PrinterError,
+                                    PrinterOfflineError)
+from stoqdrivers.translation import stoqdrivers_gettext
+from stoqdrivers.utils import monotonic
+
+_ = stoqdrivers_gettext
+
+# Upper bounds, in seconds, of the histogram buckets: 100us doubling up
+# to about 105s, values above the last bound go to an extra bucket.
+BUCKETS = tuple(0.0001 * 2 ** i for i in range(21))
+
+# Code used for the I/O done outside of an instrumented command.
+OTHER = 'other'
+
+_PRINTABLE = frozenset(string.ascii_letters + string.digits + '_-')
+
+
+def format_code(code):
+    """ Converts a command code as passed to the driver to a label
+
+    @param code: the command code, an int or a str
+    @returns: a printable str
+    """
+    if isinstance(code, (int, long)):
+        return str(code)
+    if code and not set(code) - _PRINTABLE:
+        return code
+    return '0x' + code.encode('hex')
+
+
+class Histogram(object):
+    """ A histogram with logarithmic buckets
+
+    @ivar counts: the number of values in each bucket, the last one
+      counts the values above the last bound in L{BUCKETS}
+    @ivar count: the number of values
+    @ivar sum: the sum of the values
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_mean(self):
+        if not self.count:
+            return 0.0
+        return self.sum / self.count
+
+    def get_quantile(self, quantile):
+        """ Returns the upper bound of the bucket holding the given
+        quantile, or None if there are no values or it is above the last
+        bound.
+
+        @param quantile: a float between 0 and 1
+        """
+        if not self.count:
+            return None
+        rank = quantile * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+
+class CommandStats(object):
+    """ The statistics of a single command code
+
+    @ivar code: the command code label
+    @ivar count: the number of times the command was sent
+    @ivar bytes_written: the bytes written to the port
+    @ivar bytes_read: the bytes read from the port
+    @ivar retries: the reads that returned no data
+    @ivar timeouts: the times the driver gave up waiting for a reply
+    @ivar write_time: a L{Histogram} of the time spent writing
+    @ivar first_byte_time: a L{Histogram} of the time until the first byte
+      of the reply
+    @ivar last_byte_time: a L{Histogram} of the time until the last byte
+      of the reply
+    """
+
+    def __init__(self, code):
+        self.code = code
+        self.count = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.write_time = Histogram()
+        self.first_byte_time = Histogram()
+        self.last_byte_time = Histogram()
+
+
+class _Command(object):
+    def __init__(self, stats):
+        self.stats = stats
+        self.write_time = 0.0
+        self.written_at = None
+        self.first_read_at = None
+        self.last_read_at = None
+
+
+class DriverStats(object):
+    """ The statistics of a driver, grouped by command code
+
+    @ivar name: the name used for the driver label, usually the model
+    @ivar filename: if set, a file where the statistics are written in the
+      Prometheus text format, at most once every I{interval} seconds
+    """
+
+    def __init__(self, name='', filename=None, interval=10):
+        self.name = name
+        self.filename = filename
+        self.interval = interval
+        self._commands = {}
+        self._stack = []
+        self._last_dump = monotonic()
+
+    def _get_command(self, code):
+        stats = self._commands.get(code)
+        if stats is None:
+            stats = self._commands[code] = CommandStats(code)
+        return stats
+
+    def _get_current(self):
+        if self._stack:
+            return self._stack[-1]
+        return None
+
+    #
+    # Public API
+    #
+
+    def begin_command(self, code):
+        """ Starts accounting the I/O to a command, commands can be nested
+
+        @param code: the command code, see L{format_code}
+        """
+        stats = self._get_command(format_code(code))
+        stats.count += 1
+        self._stack.append(_Command(stats))
+
+    def end_command(self):
+        """ Finishes the command started by the last L{begin_command} """
+        command = self._stack.pop()
+        stats = command.stats
+        stats.write_time.add(command.write_time)
+        if command.written_at is not None and command.first_read_at:
+            stats.first_byte_time.add(
+                command.first_read_at - command.written_at)
+            stats.last_byte_time.add(
+                command.last_read_at - command.written_at)
+        if (self.filename is not None and
+            monotonic() - self._last_dump >= self.interval):
+            self.write_prometheus(self.filename)
+
+    def add_write(self, size, started, finished):
+        """ Accounts a write to the port
+
+        @param size: the number of bytes written
+        @param started: the monotonic time before the write
+        @param finished: the monotonic time after the write
+        """
+        command = self._get_current()
+        if command is None:
+            self._get_command(OTHER).bytes_written += size
+            return
+        command.stats.bytes_written += size
+        command.write_time += finished - started
+        if command.written_at is None:
+            command.written_at = finished
+
+    def add_read(self, size, finished):
+        """ Accounts a read from the port
+
+        @param size: the number of bytes read, 0 counts as a retry
+        @param finished: the monotonic time after the read
+        """
+        command = self._get_current()
+        if command is None:
+            stats = self._get_command(OTHER)
+        else:
+            stats = command.stats
+        if not size:
+            stats.retries += 1
+            return
+        stats.bytes_read += size
+        if command is not None and command.written_at is not None:
+            if command.first_read_at is None:
+                command.first_read_at = finished
+            command.last_read_at = finished
+
+    def add_timeout(self):
+        """ Accounts a timeout waiting for a reply """
+        command = self._get_current()
+        if command is None:
+            self._get_command(OTHER).timeouts += 1
+        else:
+            command.stats.timeouts += 1
+
+    def get_commands(self):
+        """ Returns the L{CommandStats} of all the command codes seen,
+        sorted by code.
+        """
+        return [self._commands[code] for code in sorted(self._commands)]
+
+    def get_command(self, code):
+        """ Returns the L{CommandStats} of a command code or None
+
+        @param code: the command code, see L{format_code}
+        """
+        return self._commands.get(format_code(code))
+
+    def reset(self):
+        self._commands.clear()
+
+    def get_prometheus(self):
+        """ Returns the statistics in the Prometheus text format """
+        lines = []
+        counters = [
+            ('commands_total', 'Commands sent', 'count'),
+            ('bytes_written_total', 'Bytes written', 'bytes_written'),
+            ('bytes_read_total', 'Bytes read', 'bytes_read'),
+            ('retries_total', 'Reads that returned no data', 'retries'),
+            ('timeouts_total', 'Timeouts waiting for a reply', 'timeouts'),
+            ]
+        histograms = [
+            ('write_seconds', 'Time spent writing a command',
+             'write_time'),
+            ('first_byte_seconds', 'Time until the first reply byte',
+             'first_byte_time'),
+            ('last_byte_seconds', 'Time until the last reply byte',
+             'last_byte_time'),
+            ]
+        commands = self.get_commands()
+        for name, help, attr in counters:
+            name = 'stoqdrivers_' + name
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s counter' % (name, ))
+            for stats in commands:
+                lines.append('%s{%s} %d' % (name, self._get_labels(stats),
+                                            getattr(stats, attr)))
+        for name, help, attr in histograms:
+            name = 'stoqdrivers_' + name
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s histogram' % (name, ))
+            for stats in commands:
+                labels = self._get_labels(stats)
+                histogram = getattr(stats, attr)
+                seen = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    seen += count
+                    lines.append('%s_bucket{%s,le="%g"} %d' % (
+                        name, labels, bound, seen))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (
+                    name, labels, histogram.count))
+                lines.append('%s_sum{%s} %.6f' % (name, labels,
+                                                  histogram.sum))
+                lines.append('%s_count{%s} %d' % (name, labels,
+                                                  histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename):
+        """ Writes the statistics in the Prometheus text format, replacing
+        the file atomically so that a collector never reads half of it.
+
+        @param filename: the file to write
+        """
+        tmp = filename + '.tmp'
+        fd = open(tmp, 'w')
+        try:
+            fd.write(self.get_prometheus())
+        finally:
+            fd.close()
+        os.rename(tmp, filename)
+        self._last_dump = monotonic()
+
+    def _get_labels(self, stats):
+        return 'driver="%s",cmd="%s"' % (self.name, stats.code)
+
+
+def instrumented(get_code=None):
+    """ Decorates the method of a L{SerialBase} subclass that sends a
+    command, so that the I/O done inside it is accounted to the command
+    code. By default the code is the first argument of the method,
+    I{get_code} can be used to compute it from all the arguments.
+
+    The errors raised by the method get the frames of the flight recorder
+    of the driver attached, see L{stoqdrivers.flightrecorder}. While the
+    circuit breaker of the driver is open the command is not sent, see
+    L{stoqdrivers.health}.
+    """
+    def decorator(func):
+        def wrapper(self, *args, **kwargs):
+            breaker = self._breaker
+            if breaker is not None and not breaker.allow():
+                raise PrinterOfflineError(
+                    _("Printer is not replying, retrying in %d seconds") %
+                    (breaker.get_remaining() + 1))
+            stats = self._stats
+            if stats is not None:
+                if get_code is None:
+                    code = args[0]
+                else:
+                    code = get_code(*args, **kwargs)
+                stats.begin_command(code)
+            try:
+                retval = func(self, *args, **kwargs)
+                if breaker is not None:
+                    breaker.add_success()
+                return retval
+            except PrinterOfflineError, e:
+                if self._recorder is not None:
+                    e.frames = self._recorder.get_frames()
+                raise
+            except (DriverError, PrinterError), e:
+                # The device replied with an error, so it is alive
+                if breaker is not None:
+                    breaker.add_success()
+                if self._recorder is not None:
+                    e.frames = self._recorder.get_frames()
+                raise
+            finally:
+                if stats is not None:
+                    stats.end_command()
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
@@ -0,0 +1,303 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+"""
+Span tracing of the printer operations.
+
+A L{Tracer} records a span for each high level call of a printer, like
+L{stoqdrivers.printers.fiscal.FiscalPrinter.add_item}, with child spans
+for the host side phases (argument validation, text encoding) and for
+every command sent to the device. The time a command takes is split
+into the wire time, computed from the bytes transferred and the baud
+rate, and an estimate of the time the device spent processing it.
+
+Each finished call is appended to a file as a line of JSON.
+"""
+
+import json
+import time
+
+from stoqdrivers.exceptions import DriverError, PrinterError
+from stoqdrivers.stats import format_code
+from stoqdrivers.utils import BITS_PER_BYTE, monotonic
+
+CALL = 'call'
+COMMAND = 'command'
+HOST = 'host'
+
+
+class Span(object):
+    """ A traced interval of time
+
+    @ivar name: the name of the call, phase or command code
+    @ivar kind: L{CALL}, L{COMMAND} or L{HOST}
+    @ivar start: the monotonic time when it started
+    @ivar end: the monotonic time when it finished
+    @ivar attrs: a dict with extra attributes
+    @ivar children: the spans started while this one was running
+    """
+
+    def __init__(self, name, kind, start):
+        self.name = name
+        self.kind = kind
+        self.start = start
+        self.end = None
+        self.attrs = {}
+        self.children = []
+
+    def get_duration(self):
+        return self.end - self.start
+
+    def get_dict(self, origin):
+        """ Returns the span as a dict ready to be dumped as JSON
+
+        @param origin: the monotonic time the offsets are relative to
+        """
+        data = dict(name=self.name,
+                    kind=self.kind,
+                    offset=self.start - origin,
+                    duration=self.get_duration())
+        data.update(self.attrs)
+        if self.children:
+            data['spans'] = [child.get_dict(origin)
+                             for child in self.children]
+        return data
+
+
+class Tracer(object):
+    """ Records spans and writes the finished calls to a JSON lines file
+
+    The tracer receives the command events of a driver, so it is set on
+    it with L{stoqdrivers.serialbase.SerialBase.enable_stats}; the
+    statistics that were enabled before are kept in L{stats} and still
+    receive all the events.
+
+    @ivar filename: the file the traces are appended to
+    @ivar baudrate: the baud rate used to compute the wire time
+    @ivar stats: a L{stoqdrivers.stats.DriverStats} or None
+    """
+
+    def __init__(self, filename, baudrate=None):
+        self.filename = filename
+        self.baudrate = baudrate
+        self.stats = None
+        self._stack = []
+        self._fd = None
+
+    def _get_wire_time(self, n_bytes):
+        if not self.baudrate:
+            return 0.0
+        return n_bytes * BITS_PER_BYTE / float(self.baudrate)
+
+    def _get_current(self):
+        if self._stack:
+            return self._stack[-1]
+        return None
+
+    def _push(self, span):
+        parent = self._get_current()
+        if parent is not None:
+            parent.children.append(span)
+        else:
+            span.attrs['time'] = time.time()
+        self._stack.append(span)
+
+    def _pop(self):
+        span = self._stack.pop()
+        if span.end is None:
+            span.end = monotonic()
+        if not self._stack:
+            self._write(span)
+        return span
+
+    def _summarize(self, span):
+        commands = wire_time = device_time = command_time = 0
+        for child in span.children:
+            if child.kind == COMMAND:
+                commands += 1
+                command_time += child.get_duration()
+                wire_time += child.attrs['wire_time']
+                device_time += child.attrs['device_time']
+            elif child.kind == CALL:
+                self._summarize(child)
+                commands += child.attrs['commands']
+                command_time += child.get_duration() - child.attrs['host_time']
+                wire_time += child.attrs['wire_time']
+                device_time += child.attrs['device_time']
+        span.attrs.update(commands=commands,
+                          wire_time=wire_time,
+                          device_time=device_time,
+                          host_time=span.get_duration() - command_time)
+
+    def _write(self, span):
+        if span.kind == CALL:
+            self._summarize(span)
+        if self._fd is None:
+            self._fd = open(self.filename, 'a')
+        self._fd.write(json.dumps(span.get_dict(span.start)) + '\n')
+        self._fd.flush()
+
+    #
+    # Public API
+    #
+
+    def begin_span(self, name):
+        """ Starts the span of a call, calls can be nested
+
+        @param name: the name of the call
+        """
+        self._push(Span(name, CALL, monotonic()))
+
+    def end_span(self):
+        """ Finishes the span started by the last L{begin_span} """
+        self._pop()
+
+    def add_phase(self, name, start=None):
+        """ Adds a host side phase, which finished now, to the current span
+
+        @param name: the name of the phase
+        @param start: the monotonic time when the phase started, by
+          default when the current span started
+        """
+        parent = self._get_current()
+        if parent is None:
+            return
+        if start is None:
+            start = parent.start
+        span = Span(name, HOST, start)
+        span.end = monotonic()
+        parent.children.append(span)
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+    #
+    # Driver statistics events, see stoqdrivers.stats.DriverStats
+    #
+
+    def begin_command(self, code):
+        if self.stats is not None:
+            self.stats.begin_command(code)
+        span = Span(format_code(code), COMMAND, monotonic())
+        span.attrs.update(bytes_written=0, bytes_read=0, retries=0,
+                          timeouts=0)
+        self._push(span)
+
+    def end_command(self):
+        if self.stats is not None:
+            self.stats.end_command()
+        span = self._stack[-1]
+        attrs = span.attrs
+        attrs['wire_time'] = self._get_wire_time(attrs['bytes_written'] +
+                                                 attrs['bytes_read'])
+        span.end = monotonic()
+        attrs['device_time'] = max(0.0,
+                                   span.get_duration() - attrs['wire_time'])
+        self._pop()
+
+    def add_write(self, size, started, finished):
+        if self.stats is not None:
+            self.stats.add_write(size, started, finished)
+        span = self._get_current()
+        if span is not None and span.kind == COMMAND:
+            span.attrs['bytes_written'] += size
+
+    def add_read(self, size, finished):
+        if self.stats is not None:
+            self.stats.add_read(size, finished)
+        span = self._get_current()
+        if span is not None and span.kind == COMMAND:
+            if size:
+                span.attrs['bytes_read'] += size
+            else:
+                span.attrs['retries'] += 1
+
+    def add_timeout(self):
+        if self.stats is not None:
+            self.stats.add_timeout()
+        span = self._get_current()
+        if span is not None and span.kind == COMMAND:
+            span.attrs['timeouts'] += 1
+
+
+def traced(func):
+    """ Decorates a method of a printer so that its calls are traced by
+    the tracer returned by its get_tracer() method, if any. It must be
+    applied on top of the other decorators so that they are traced too.
+
+    The errors raised by the drivers outside of the commands also get the
+    frames of the flight recorder attached here, see
+    L{stoqdrivers.flightrecorder}.
+    """
+    def wrapper(self, *args, **kwargs):
+        tracer = self.get_tracer()
+        if tracer is not None:
+            tracer.begin_span(func.__name__)
+        try:
+            return func(self, *args, **kwargs)
+        except (DriverError, PrinterError), e:
+            recorder = self.get_recorder()
+            if recorder is not None:
+                e.frames = recorder.get_frames()
+            raise
+        finally:
+            if tracer is not None:
+                tracer.end_span()
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+def traced_iter(func):
+    """ Like L{traced}, for the methods of a printer returning an
+    iterator. The span starts when the first item is asked for and ends
+    when the iterator is exhausted or closed, so that the commands sent and
+    the errors raised while iterating are part of it.
+    """
+    def wrapper(self, *args, **kwargs):
+        return _iter_traced(self, func.__name__, func(self, *args, **kwargs))
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+def _iter_traced(printer, name, iterator):
+    tracer = printer.get_tracer()
+    if tracer is not None:
+        tracer.begin_span(name)
+    try:
+        for item in iterator:
+            yield item
+    except (DriverError, PrinterError), e:
+        recorder = printer.get_recorder()
+        if recorder is not None:
+            e.frames = recorder.get_frames()
+        raise
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+        if tracer is not None:
+            tracer.end_span()
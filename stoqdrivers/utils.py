@@ -27,8 +27,38 @@
 Functions for general use.
 """
 
+import ctypes
+import ctypes.util
+import time
 import unicodedata
 
+# Number of bits sent on the wire for each byte: start, 8 data and stop
+BITS_PER_BYTE = 10
+
+# From <time.h>
+_CLOCK_MONOTONIC = 1
+_CLOCK_THREAD_CPUTIME_ID = 3
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long)]
+
+
+def _get_clock_gettime():
+    for name in ['rt', 'c']:
+        library = ctypes.util.find_library(name)
+        if library is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(library).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        return clock_gettime
+
+_clock_gettime = _get_clock_gettime()
+
 
 def encode_text(text, encoding):
     """ Converts the string 'text' to encoding 'encoding' and optionally
@@ -45,3 +75,55 @@ def encode_text(text, encoding):
     if encoding == "ascii":
         text = unicodedata.normalize("NFKD", text)
     return text.encode(encoding, "ignore")
+
+
+def _get_clock(clock_id, fallback):
+    if _clock_gettime is None:
+        return fallback()
+    spec = _timespec()
+    if _clock_gettime(clock_id, ctypes.byref(spec)) != 0:
+        return fallback()
+    return spec.tv_sec + spec.tv_nsec * 1e-9
+
+
+def monotonic():
+    """ Returns the seconds of a clock which is not affected by changes
+    of the system time, falling back to the system time when the platform
+    does not have such a clock.
+    """
+    return _get_clock(_CLOCK_MONOTONIC, time.time)
+
+
+def thread_time():
+    """ Returns the CPU seconds used by the calling thread, falling back
+    to the ones used by the whole process.
+    """
+    return _get_clock(_CLOCK_THREAD_CPUTIME_ID, time.clock)
+
+
+def wait_until(condition, timeout=None, interval=0.001, max_interval=0.05):
+    """ Calls 'condition' until it returns True, sleeping between the
+    calls for an interval which doubles up to 'max_interval', so that
+    long waits use almost no CPU.
+
+    @param condition:    a callable without arguments
+    @param timeout:      the seconds to wait, None to wait forever
+    @param interval:     the seconds to sleep after the first call
+    @param max_interval: the maximum seconds to sleep between calls
+    @returns:            True if the condition was met, False on timeout
+    """
+    if condition():
+        return True
+    if timeout is not None:
+        deadline = monotonic() + timeout
+    while True:
+        delay = interval
+        if timeout is not None:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return False
+            delay = min(delay, remaining)
+        time.sleep(delay)
+        if condition():
+            return True
+        interval = min(interval * 2, max_interval)
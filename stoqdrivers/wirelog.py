@@ -0,0 +1,199 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+"""
+Lazy, sampled and redacted logging of the bytes sent to the devices.
+
+Drivers log the frames they write and read like this::
+
+    if wirelog.is_enabled(log):
+        log.debug(">>> %s (%d bytes)", wirelog.frame(data), len(data))
+
+L{is_enabled} tells, without creating a log record, if a debug record of
+that logger would be emitted by any handler, so the frames cost almost
+nothing when debugging is off. The frame is only converted to text when
+the record is emitted, and the customer data registered with
+L{add_secret} is masked at that moment.
+
+L{set_sampling} restricts the logging to one coupon in N, the
+L{stoqdrivers.printers.fiscal.FiscalPrinter} marks the coupons with
+L{start_coupon} and L{end_coupon}; the frames sent outside of coupons
+are always logged unless the sampling is 0.
+"""
+
+import logging
+
+_sampling = 1
+_sampled = True
+_coupons = 0
+_in_coupon = False
+_secrets = []
+# logger name -> whether its debug records are emitted
+_loggers = {}
+
+
+class _Frame(object):
+    __slots__ = ['data']
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        data = self.data
+        for secret in _secrets:
+            if secret in data:
+                data = data.replace(secret, '*' * len(secret))
+        return repr(data)
+    __repr__ = __str__
+
+
+class _Redacted(object):
+    __slots__ = ['value']
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        if not self.value:
+            return repr(self.value)
+        return "'%s'" % ('*' * len(self.value), )
+    __repr__ = __str__
+
+
+def _is_emitted(logger):
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+    record = logger.makeRecord(logger.name, logging.DEBUG, __file__, 0,
+                               '', (), None)
+    if not logger.filter(record):
+        return False
+    while logger is not None:
+        for handler in logger.handlers:
+            if record.levelno >= handler.level and handler.filter(record):
+                return True
+        if not logger.propagate:
+            break
+        logger = logger.parent
+    return False
+
+
+def _update():
+    global _sampled
+    if not _sampling:
+        _sampled = False
+    elif _in_coupon:
+        _sampled = (_coupons - 1) % _sampling == 0
+    else:
+        _sampled = True
+
+
+def is_enabled(logger):
+    """ Returns if the frames logged with the logger are emitted
+
+    @param logger: the logger of the driver
+    """
+    if not _sampled:
+        return False
+    try:
+        return _loggers[logger.name]
+    except KeyError:
+        enabled = _loggers[logger.name] = _is_emitted(logger)
+        return enabled
+
+
+def update():
+    """ Must be called after the logging setup changes, like adding
+    handlers or changing the kiwi log levels.
+    """
+    _loggers.clear()
+
+
+def frame(data):
+    """ Returns an object which is formatted as the repr of the data, with
+    the secrets masked, when the log record is emitted.
+
+    @param data: the bytes written or read
+    """
+    return _Frame(data)
+
+
+def redacted(value):
+    """ Returns an object which is formatted as a masked string when the
+    log record is emitted.
+
+    @param value: a customer name, address or document
+    """
+    return _Redacted(value)
+
+
+def add_secret(value):
+    """ Masks the value in the frames logged until the coupon finishes.
+    Drivers often truncate or pad the customer data, so each of its words
+    is masked too.
+
+    @param value: the value, as sent to the device
+    """
+    for secret in [value] + value.split():
+        if len(secret) >= 3 and secret not in _secrets:
+            _secrets.append(secret)
+    # Mask the longest first so that it is found before its words are
+    _secrets.sort(key=len, reverse=True)
+
+
+def set_sampling(sampling):
+    """ Sets how many coupons there are for each one logged
+
+    @param sampling: 1 logs every coupon, N one coupon in N and 0 none
+    """
+    global _sampling
+    _sampling = sampling
+    _update()
+
+
+def get_sampling():
+    return _sampling
+
+
+def is_sampled():
+    """ Returns if the current coupon is logged """
+    return _sampled
+
+
+def start_coupon():
+    """ Marks the start of a coupon, deciding if its frames are logged.
+    Calling it again before L{end_coupon} does nothing.
+    """
+    global _coupons, _in_coupon
+    if _in_coupon:
+        return
+    _in_coupon = True
+    _coupons += 1
+    _update()
+
+
+def end_coupon():
+    """ Marks the end of a coupon, forgetting its secrets """
+    global _in_coupon
+    _in_coupon = False
+    del _secrets[:]
+    _update()
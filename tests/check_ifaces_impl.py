@@ -41,7 +41,7 @@ def _check_drivers(iface, brand, drivers):
     for driver in drivers:
         print "\t\t- %s\n" % driver.model_name,
         try:
-            verifyClass(iface, driver)
+            verifyClass(iface, driver.load())
         except Invalid, e:
             print "ERROR: ", e
 
@@ -0,0 +1,116 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+import unittest
+
+from stoqdrivers.emulator import PtyEmulator, get_protocol
+from stoqdrivers.emulator.base import PtySerialPort
+from stoqdrivers.exceptions import DriverError
+from stoqdrivers.printers.fiscal import FiscalPrinter
+
+
+class _CountingPort(PtySerialPort):
+    # Counts the writes, failing the first 'broken' ones
+    broken = 0
+    error = IOError
+
+    def __init__(self, device):
+        PtySerialPort.__init__(self, device)
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        if self.broken:
+            self.broken -= 1
+            raise self.error('Broken port')
+        PtySerialPort.write(self, data)
+
+
+class LazyConnectTest(unittest.TestCase):
+    def setUp(self):
+        # The setup of this driver reads the decimal places
+        self.emulator = PtyEmulator(get_protocol('epson', 'FBII'))
+        self.emulator.start()
+        self.port = _CountingPort(self.emulator.device)
+
+    def tearDown(self):
+        self.emulator.stop()
+
+    def _get_printer(self):
+        return FiscalPrinter(brand='epson', model='FBII', port=self.port,
+                             lazy=True)
+
+    def testConstruction(self):
+        printer = self._get_printer()
+        self.failIf(printer.is_connected())
+        self.assertEqual(self.port.writes, 0)
+        self.assertEqual(self.emulator.commands, 0)
+
+        # Nor it opens the port
+        printer = FiscalPrinter(brand='epson', model='FBII',
+                                device='/dev/stoqdrivers-missing', lazy=True)
+        self.failIf(printer.is_connected())
+
+    def testConnectOnce(self):
+        printer = self._get_printer()
+        capabilities = printer.get_capabilities()
+        self.failUnless(printer.is_connected())
+        driver = printer._driver
+        commands = self.emulator.commands
+        self.failUnless(commands > 0)
+        self.failUnless(printer.get_capabilities() is capabilities)
+        printer.connect()
+        self.failUnless(printer._driver is driver)
+        self.assertEqual(self.emulator.commands, commands)
+
+    def testFirstCommand(self):
+        printer = self._get_printer()
+        self.failIf(printer.has_open_coupon())
+        self.failUnless(printer.is_connected())
+
+    def testRetry(self):
+        printer = self._get_printer()
+        self.port.broken = 1
+        self.assertRaises(IOError, printer.connect)
+        self.failIf(printer.is_connected())
+        printer.connect()
+        self.failUnless(printer.is_connected())
+        self.failIf(printer.has_open_coupon())
+
+    def testIntrospection(self):
+        printer = self._get_printer()
+        self.assertEqual(printer.get_recorder(), None)
+        self.assertEqual(printer.get_breaker(), None)
+        self.assertEqual(printer.get_stats(), None)
+        self.failIf(printer.is_connected())
+        self.assertEqual(self.port.writes, 0)
+
+    def testErrorOnConnect(self):
+        printer = self._get_printer()
+        self.port.error = DriverError
+        self.port.broken = 1
+        self.assertRaises(DriverError, printer.has_open_coupon)
+        # Handling the error does not connect again
+        self.failIf(printer.is_connected())
+        self.assertEqual(self.port.writes, 1)
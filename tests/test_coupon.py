@@ -30,17 +30,15 @@ from decimal import Decimal
 import os
 import unittest
 
-from zope.interface import implements
-
-
 import stoqdrivers
+from stoqdrivers.emulator.capture import CapturePort, capture_to_transcript
+from stoqdrivers.emulator.replay import ReplayPort
 from stoqdrivers.enum import TaxType, UnitType
 from stoqdrivers.exceptions import (CouponOpenError,
                                     PendingReadX, PaymentAdditionError,
                                     AlreadyTotalized, CancelItemError,
                                     InvalidValue, CloseCouponError,
                                     CouponNotOpenError)
-from stoqdrivers.interfaces import ISerialPort
 from stoqdrivers.printers.fiscal import FiscalPrinter
 from stoqdrivers.serialbase import SerialPort
 
@@ -49,142 +47,11 @@ from stoqdrivers.serialbase import SerialPort
 RECORDER_DATA_DIR = "data"
 
 
-class LogSerialPort:
-    """ A decorator for the SerialPort object expected by the driver to test,
-    responsible for log all the bytes read/written.
-    """
-    implements(ISerialPort)
-
-    def __init__(self, port):
-        self._port = port
-        self._bytes = []
-        self._last = None
-        self._buffer = ''
-
-    def setDTR(self):
-        return self._port.setDTR()
-
-    def getDSR(self):
-        return self._port.getDSR()
-
-    def setParity(self, parity):
-        return self._port.setParity(parity)
-
-    def setTimeout(self, read_timeout):
-        return self._port.setTimeout(read_timeout)
-
-    def setWriteTimeout(self, write_timeout):
-        return self._port.setWriteTimeout(write_timeout)
-
-    def read(self, n_bytes=1):
-        data = self._port.read(n_bytes)
-        self._buffer += data
-        self._last = 'R'
-        return data
-
-    def write(self, bytes):
-        if self._last == 'R':
-            self._bytes.append(('R', self._buffer))
-            self._buffer = ''
-
-        self._bytes.append(('W', bytes))
-        self._port.write(bytes)
-        self._last = 'W'
-
-    def save(self, filename):
-        if self._buffer:
-            self._bytes.append(('R', self._buffer))
-        fd = open(filename, "w")
-        for type, line in self._bytes:
-            fd.write("%s %s\n" % (type, repr(line)[1:-1]))
-        fd.close()
-
-
-class PlaybackPort:
-    implements(ISerialPort)
-
-    def __init__(self, datafile):
-        self._input = []
-        self._output = ''
-        self._load_data(datafile)
-
-    def setDTR(self):
-        pass
-
-    def setBaudrate(self, baudrate):
-        pass
-
-    def setByteSize(self, bytesize):
-        pass
-
-    def setParity(self, parity):
-        pass
-
-    def setStopbits(self, stopbits):
-        pass
-
-    def setTimeout(self, read_timeout):
-        pass
-
-    def setWriteTimeout(self, write_timeout):
-        pass
-
-    def getDSR(self):
-        return True
-
-    def write(self, bytes):
-        n_bytes = len(bytes)
-        data = "".join([self._input.pop(0) for i in xrange(n_bytes)])
-        if bytes != data:
-            raise ValueError("Written data differs from the expected:\n"
-                             "WROTE:    %r\n"
-                             "RECORDED: %r\n" % (data, bytes))
-
-    def read(self, n_bytes=1):
-        data = self._output[:n_bytes]
-        if not data:
-            return None
-        self._output = self._output[n_bytes:]
-        return data
-
-    def _convert_data(self, data):
-        data = data.replace('\\n', '\n')
-        data = data.replace('\\r', '\r')
-        data = data.replace('\\t', '\t')
-        data = data.replace('\\\\', '\\')
-        data = data.split('\\x')
-        if len(data) == 1:
-            data = data[0]
-        else:
-            n = ''
-            for p in data:
-                if len(p) <= 1:
-                    n += p
-                else:
-                    try:
-                        data = p[:2].decode('hex')
-                    except:
-                        data = p[:2]
-                    n += data + p[2:]
-            data = n
-        return data
-
-    def _load_data(self, datafile):
-        fd = open(datafile, "r")
-        for n, line in enumerate(fd.readlines()):
-            data = self._convert_data(line[2:-1])
-
-            if line.startswith("W"):
-                self._input.extend(data)
-            elif line.startswith("R"):
-                self._output += data
-            else:
-                raise TypeError("Unrecognized entry type at %s:%d: %r"
-                                % (datafile, n + 1, line[0]))
-        fd.close()
-
-
 class _BaseTest(unittest.TestCase):
+    # The recorded transcripts are independent, so nose can replay them
+    # in several processes
+    _multiprocess_can_split_ = True
+
     def __init__(self, test_name):
         self._test_name = test_name
         unittest.TestCase.__init__(self, test_name)
@@ -192,7 +59,8 @@ class _BaseTest(unittest.TestCase):
     def tearDown(self):
         filename = self._get_recorder_filename()
         if not os.path.exists(filename):
-            self._port.save(filename)
+            self._port.close()
+            capture_to_transcript(self._get_capture_filename(), filename)
 
     def setUp(self):
         filename = self._get_recorder_filename()
@@ -201,9 +69,10 @@ class _BaseTest(unittest.TestCase):
             # fiscal printer when recreating the tests.
             real_port = SerialPort('/tmp/stoq-ecf')
             real_port.setBaudrate(9600)
-            self._port = LogSerialPort(real_port)
+            self._port = CapturePort(real_port,
+                                     self._get_capture_filename())
         else:
-            self._port = PlaybackPort(filename)
+            self._port = ReplayPort(filename)
 
         self._device = self.device_class(brand=self.brand,
                                          model=self.model,
@@ -224,6 +93,10 @@ class _BaseTest(unittest.TestCase):
         filename = "%s-%s-%s.txt" % (self.brand, self.model, test_name)
         return os.path.join(testdir, RECORDER_DATA_DIR, filename)
 
+    def _get_capture_filename(self):
+        # The capture keeps the timing of the recording, for profiling
+        return os.path.splitext(self._get_recorder_filename())[0] + '.cap'
+
 
 class _TestCoupon(object):
     """ Test a coupon creation """
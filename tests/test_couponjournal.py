@@ -0,0 +1,171 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+from decimal import Decimal
+import os
+import tempfile
+import unittest
+
+from stoqdrivers.couponjournal import (ADDING, CANCEL_ITEM, ITEM, OPEN,
+                                       PAYMENT, TOTALIZE, CouponJournal)
+from stoqdrivers.emulator import PtyEmulator, get_protocol
+from stoqdrivers.enum import TaxType, UnitType
+from stoqdrivers.printers.fiscal import FiscalPrinter
+
+
+class CouponJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.filename = tempfile.mktemp()
+        self.journal = CouponJournal(self.filename)
+
+    def tearDown(self):
+        self.journal.close()
+        os.unlink(self.filename)
+
+    def _add(self, price):
+        self.journal.adding_item(u'1', u'Item', price, 'FF', Decimal('1'),
+                                 UnitType.EMPTY, Decimal('0'), Decimal('0'),
+                                 u'')
+
+    def testOperations(self):
+        journal = self.journal
+        journal.open_coupon()
+        self._add(Decimal('10'))
+        journal.add_item(1)
+        # Refused by the printer
+        self._add(Decimal('5'))
+        self._add(Decimal('7'))
+        journal.add_item(2)
+        journal.cancel_item(1)
+        journal.totalize(Decimal('7'))
+        journal.add_payment('01', Decimal('7'))
+        journal.close()
+        operations = CouponJournal(self.filename).get_operations()
+        self.assertEqual([op[:3] for op in operations], [
+            (OPEN, ), (ITEM, 1, u'1'), (ITEM, 2, u'1'), (CANCEL_ITEM, 1),
+            (TOTALIZE, Decimal('7')), (PAYMENT, '01', Decimal('7'))])
+        self.assertEqual(operations[2][4], Decimal('7'))
+
+    def testTornRecord(self):
+        self.journal.open_coupon()
+        self._add(Decimal('10'))
+        self.journal.close()
+        fp = open(self.filename, 'a')
+        fp.write('["item", ')
+        fp.close()
+        operations = self.journal.get_operations()
+        self.assertEqual([op[0] for op in operations], [OPEN, ADDING])
+        self.journal.clear()
+        self.assertEqual(self.journal.get_operations(), [])
+
+    def testRecordAfterTornRecord(self):
+        self.journal.open_coupon()
+        self._add(Decimal('10'))
+        self.journal.close()
+        fp = open(self.filename, 'a')
+        fp.write('["item", ')
+        fp.close()
+        # Continued by another process, after the crash
+        journal = CouponJournal(self.filename)
+        journal.add_item(1)
+        journal.totalize(Decimal('10'))
+        journal.close()
+        operations = CouponJournal(self.filename).get_operations()
+        self.assertEqual([op[:2] for op in operations], [
+            (OPEN, ), (ITEM, 1), (TOTALIZE, Decimal('10'))])
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.emulator = PtyEmulator(get_protocol('bematech', 'MP25'))
+        self.emulator.start()
+        self.filename = tempfile.mktemp()
+
+    def tearDown(self):
+        self.emulator.stop()
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+    def _get_printer(self):
+        printer = FiscalPrinter(brand='bematech', model='MP25',
+                                port=self.emulator.open_port())
+        printer.set_coupon_journal(CouponJournal(self.filename))
+        return printer
+
+    def testResume(self):
+        printer = self._get_printer()
+        taxcode = printer.get_tax_constant(TaxType.NONE)
+        payment = printer.get_payment_constants()[0][0]
+        printer.open()
+        printer.add_item(u'1', u'Item', Decimal('10'), taxcode)
+        printer.totalize()
+        printer.add_payment(payment, Decimal('4'))
+        # The process dies while adding a payment
+        printer.get_coupon_journal().close()
+
+        printer = self._get_printer()
+        operations = printer.resume_coupon()
+        self.assertEqual([op[0] for op in operations],
+                         [OPEN, ITEM, TOTALIZE, PAYMENT])
+        printer.add_payment(payment, Decimal('6'))
+        self.assertEqual(printer.close(), 1)
+        self.assertEqual(printer.resume_coupon(), None)
+
+    def testResumeAddingItem(self):
+        printer = self._get_printer()
+        taxcode = printer.get_tax_constant(TaxType.NONE)
+        printer.open()
+        printer.add_item(u'1', u'Item', Decimal('10'), taxcode)
+        # The item reached the printer, but not the journal
+        journal = printer.get_coupon_journal()
+        journal.adding_item(u'2', u'Other', Decimal('5'), taxcode,
+                            Decimal('1'), UnitType.EMPTY, Decimal('0'),
+                            Decimal('0'), u'')
+        printer.set_coupon_journal(None)
+        printer.add_item(u'2', u'Other', Decimal('5'), taxcode)
+        journal.close()
+
+        printer = self._get_printer()
+        operations = printer.resume_coupon()
+        self.assertEqual([op[:3] for op in operations],
+                         [(OPEN, ), (ITEM, 1, u'1'), (ITEM, 2, u'2')])
+
+        # This one did not reach the printer
+        journal = printer.get_coupon_journal()
+        journal.adding_item(u'3', u'Last', Decimal('1'), taxcode,
+                            Decimal('1'), UnitType.EMPTY, Decimal('0'),
+                            Decimal('0'), u'')
+        journal.close()
+        printer = self._get_printer()
+        operations = printer.resume_coupon()
+        self.assertEqual([op[:3] for op in operations],
+                         [(OPEN, ), (ITEM, 1, u'1'), (ITEM, 2, u'2')])
+        self.assertEqual(printer.totalize(), Decimal('15'))
+
+    def testNothingToResume(self):
+        printer = self._get_printer()
+        self.assertEqual(printer.resume_coupon(), None)
+        printer.open()
+        printer.cancel()
+        self.assertEqual(printer.resume_coupon(), None)
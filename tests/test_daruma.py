@@ -0,0 +1,59 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+import unittest
+
+from stoqdrivers.emulator import PtyEmulator, get_protocol
+from stoqdrivers.exceptions import HardwareFailure
+from stoqdrivers.printers.daruma.FS345 import FS345, FS345Status
+
+
+class StatusTest(unittest.TestCase):
+    def testDecode(self):
+        status = FS345Status(':A5C60C010000', taken=0)
+        self.failIf(status.pending_reduce_z)
+        self.failUnless(status.coupon_open)
+        self.failIf(status.needs_read_x)
+        self.assertRaises(AttributeError, setattr, status,
+                          'coupon_open', True)
+        self.assertRaises(HardwareFailure, FS345Status, 'E99')
+
+    def testSingleQuery(self):
+        emulator = PtyEmulator(get_protocol('daruma', 'FS345'))
+        emulator.start()
+        try:
+            printer = FS345(emulator.open_port())
+            commands = emulator.commands
+            status = printer.get_status()
+            printer.has_pending_reduce()
+            printer.needs_read_x()
+            self.failUnless(printer.get_status() is status)
+            self.assertEqual(emulator.commands, commands + 1)
+            printer.get_status(max_age=0)
+            self.assertEqual(emulator.commands, commands + 2)
+            # Any command sent invalidates the snapshot
+            printer.get_serial()
+            self.failIf(printer.get_status() is status)
+        finally:
+            emulator.stop()
@@ -0,0 +1,326 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+import datetime
+from decimal import Decimal
+import os
+import tempfile
+import time
+import unittest
+
+from stoqdrivers.emulator import (EmulatorError, FiscalState, PtyEmulator,
+                                  ReplayMismatch, ReplayPort, get_protocol,
+                                  get_protocols)
+from stoqdrivers.emulator.base import BaseProtocol
+from stoqdrivers.emulator.capture import (CaptureWriter, CapturePort,
+                                          TimedReplayPort, read_capture,
+                                          capture_to_transcript,
+                                          transcript_to_capture)
+from stoqdrivers.enum import PaymentMethodType, TaxType
+from stoqdrivers.exceptions import CancelItemError
+from stoqdrivers.printers.dataregis.EP375 import EP375
+from stoqdrivers.printers.fiscal import FiscalPrinter
+
+
+def _get_data(filename):
+    return os.path.join(os.path.dirname(__file__), 'data', filename)
+
+
+class FiscalStateTest(unittest.TestCase):
+    def testCoupon(self):
+        state = FiscalState()
+        state.open_coupon()
+        self.assertRaises(EmulatorError, state.open_coupon)
+        state.add_item(Decimal('10'), Decimal('2'))
+        state.add_item(Decimal('5'))
+        state.cancel_item(2)
+        self.assertRaises(EmulatorError, state.cancel_item, 2)
+        self.assertEqual(state.totalize(discount=Decimal('1')),
+                         Decimal('19'))
+        self.assertEqual(state.add_payment(Decimal('10')), Decimal('9'))
+        self.assertRaises(EmulatorError, state.close_coupon)
+        self.assertEqual(state.add_payment(Decimal('10')), Decimal('0'))
+        self.assertEqual(state.close_coupon(), 1)
+        self.assertEqual(state.period_total, Decimal('19'))
+
+    def testReduceZ(self):
+        state = FiscalState()
+        state.open_coupon()
+        state.add_item(Decimal('10'))
+        state.totalize()
+        state.add_payment(Decimal('10'))
+        state.close_coupon()
+        state.reduce_z()
+        self.assertEqual((state.coo, state.crz), (2, 1))
+        self.assertEqual(state.grand_total, Decimal('10'))
+        self.assertEqual(state.period_total, Decimal('0'))
+        self.assertEqual([d['type'] for d in state.get_documents()],
+                         ['coupon', 'Z'])
+
+
+class _EchoProtocol(BaseProtocol):
+    name = 'echo'
+
+    def extract(self, data):
+        if '\n' not in data:
+            return None, data
+        request, rest = data.split('\n', 1)
+        return request, rest
+
+    def process(self, request):
+        return request, request.upper() + '\n'
+
+
+class PtyEmulatorTest(unittest.TestCase):
+    def testFeed(self):
+        protocol = _EchoProtocol()
+        self.assertEqual(protocol.feed('ab'), [])
+        self.assertEqual(protocol.feed('c\nd\n'),
+                         [('abc', 'abc', 'ABC\n'), ('d', 'd', 'D\n')])
+
+    def testWireTime(self):
+        emulator = PtyEmulator(_EchoProtocol(), baudrate=9600)
+        self.assertEqual(emulator.get_wire_time(960), 1)
+        self.assertEqual(PtyEmulator(_EchoProtocol()).get_wire_time(960), 0)
+
+    def testLatency(self):
+        emulator = PtyEmulator(_EchoProtocol(),
+                               latency={None: 0, 'slow': 0.2})
+        emulator.start()
+        try:
+            port = emulator.open_port()
+            start = time.time()
+            port.write('fast\n')
+            self.assertEqual(port.readline(), 'FAST\n')
+            self.failUnless(time.time() - start < 0.2)
+            port.write('slow\n')
+            self.assertEqual(port.readline(), 'SLOW\n')
+            self.failUnless(time.time() - start >= 0.2)
+            port.close()
+        finally:
+            emulator.stop()
+        self.assertEqual(emulator.commands, 2)
+
+
+class ReplayPortTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.write(fd, "W \\x1b\\x00ab\n"
+                     "R \\x06\\r\n"
+                     "W cd\\\\\n"
+                     "R ok\n")
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def testReplay(self):
+        port = ReplayPort(self.filename)
+        port.write('\x1b\x00')
+        port.write('abc')
+        self.assertEqual(port.read(3), '\x06\ro')
+        self.failIf(port.is_done())
+        port.write('d\\')
+        self.assertEqual(port.read(5), 'k')
+        self.assertEqual(port.read(), None)
+        self.failUnless(port.is_done())
+
+    def testMismatch(self):
+        port = ReplayPort(self.filename)
+        port.write('\x1b\x00ab')
+        try:
+            port.write('cx')
+        except ReplayMismatch, e:
+            self.assertEqual((e.offset, e.lineno), (5, 3))
+        else:
+            self.fail('ReplayMismatch not raised')
+
+
+class _ClosingPort(ReplayPort):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def testCapturePort(self):
+        port = CapturePort(
+            _ClosingPort(_get_data('epson-FBIII-summarize.txt')),
+            self.filename)
+        port.write('\x02')
+        self.assertEqual(port.read(2), '\x06\x02')
+        port.close()
+        records = list(read_capture(self.filename))
+        self.assertEqual([(d, data) for d, t, data in records],
+                         [('W', '\x02'), ('R', '\x06\x02')])
+        self.failUnless(0 <= records[0][1] <= records[1][1])
+        self.failUnless(port.closed)
+
+        # An interrupted record is ignored
+        fp = open(self.filename, 'ab')
+        fp.write('W\x00')
+        fp.close()
+        self.assertEqual(len(list(read_capture(self.filename))), 2)
+
+    def testConvert(self):
+        transcript = _get_data('epson-FBIII-summarize.txt')
+        transcript_to_capture(transcript, self.filename)
+        capture_to_transcript(self.filename, self.filename + '.txt')
+        try:
+            self.assertEqual(open(self.filename + '.txt').read(),
+                             open(transcript).read())
+        finally:
+            os.unlink(self.filename + '.txt')
+
+    def testTimedReplay(self):
+        writer = CaptureWriter(self.filename)
+        writer.record('W', 'ping', 1.0)
+        writer.record('R', 'po', 1.2)
+        writer.record('R', 'ng', 1.4)
+        writer.close()
+        port = TimedReplayPort(self.filename, speed=2)
+        start = time.time()
+        port.write('ping')
+        self.assertEqual(port.read(4), 'po')
+        self.failUnless(0.09 < time.time() - start < 0.15)
+        self.assertEqual(port.read(4), 'ng')
+        self.failUnless(0.19 < time.time() - start < 0.25)
+        self.assertEqual(port.read(4), None)
+
+
+class EmulatedPrinterTest(unittest.TestCase):
+    def setUp(self):
+        self.emulators = []
+
+    def tearDown(self):
+        for emulator in self.emulators:
+            emulator.stop()
+
+    def _start(self, brand, model):
+        emulator = PtyEmulator(get_protocol(brand, model))
+        emulator.start()
+        self.emulators.append(emulator)
+        return emulator
+
+    def _sell(self, brand, model):
+        emulator = self._start(brand, model)
+        printer = FiscalPrinter(brand=brand, model=model,
+                                port=emulator.open_port())
+        taxcode = printer.get_tax_constant(TaxType.NONE)
+        payment = printer.get_payment_constants()[0][0]
+        self.failIf(printer.has_open_coupon())
+        printer.open()
+        printer.add_item(u'123', u'Item one', Decimal('10'), taxcode)
+        printer.add_item(u'124', u'Item two', Decimal('5'), taxcode,
+                         items_quantity=Decimal('2'))
+        self.assertEqual(printer.totalize(), Decimal('20'))
+        self.assertEqual(printer.add_payment(payment, Decimal('20')), 0)
+        self.assertEqual(printer.close(), 1)
+        printer.till_add_cash(Decimal('10'))
+        printer.close_till()
+        self.assertEqual(printer.get_crz(), 1)
+        state = emulator.protocol.state
+        self.assertEqual(state.grand_total, Decimal('20'))
+        self.assertEqual([d['type'] for d in state.get_documents()],
+                         ['coupon', 'non-fiscal', 'Z'])
+        return printer
+
+    def testSale(self):
+        for brand, model in get_protocols():
+            if brand == 'dataregis':
+                continue
+            self._sell(brand, model)
+
+    def testIterMemory(self):
+        printer = self._sell('bematech', 'MP25')
+        today = datetime.date.today()
+        progress = []
+        lines = printer.till_iter_memory(today, today, progress.append)
+        # Nothing is read until it is asked for
+        self.assertEqual(progress, [])
+        line = u'CRZ: 0001 COO: 000003 %s VENDA BRUTA: 20.00' % (
+            today.strftime('%d/%m/%Y'))
+        self.assertEqual(list(lines), [line])
+        self.assertEqual(progress, [len(line)])
+
+        filename = tempfile.mktemp()
+        try:
+            self.assertEqual(
+                printer.till_read_memory_to_file(today, today, filename),
+                len(line))
+            self.assertEqual(open(filename).read(), line)
+        finally:
+            os.unlink(filename)
+
+    def testCloseIterMemory(self):
+        printer = self._sell('bematech', 'MP25')
+        printer.till_add_cash(Decimal('10'))
+        printer.close_till()
+        today = datetime.date.today()
+        lines = printer.till_iter_memory(today, today)
+        self.failUnless(lines.next().startswith(u'CRZ: 0001'))
+        lines.close()
+        # The rest of the report is not taken as the next reply
+        self.assertEqual(printer.get_crz(), 2)
+
+    def testTransactions(self):
+        printer = self._sell('bematech', 'MP4000')
+        today = datetime.datetime.today()
+        data = printer._driver._get_transactions(today, today)
+        self.assertEqual(len(data['invoices']), 1)
+        self.assertEqual(data['invoices'][0]['COO'], '000001')
+
+    def testSintegra(self):
+        for model in ['MP25', 'MP4000']:
+            printer = self._sell('bematech', model)
+            sintegra = printer.get_sintegra()
+            self.assertEqual(sintegra.total, Decimal('20'))
+            self.assertEqual(sintegra.crz, 1)
+
+    def testEP375(self):
+        emulator = self._start('dataregis', 'EP375')
+        driver = EP375(emulator.open_port(), None)
+        driver.coupon_open()
+        driver.coupon_add_item('123', 'Item one', Decimal('10'), '04')
+        item_id = driver.coupon_add_item('124', 'Item two', Decimal('7'),
+                                         '04', quantity=Decimal('2'))
+        driver.coupon_cancel_item(item_id)
+        self.assertRaises(CancelItemError, driver.coupon_cancel_item,
+                          item_id)
+        self.assertEqual(driver.coupon_totalize(), Decimal('10'))
+        self.assertEqual(driver.coupon_add_payment(PaymentMethodType.MONEY,
+                                                   Decimal('10')), 0)
+        self.assertEqual(driver.coupon_close(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+import unittest
+
+from stoqdrivers.exceptions import InvalidReply
+from stoqdrivers.printers.dataregis.EP375 import EP375, MAX_RETRANSMISSIONS
+from stoqdrivers.serialbase import VirtualPort
+
+
+def _pack(counter, command, params, last):
+    data = '%s%c%s' % (command, len(params), params)
+    checksum = chr(sum([ord(c) for c in data]) & 0xff)
+    return ('\xfe' + chr(counter) + data + checksum +
+            (last and '\x1a' or '') + '\r')
+
+
+class _ScriptedPort(VirtualPort):
+    def __init__(self, data):
+        self.data = data
+        self.written = ''
+
+    def setDTR(self, value=True):
+        pass
+
+    def write(self, data):
+        self.written += data
+
+    def read(self, n_bytes=1):
+        data, self.data = self.data[:n_bytes], self.data[n_bytes:]
+        return data
+
+
+class EP375ReplyTest(unittest.TestCase):
+    def _get_printer(self, data):
+        return EP375(_ScriptedPort(data), None)
+
+    def testLongReply(self):
+        # Deeper than the recursion limit of the old parser
+        packages = ['\x08\r']
+        for i in range(3000):
+            packages.append(_pack(0x20, 'o', '%06d' % i, i == 2999))
+        printer = self._get_printer(''.join(packages))
+        reply = printer._parse_reply(printer.readline())
+        self.assertEqual(reply, ''.join(['%06d' % i for i in range(3000)]))
+
+    def testEmptyReply(self):
+        printer = self._get_printer('\x04\r')
+        self.assertEqual(printer._parse_reply(printer.readline()), '')
+
+    def testBrokenPackage(self):
+        printer = self._get_printer('\x08\r' + '\xfe o\x09abc\r' * 10)
+        self.assertRaises(InvalidReply, printer._parse_reply,
+                          printer.readline())
+        self.assertEqual(printer.get_port().written,
+                         '\x06' * MAX_RETRANSMISSIONS)
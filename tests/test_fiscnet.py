@@ -0,0 +1,207 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+import datetime
+from decimal import Decimal
+import random
+import re
+import unittest
+
+from stoqdrivers.emulator import PtyEmulator, get_protocol
+from stoqdrivers.exceptions import InvalidReply, InvalidState
+from stoqdrivers.printers.fiscnet.FiscNetECF import (_iter_return_values,
+                                                    _ReturnValues,
+                                                    FiscNetECF,
+                                                    PIPELINE_DEPTH)
+from stoqdrivers.serialbase import VirtualPort
+
+_TOKEN_RE = re.compile(r"^\s*([^=\s;]+)")
+_QUOTED_VALUE_RE = re.compile(r"^\s*=\s*\"([^\"\\]*(?:\\.[^\"\\]*)*)\"")
+_VALUE_RE = re.compile(r"^\s*=\s*([^\s;]*)")
+_ESCAPE_RE = re.compile(r"\\(.)")
+
+
+def _parse_return_value(text):
+    # The parser used before, based on cookielib.split_header_words
+    def unmatched(match):
+        start, end = match.span(0)
+        return match.string[:start] + match.string[end:]
+
+    result = {}
+    while text:
+        m = _TOKEN_RE.search(text)
+        if m:
+            text = unmatched(m)
+            name = m.group(1)
+            m = _QUOTED_VALUE_RE.search(text)
+            if m:
+                text = unmatched(m)
+                value = _ESCAPE_RE.sub(r"\1", m.group(1))
+            else:
+                m = _VALUE_RE.search(text)
+                if m:
+                    text = unmatched(m)
+                    value = m.group(1).rstrip()
+                else:
+                    value = None
+            result[name] = value
+        else:
+            raise AssertionError
+    return result
+
+
+def _parse(text):
+    try:
+        return dict(_iter_return_values(text))
+    except AssertionError:
+        return AssertionError
+
+
+def _parse_reference(text):
+    try:
+        return _parse_return_value(text)
+    except AssertionError:
+        return AssertionError
+
+
+class ReturnValueTest(unittest.TestCase):
+    def testParse(self):
+        text = ('ValorInteiro=12 NomeTexto="a \\"b\\" c" '
+                'ValorMoeda=1.234,56 Lone')
+        self.assertEqual(list(_iter_return_values(text)),
+                         [('ValorInteiro', '12'),
+                          ('NomeTexto', 'a "b" c'),
+                          ('ValorMoeda', '1.234,56'),
+                          ('Lone', None)])
+        self.assertRaises(AssertionError, list,
+                          _iter_return_values('a=1;'))
+
+    def testTypes(self):
+        values = _ReturnValues(_iter_return_values(
+            'I=42 M=1.234,56 D=#29/03/2007# Z=#00/00/0000# T="x" B=1'))
+        self.assertEqual(values.get_int('I'), 42)
+        self.assertEqual(values.get_decimal('M'), Decimal('1234.56'))
+        self.assertEqual(values.get_date('D'), datetime.date(2007, 3, 29))
+        self.assertEqual(values.get_date('Z'), datetime.date.today())
+        self.assertEqual(values.get_text('T'), 'x')
+        self.assertEqual(values.get_bool('B'), True)
+
+    def testFuzz(self):
+        rand = random.Random(1138)
+        alphabet = 'ab1,#/=;"\\ \t\n'
+        for i in range(5000):
+            text = ''.join([rand.choice(alphabet)
+                            for j in range(rand.randint(0, 24))])
+            self.assertEqual(_parse(text), _parse_reference(text),
+                             'mismatch for %r' % (text,))
+
+    def testFuzzValues(self):
+        # Well formed replies, which are the common case
+        rand = random.Random(42)
+        for i in range(500):
+            pairs = []
+            for j in range(rand.randint(1, 10)):
+                value = ''.join([rand.choice('ab1,"\\ ')
+                                 for k in range(rand.randint(0, 8))])
+                value = value.replace('\\', '\\\\').replace('"', '\\"')
+                pairs.append('N%d="%s"' % (j, value))
+            text = ' '.join(pairs)
+            self.assertEqual(_parse(text), _parse_reference(text))
+
+
+class _PipelinePort(VirtualPort):
+    # Replies to the register reads only once all the requests in
+    # flight were written
+    def __init__(self, replies=''):
+        self.requests = []
+        self.in_flight = []
+        self.replies = replies
+
+    def setParity(self, parity):
+        pass
+
+    def setWriteTimeout(self, timeout):
+        pass
+
+    def write(self, data):
+        command_id = data[1:].split(';')[0]
+        self.requests.append(command_id)
+        self.in_flight.append(command_id)
+
+    def read(self, n_bytes=1):
+        if not self.replies:
+            for command_id in self.in_flight:
+                self.replies += '{%s;0;ValorInteiro=%s;}' % (command_id,
+                                                            command_id)
+            self.in_flight = []
+        data, self.replies = self.replies[:n_bytes], self.replies[n_bytes:]
+        return data
+
+
+class RegisterBatchTest(unittest.TestCase):
+    def testPipeline(self):
+        port = _PipelinePort()
+        driver = FiscNetECF(port)
+        values = driver._read_registers([('R%d' % i, int)
+                                         for i in range(20)])
+        self.assertEqual(values, range(1, 21))
+        self.assertEqual(len(port.requests), 20)
+        # The first requests were all sent before any reply was read
+        self.assertEqual(port.requests[:PIPELINE_DEPTH],
+                         [str(i) for i in range(1, PIPELINE_DEPTH + 1)])
+
+    def testUnknownReply(self):
+        port = _PipelinePort('{99;0;ValorInteiro=99;}')
+        driver = FiscNetECF(port)
+        self.assertRaises(InvalidReply, driver._read_registers,
+                          [('R%d' % i, int) for i in range(20)])
+        # The replies in flight were read, and no more requests sent
+        self.assertEqual(port.requests,
+                         [str(i) for i in range(1, PIPELINE_DEPTH + 1)])
+        self.assertEqual(port.replies, '')
+        # The reply to command 0 is the one read
+        self.assertEqual(driver._read_register('R', int), 0)
+
+    def testEmulator(self):
+        emulator = PtyEmulator(get_protocol('fiscnet', 'FiscNetECF'))
+        emulator.start()
+        try:
+            driver = FiscNetECF(emulator.open_port())
+            registers = [('COO', int), ('GT', Decimal),
+                         ('DataAbertura', datetime.date),
+                         ('NumeroSerieECF', str), ('DocumentoAberto', bool)]
+            self.assertEqual(driver._read_registers(registers),
+                             [driver._read_register(name, regtype)
+                              for name, regtype in registers])
+
+            # The replies to the commands sent after the failed one are
+            # read, so the next command gets its own reply
+            registers.insert(1, ('Foo', int))
+            commands = emulator.commands
+            self.assertRaises(InvalidState, driver._read_registers,
+                              registers)
+            self.assertEqual(emulator.commands, commands + 6)
+            self.assertEqual(driver._read_register('COO', int), 0)
+        finally:
+            emulator.stop()
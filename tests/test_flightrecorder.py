@@ -0,0 +1,98 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+import os
+import tempfile
+import unittest
+
+from stoqdrivers.emulator import PtyEmulator, get_protocol
+from stoqdrivers.emulator.capture import read_capture
+from stoqdrivers.exceptions import DriverError
+from stoqdrivers.flightrecorder import FlightRecorder, READ, WRITE
+from stoqdrivers.printers.fiscal import FiscalPrinter
+from stoqdrivers.serialbase import SerialBase, VirtualPort
+
+
+class FlightRecorderTest(unittest.TestCase):
+    def testRing(self):
+        recorder = FlightRecorder(size=3)
+        self.assertEqual(recorder.get_frames(), [])
+        recorder.record(WRITE, 'a')
+        recorder.record(READ, 'b')
+        recorder.record(READ, 'c')
+        self.assertEqual([(d, data) for d, t, data in recorder.get_frames()],
+                         [(WRITE, 'a'), (READ, 'bc')])
+        for data in ['d', 'e', 'f']:
+            recorder.record(WRITE, data)
+            recorder.record(READ, data.upper())
+        frames = recorder.get_frames()
+        self.assertEqual([(d, data) for d, t, data in frames],
+                         [(READ, 'E'), (WRITE, 'f'), (READ, 'F')])
+        self.failUnless(frames[0][1] <= frames[1][1] <= frames[2][1])
+        recorder.clear()
+        self.assertEqual(recorder.get_frames(), [])
+
+    def testDump(self):
+        recorder = FlightRecorder()
+        recorder.record(WRITE, 'abc')
+        recorder.record(READ, 'de')
+        filename = tempfile.mktemp()
+        try:
+            recorder.dump(filename)
+            records = list(read_capture(filename))
+        finally:
+            os.unlink(filename)
+        self.assertEqual([(d, data) for d, t, data in records],
+                         [(WRITE, 'abc'), (READ, 'de')])
+        self.assertEqual(records[0][1], 0)
+
+    def testTimeout(self):
+        driver = SerialBase(VirtualPort())
+        try:
+            driver.writeline('X')
+        except DriverError, e:
+            self.assertEqual([(d, data) for d, t, data in e.frames],
+                             [(WRITE, '\x1bX')])
+        else:
+            self.fail('DriverError not raised')
+
+    def testPrinterError(self):
+        emulator = PtyEmulator(get_protocol('bematech', 'MP25'))
+        emulator.start()
+        try:
+            printer = FiscalPrinter(brand='bematech', model='MP25',
+                                    port=emulator.open_port())
+            printer.get_recorder().clear()
+            try:
+                printer.open()
+                printer.cancel_item(99)
+            except DriverError, e:
+                frames = e.frames
+            else:
+                self.fail('DriverError not raised')
+        finally:
+            emulator.stop()
+        self.failUnless(frames)
+        self.assertEqual(frames[0][0], WRITE)
+        self.assertEqual(frames[-1][0], READ)
@@ -0,0 +1,251 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+import os
+import time
+import unittest
+
+from stoqdrivers.emulator import PtyEmulator, get_protocol
+from stoqdrivers.emulator.base import PtySerialPort
+from stoqdrivers.exceptions import DriverError, PrinterOfflineError
+from stoqdrivers.health import (BusyWindow, CircuitBreaker, CLOSED, OPEN,
+                                HALF_OPEN)
+from stoqdrivers.printers.daruma.FS2100 import FS2100
+from stoqdrivers.printers.dataregis.EP375 import EP375
+from stoqdrivers.printers.fiscal import FiscalPrinter
+from stoqdrivers.serialbase import SerialBase, VirtualPort
+from stoqdrivers.stats import instrumented
+from stoqdrivers.utils import monotonic, thread_time
+
+
+class _OfflinePort(VirtualPort):
+    def __init__(self):
+        self.written = ''
+
+    def getDSR(self):
+        return False
+
+    def write(self, data):
+        self.written += data
+
+
+class _BusyPort(PtySerialPort):
+    # Sets DSR once 'busy' seconds passed since it was opened
+    busy = None
+
+    def __init__(self, device, busy=None):
+        PtySerialPort.__init__(self, device)
+        self.busy = busy
+        self.opened = time.time()
+
+    def getDSR(self):
+        return (self.busy is not None and
+                time.time() - self.opened >= self.busy)
+
+
+class _Driver(SerialBase):
+    @instrumented()
+    def send_command(self, command):
+        return self.writeline(command)
+
+    def _probe(self):
+        self.send_command('S')
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def testStates(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=60)
+        self.assertEqual(breaker.get_state(), CLOSED)
+        breaker.add_failure()
+        self.failUnless(breaker.allow())
+        breaker.add_failure()
+        self.assertEqual(breaker.get_state(), OPEN)
+        self.failIf(breaker.allow())
+        self.failUnless(0 < breaker.get_remaining() <= 60)
+        breaker.add_success()
+        self.assertEqual(breaker.get_state(), CLOSED)
+        self.assertEqual(breaker.get_failures(), 0)
+
+    def testHalfOpen(self):
+        breaker = CircuitBreaker(threshold=1, cooldown=0)
+        breaker.add_failure()
+        self.assertEqual(breaker.get_state(), HALF_OPEN)
+        self.failUnless(breaker.allow())
+        # A timeout while trying again opens it at once
+        breaker.cooldown = 60
+        breaker.add_failure()
+        self.failIf(breaker.allow())
+
+
+class BusyWindowTest(unittest.TestCase):
+    def testDelay(self):
+        busy = BusyWindow(estimate=1.0, interval=0.05)
+        self.failIf(busy.is_busy())
+        self.assertEqual(busy.get_busy_until(), None)
+        busy.add_busy()
+        self.failUnless(0.9 < busy.get_busy_until() - monotonic() <= 1.0)
+        self.assertEqual(busy.get_delay(0), 0.05)
+        self.assertEqual(busy.get_delay(2), 0.2)
+        # Never past the expected end
+        self.failUnless(0.9 < busy.get_delay(10) <= 1.0)
+        self.failUnless(0.9 < busy.get_delay(0, urgent=False) <= 1.0)
+
+    def testLearn(self):
+        busy = BusyWindow(estimate=1.0, weight=0.5)
+        busy.add_busy()
+        busy.add_ready()
+        self.failIf(busy.is_busy())
+        self.failUnless(0.5 <= busy.estimate < 0.51)
+        # Once the estimate is over the retries back off as usual
+        busy.estimate = 0
+        busy.add_busy()
+        self.assertEqual(busy.get_delay(0, urgent=False), busy.interval)
+
+
+class CompactionTest(unittest.TestCase):
+    def setUp(self):
+        self.emulator = PtyEmulator(get_protocol('daruma', 'FS2100'))
+        self.emulator.start()
+        self.printer = FS2100(self.emulator.open_port())
+        # A tenth of the default delays, and compactions to match
+        self.busy = BusyWindow(estimate=0.1, interval=0.005)
+        self.printer.set_busy_window(self.busy)
+
+    def tearDown(self):
+        self.emulator.stop()
+
+    def testUrgent(self):
+        self.emulator.protocol.compact(0.03)
+        start = time.time()
+        self.printer.coupon_open()
+        # Polled with a backoff instead of waiting the whole estimate
+        self.failUnless(0.03 <= time.time() - start < 0.2)
+        self.failUnless(self.emulator.commands <= 6)
+        self.assertEqual(self.printer.get_busy_until(), None)
+        self.failUnless(self.busy.estimate < 0.1)
+
+    def testDeferred(self):
+        self.busy.estimate = 0.03
+        self.emulator.protocol.compact(0.03)
+        self.printer.get_serial()
+        self.failUnless(self.emulator.commands <= 3)
+
+    def testTimeout(self):
+        self.printer.compaction_timeout = 0.02
+        self.emulator.protocol.compact(5)
+        self.assertRaises(DriverError, self.printer.coupon_open)
+        self.failUnless(self.printer.get_busy_until() is not None)
+        self.assertRaises(DriverError, self.printer.till_add_cash, 1)
+        self.emulator.protocol.busy_until = 0
+        self.printer.coupon_open()
+        self.assertEqual(self.printer.get_busy_until(), None)
+        # The late replies to the refused commands were all read
+        commands = self.emulator.commands
+        self.failUnless(self.printer.get_serial())
+        self.assertEqual(self.emulator.commands, commands + 1)
+
+
+class HealthTest(unittest.TestCase):
+    def testFailFast(self):
+        port = _OfflinePort()
+        driver = _Driver(port)
+        for i in range(2):
+            self.assertRaises(PrinterOfflineError, driver.send_command, 'X')
+        self.assertEqual(port.written, '\x1bX\x1bX')
+        self.assertEqual(driver.get_breaker().get_state(), OPEN)
+        self.assertRaises(PrinterOfflineError, driver.send_command, 'X')
+        self.assertEqual(port.written, '\x1bX\x1bX')
+
+    def testModemStatusLines(self):
+        port = _OfflinePort()
+        driver = _Driver(port)
+        driver.MODEM_STATUS_LINES = True
+        self.assertRaises(PrinterOfflineError, driver.check_health)
+        self.assertEqual(port.written, '')
+        self.assertEqual(driver.get_breaker().get_failures(), 1)
+
+    def testProbe(self):
+        emulator = PtyEmulator(get_protocol('bematech', 'MP25'))
+        emulator.start()
+        try:
+            printer = FiscalPrinter(brand='bematech', model='MP25',
+                                    port=emulator.open_port())
+            breaker = printer.get_breaker()
+            breaker.add_failure()
+            breaker.add_failure()
+            self.assertRaises(PrinterOfflineError, printer.get_serial)
+            printer.check_health()
+            self.assertEqual(breaker.get_state(), CLOSED)
+            self.failUnless(printer.get_serial())
+
+            # Long operations probe the printer after a timeout
+            breaker.add_failure()
+            commands = emulator.commands
+            printer.summarize()
+            self.assertEqual(breaker.get_failures(), 0)
+            self.assertEqual(emulator.commands, commands + 2)
+        finally:
+            emulator.stop()
+
+
+class ModemStatusTest(unittest.TestCase):
+    def setUp(self):
+        self._master, slave = os.openpty()
+        self._device = os.ttyname(slave)
+        os.close(slave)
+
+    def tearDown(self):
+        os.close(self._master)
+
+    def testWaitDSR(self):
+        port = _BusyPort(self._device, busy=0.3)
+        try:
+            start = time.time()
+            cpu = thread_time()
+            self.failUnless(port.waitDSR(5))
+            # A busy wait would use the CPU for all the 0.3 seconds
+            self.failUnless(thread_time() - cpu < 0.05)
+            self.failUnless(0.3 <= time.time() - start < 1)
+        finally:
+            port.close()
+
+    def testWaitDSRTimeout(self):
+        port = _BusyPort(self._device)
+        try:
+            start = time.time()
+            self.failIf(port.waitDSR(0.2))
+            self.failUnless(0.2 <= time.time() - start < 1)
+        finally:
+            port.close()
+
+    def testBusyPrinter(self):
+        port = _BusyPort(self._device)
+        try:
+            printer = EP375(port, None)
+            printer.DSR_TIMEOUT = 0.2
+            cpu = thread_time()
+            self.assertRaises(PrinterOfflineError, printer.writeline, 'R')
+            self.failUnless(thread_time() - cpu < 0.05)
+        finally:
+            port.close()
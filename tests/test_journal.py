@@ -0,0 +1,232 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+import datetime
+from decimal import Decimal
+import os
+import tempfile
+import unittest
+
+from stoqdrivers.emulator import PtyEmulator, get_protocol
+from stoqdrivers.enum import TaxType
+from stoqdrivers.journal import Invoice, InvoiceIndex, sync
+from stoqdrivers.printers.bematech.MP4000 import TransactionParser
+from stoqdrivers.printers.fiscal import FiscalPrinter
+
+_JOURNAL = """BEMATECH MP-4000 TH FI
+
+
+
+
+
+
+
+
+
+
+EFECTIVO = 1,00
+COO:000010 CCF:000007 02/01/2013 10:20:30
+Efectivo = 10,50
+Tarjeta de Credito = 2,00
+COO:000011 CCF:000008 02/01/2013 11:00:00
+Efectivo = 3,00
+ANULACION COO:000011 02/01/2013 11:01:00
+Factura Inicial 10
+Factura Final 11
+Numero de Facturas 2
+Numero de Facturas Anuladas 1
+VERSION CAJA:0001 TIENDA:0002
+"""
+
+
+class TransactionParserTest(unittest.TestCase):
+    def testParse(self):
+        parser = TransactionParser()
+        invoices = list(parser.parse(_JOURNAL.splitlines(True)))
+        self.assertEqual(invoices, [
+            Invoice(10, 7, datetime.datetime(2013, 1, 2, 10, 20, 30),
+                    ((u'Efectivo', Decimal('10.50')),
+                     (u'Tarjeta de Credito', Decimal('2.00')))),
+            Invoice(11, 8, datetime.datetime(2013, 1, 2, 11, 0, 0),
+                    ((u'Efectivo', Decimal('3.00')), ),
+                    datetime.datetime(2013, 1, 2, 11, 1, 0))])
+        self.assertEqual(parser.summary, dict(start=10, end=11, ninvoices=2,
+                                              ncancels=1, till=1, store=2))
+
+    def testIncremental(self):
+        parser = TransactionParser()
+        lines = _JOURNAL.splitlines(True)
+        for line in lines[:15]:
+            self.assertEqual(parser.feed(line), None)
+        # The first invoice is done as soon as the second starts
+        self.assertEqual(parser.feed(lines[15]).coo, 10)
+        self.assertEqual(parser.close().coo, 11)
+        self.assertEqual(parser.close(), None)
+
+
+class InvoiceIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.filename = tempfile.mktemp()
+        index = InvoiceIndex(self.filename)
+        index.add(TransactionParser().parse(_JOURNAL.splitlines(True)))
+        index.close()
+        self.index = InvoiceIndex(self.filename)
+
+    def tearDown(self):
+        self.index.close()
+        os.unlink(self.filename)
+
+    def testQueries(self):
+        index = self.index
+        self.assertEqual(index.get_last_coo(), 11)
+        self.assertEqual(index.get(11).cancelled,
+                         datetime.datetime(2013, 1, 2, 11, 1, 0))
+        self.assertEqual(index.get(12), None)
+        self.assertEqual([i.coo for i in index.find(method=u'Efectivo')],
+                         [10, 11])
+        self.assertEqual(
+            [i.coo for i in index.find(
+                start=datetime.datetime(2013, 1, 2, 10, 30))], [11])
+        self.assertEqual(index.find(method=u'Cheque'), [])
+        self.assertEqual(index.get_total(), Decimal('12.50'))
+        self.assertEqual(index.get_total(method=u'Efectivo'),
+                         Decimal('10.50'))
+
+    def testReplace(self):
+        invoice = Invoice(10, 7, datetime.datetime(2013, 1, 2, 10, 20, 30),
+                          ((u'Cheque', Decimal('12.50')), ))
+        self.assertEqual(self.index.add([invoice]), 1)
+        self.assertEqual(self.index.get(10), invoice)
+        self.assertEqual(self.index.find(method=u'Tarjeta de Credito'), [])
+
+
+class _Driver(object):
+    # Emits an invoice for each COO, failing after 'fail' of them
+    fail = None
+
+    def __init__(self, coo):
+        self.coo = coo
+        self.ranges = []
+
+    def get_serial(self):
+        return 'SERIAL'
+
+    def get_coo(self):
+        return self.coo
+
+    def get_crz(self):
+        return 3
+
+    def iter_invoices(self, first, last):
+        self.ranges.append((first, last))
+        for coo in range(first, last + 1):
+            if coo == self.fail:
+                raise IOError
+            yield Invoice(coo, coo, datetime.datetime(2013, 1, 2))
+
+
+class SyncTest(unittest.TestCase):
+    def testIncremental(self):
+        index = InvoiceIndex()
+        driver = _Driver(5)
+        self.assertEqual(sync(driver, index), 5)
+        self.assertEqual(sync(driver, index), 0)
+        driver.coo = 7
+        self.assertEqual(sync(driver, index), 2)
+        self.assertEqual(driver.ranges, [(1, 5), (6, 7)])
+        self.assertEqual(index.get_checkpoint('SERIAL'), (7, 3))
+
+    def testResume(self):
+        index = InvoiceIndex()
+        driver = _Driver(10)
+        driver.fail = 8
+        self.assertRaises(IOError, sync, driver, index, batch_size=3)
+        # The batches committed before the failure are kept
+        self.assertEqual(index.get_checkpoint('SERIAL'), (6, 3))
+        self.assertEqual(index.get_last_coo(), 6)
+        driver.fail = None
+        self.assertEqual(sync(driver, index, batch_size=3), 4)
+        self.assertEqual(driver.ranges[-1], (7, 10))
+        self.assertEqual(len(index.find()), 10)
+
+
+class EmulatedIndexTest(unittest.TestCase):
+    def testIndexTransactions(self):
+        emulator = PtyEmulator(get_protocol('bematech', 'MP4000'))
+        emulator.start()
+        try:
+            printer = FiscalPrinter(brand='bematech', model='MP4000',
+                                    port=emulator.open_port())
+            taxcode = printer.get_tax_constant(TaxType.NONE)
+            payment = printer.get_payment_constants()[0]
+            printer.open()
+            printer.add_item(u'123', u'Item', Decimal('10'), taxcode)
+            printer.totalize()
+            printer.add_payment(payment[0], Decimal('10'))
+            printer.close()
+            now = datetime.datetime.now()
+            index = InvoiceIndex()
+            self.assertEqual(
+                printer._driver.index_transactions(now, now, index), 1)
+            invoice = index.get(1)
+            self.assertEqual(invoice.payments,
+                             ((payment[1], Decimal('10')), ))
+
+            self.assertEqual(printer.sync_journal(index), 1)
+            printer.open()
+            printer.add_item(u'123', u'Item', Decimal('5'), taxcode)
+            printer.totalize()
+            printer.add_payment(payment[0], Decimal('5'))
+            printer.close()
+            # Only the new invoice is read
+            self.assertEqual(printer.sync_journal(index), 1)
+            self.assertEqual(index.get(2).payments,
+                             ((payment[1], Decimal('5')), ))
+            self.assertEqual(printer.sync_journal(index), 0)
+        finally:
+            emulator.stop()
+
+    def testLongCOO(self):
+        # Past 9999 the COOs take the whole width of the range
+        for coo in [10000, 123455]:
+            emulator = PtyEmulator(get_protocol('bematech', 'MP4000'))
+            emulator.start()
+            try:
+                emulator.protocol.state.coo = coo
+                printer = FiscalPrinter(brand='bematech', model='MP4000',
+                                        port=emulator.open_port())
+                taxcode = printer.get_tax_constant(TaxType.NONE)
+                payment = printer.get_payment_constants()[0]
+                printer.open()
+                printer.add_item(u'123', u'Item', Decimal('10'), taxcode)
+                printer.totalize()
+                printer.add_payment(payment[0], Decimal('10'))
+                printer.close()
+                index = InvoiceIndex()
+                index.set_checkpoint(printer.get_serial(), coo,
+                                     printer.get_crz())
+                self.assertEqual(printer.sync_journal(index), 1)
+                self.assertEqual(index.get_last_coo(), coo + 1)
+            finally:
+                emulator.stop()
@@ -0,0 +1,93 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+from decimal import Decimal
+import os
+import tempfile
+import unittest
+
+from stoqdrivers.emulator import PtyEmulator, get_protocol
+from stoqdrivers.enum import TaxType
+from stoqdrivers.ledger import SalesLedger
+from stoqdrivers.printers.fiscal import FiscalPrinter
+
+
+class SalesLedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.emulator = PtyEmulator(get_protocol('bematech', 'MP25'))
+        self.emulator.start()
+        self.printer = FiscalPrinter(brand='bematech', model='MP25',
+                                     port=self.emulator.open_port())
+        self.filename = tempfile.mktemp()
+        self.ledger = SalesLedger(self.filename)
+        self.printer.set_ledger(self.ledger)
+
+    def tearDown(self):
+        self.ledger.close()
+        os.unlink(self.filename)
+        self.emulator.stop()
+
+    def _sell(self, *prices):
+        printer = self.printer
+        taxcode = printer.get_tax_constant(TaxType.NONE)
+        payment = printer.get_payment_constants()[0][0]
+        printer.open()
+        item_ids = [printer.add_item(u'123', u'Item', price, taxcode)
+                    for price in prices]
+        total = printer.totalize()
+        printer.add_payment(payment, total)
+        return printer.close(), item_ids
+
+    def testSales(self):
+        printer = self.printer
+        coo, item_ids = self._sell(Decimal('10'), Decimal('5'))
+        self._sell(Decimal('3'))
+        printer.cancel_last_coupon()
+        printer.open()
+        item_id = printer.add_item(u'1', u'x', Decimal('1'),
+                                   printer.get_tax_constant(TaxType.NONE))
+        printer.cancel_item(item_id)
+        printer.cancel()
+        printer.till_add_cash(Decimal('10'))
+        printer.till_remove_cash(Decimal('4'))
+
+        # Reopened, as after a crash
+        self.ledger.close()
+        self.ledger = SalesLedger(self.filename)
+        ledger = self.ledger
+        self.assertEqual(ledger.get_sales(), (1, Decimal('15')))
+        payment = printer.get_payment_constants()[0][0]
+        self.assertEqual(ledger.get_payment_totals(),
+                         {payment: Decimal('15')})
+        self.assertEqual(ledger.get_tax_totals(),
+                         {printer.get_tax_constant(TaxType.NONE):
+                          Decimal('15')})
+        self.assertEqual(ledger.get_cash_total(), Decimal('6'))
+        coupon = ledger.get_coupon(coo)
+        self.assertEqual([item['item_id'] for item in coupon['items']],
+                         item_ids)
+        self.assertEqual(coupon['total'], Decimal('15'))
+        self.assertEqual(coupon['cancelled'], None)
+        self.failIf(ledger.get_coupon(coo + 1)['cancelled'] is None)
+        self.assertEqual(ledger.get_last_coo(), coo + 1)
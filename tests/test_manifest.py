@@ -0,0 +1,85 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+import sys
+import unittest
+
+from stoqdrivers.interfaces import ICouponPrinter, IChequePrinter
+from stoqdrivers.manifest import get_driver_info
+from stoqdrivers.manifest import validate_manifest
+from stoqdrivers.printers.base import (get_supported_printers,
+                                       get_supported_printers_by_iface)
+from stoqdrivers.scales.base import get_supported_scales
+
+
+class ManifestTest(unittest.TestCase):
+    def testUpToDate(self):
+        self.assertEqual(validate_manifest(), [])
+
+    def testListingDoesNotImport(self):
+        # The modules are put back afterwards, the ones importing them
+        # would be left with their globals cleared otherwise
+        removed = {}
+        for module in sys.modules.keys():
+            if module.startswith('stoqdrivers.printers.epson.'):
+                removed[module] = sys.modules.pop(module)
+        try:
+            printers = get_supported_printers()
+            self.assertEqual([info.model for info in printers['epson']],
+                             ['FBII', 'FBIII'])
+            self.failIf('stoqdrivers.printers.epson.FBII' in sys.modules)
+        finally:
+            sys.modules.update(removed)
+
+    def testSupported(self):
+        printers = get_supported_printers()
+        self.failIf('virtual' in printers)
+        self.assertEqual([info.model for info in printers['dataregis']],
+                         ['Quick'])
+
+    def testInterfaces(self):
+        cheque = get_supported_printers_by_iface(IChequePrinter)
+        self.assertEqual(sorted(cheque.keys()),
+                         ['dataregis', 'elgin', 'perto'])
+        coupon = get_supported_printers_by_iface(ICouponPrinter)
+        self.failUnless('bematech' in coupon)
+        self.assertEqual(get_supported_scales().keys(), ['toledo'])
+
+    def testLoad(self):
+        info = get_driver_info('printers', 'bematech', 'MP25')
+        driver_class = info.load()
+        self.assertEqual(driver_class.__name__, 'MP25')
+        self.assertEqual(info.model_name, driver_class.model_name)
+        self.failUnless(ICouponPrinter.implementedBy(driver_class))
+        # Attributes not in the manifest come from the driver class
+        self.assertEqual(info.coupon_printer_charset,
+                         driver_class.coupon_printer_charset)
+
+    def testLookupMissing(self):
+        self.assertEqual(get_driver_info('printers', 'bematech', 'XX'),
+                         None)
+
+
+if __name__ == '__main__':
+    unittest.main()
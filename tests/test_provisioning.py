@@ -0,0 +1,159 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+from decimal import Decimal
+import unittest
+
+from stoqdrivers.emulator import PtyEmulator, get_protocol
+from stoqdrivers.exceptions import DriverError
+from stoqdrivers.printers.fiscal import FiscalPrinter
+from stoqdrivers.provisioning import (ADD, DELETE, WRITE, Table, get_changes,
+                                      provision)
+
+
+class _MemoryTable(Table):
+    def __init__(self, entries, size=None, can_delete=False):
+        Table.__init__(self, None)
+        self.entries = entries
+        self.size = size
+        self.can_delete = can_delete
+
+    def read(self):
+        return dict(self.entries)
+
+    def write(self, slot, entry):
+        if slot is None:
+            slot = len(self.entries)
+        self.entries[slot] = entry
+
+    def delete(self, slot):
+        del self.entries[slot]
+
+
+class ChangesTest(unittest.TestCase):
+    def testKeep(self):
+        table = _MemoryTable({}, size=4, can_delete=True)
+        self.assertEqual(get_changes(table, {0: 'a', 2: 'b'}, ['b', 'a']),
+                         [])
+
+    def testReplace(self):
+        table = _MemoryTable({}, size=4, can_delete=True)
+        self.assertEqual(
+            get_changes(table, {0: 'a', 1: 'x', 2: 'y'}, ['a', 'b']),
+            [(WRITE, 1, 'b'), (DELETE, 2, None)])
+
+    def testFreeSlots(self):
+        table = _MemoryTable({}, size=3)
+        self.assertEqual(get_changes(table, {1: 'x'}, ['a', 'b']),
+                         [(WRITE, 1, 'a'), (WRITE, 0, 'b')])
+        self.assertRaises(DriverError, get_changes, table, {1: 'x'},
+                          ['a', 'b', 'c', 'd'])
+
+    def testAppend(self):
+        table = _MemoryTable({})
+        self.assertEqual(get_changes(table, {0: 'a', 1: 'x'}, ['a', 'b', 'b']),
+                         [(ADD, None, 'b')])
+
+    def testProvision(self):
+        table = _MemoryTable({0: 'a', 1: 'x'}, size=2, can_delete=True)
+        self.assertEqual(provision(dict(t=table), dict(t=['b'])),
+                         [('t', WRITE, 0, 'b'), ('t', DELETE, 1, None)])
+        self.assertEqual(table.entries, {0: 'b'})
+        self.assertEqual(provision(dict(t=table), dict(t=['b'])), [])
+        self.assertRaises(DriverError, provision, dict(t=table),
+                          dict(other=['b']))
+
+
+class EmulatedProvisioningTest(unittest.TestCase):
+    taxes = [(Decimal('17.00'), False),
+             (Decimal('7.00'), False),
+             (Decimal('2.00'), True)]
+    payment_methods = [(u'Cheque', False),
+                       (u'Cartao Credito', True),
+                       (u'Vale Compra', False)]
+
+    def _provision(self, brand, model):
+        emulator = PtyEmulator(get_protocol(brand, model))
+        emulator.start()
+        try:
+            printer = FiscalPrinter(brand=brand, model=model,
+                                    port=emulator.open_port())
+            changes = printer.provision(self.taxes, self.payment_methods)
+            self.failUnless(changes)
+            self.failUnless(Decimal('7.00') in
+                            [value for tax, code, value in
+                             printer.get_tax_constants()])
+            self.failUnless(u'Vale Compra' in
+                            [name for code, name in
+                             printer.get_payment_constants()])
+            commands = emulator.commands
+            self.assertEqual(printer.provision(self.taxes,
+                                               self.payment_methods), [])
+            return changes, emulator.commands - commands
+        finally:
+            emulator.stop()
+
+    def testFiscNet(self):
+        changes, commands = self._provision('fiscnet', 'FiscNetECF')
+        self.assertEqual(
+            [(name, action, slot) for name, action, slot, entry in changes],
+            [('payment_methods', WRITE, 1),
+             ('payment_methods', WRITE, 2),
+             ('taxes', WRITE, 1),
+             ('taxes', WRITE, 2),
+             ('taxes', DELETE, 3),
+             ('taxes', DELETE, 4),
+             ('taxes', DELETE, 5)])
+        # The tables are read in two bursts and nothing is written
+        self.assertEqual(commands, 15 + 16)
+
+    def testDaruma(self):
+        changes, commands = self._provision('daruma', 'FS345')
+        self.assertEqual(
+            [(name, action, slot) for name, action, slot, entry in changes],
+            [('payment_methods', WRITE, 0),
+             ('payment_methods', WRITE, 1),
+             ('taxes', ADD, None),
+             ('taxes', ADD, None)])
+        self.assertEqual(commands, 2)
+
+    def testBematech(self):
+        changes, commands = self._provision('bematech', 'MP25')
+        self.assertEqual(
+            [(name, action, slot) for name, action, slot, entry in changes],
+            [('payment_methods', ADD, None),
+             ('taxes', ADD, None),
+             ('taxes', ADD, None)])
+        self.assertEqual(commands, 3)
+
+    def testNotImplemented(self):
+        emulator = PtyEmulator(get_protocol('epson', 'FBII'))
+        emulator.start()
+        try:
+            printer = FiscalPrinter(brand='epson', model='FBII',
+                                    port=emulator.open_port())
+            self.assertRaises(NotImplementedError, printer.provision,
+                              self.taxes)
+        finally:
+            emulator.stop()
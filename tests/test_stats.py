@@ -0,0 +1,116 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+import os
+import tempfile
+import unittest
+
+from stoqdrivers.emulator import PtyEmulator, get_protocol
+from stoqdrivers.exceptions import DriverError
+from stoqdrivers.printers.fiscal import FiscalPrinter
+from stoqdrivers.serialbase import SerialBase, VirtualPort
+from stoqdrivers.stats import (BUCKETS, DriverStats, Histogram, format_code,
+                               instrumented)
+
+
+class _Driver(SerialBase):
+    @instrumented()
+    def send(self, command):
+        self.write(command)
+        return self.readline()
+
+
+class HistogramTest(unittest.TestCase):
+    def testBuckets(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.get_quantile(0.5), None)
+        for value in [0.00005, 0.0001, 0.01, 0.01, 1000]:
+            histogram.add(value)
+        self.assertEqual(histogram.counts[0], 2)
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.get_quantile(0.2), BUCKETS[0])
+        self.assertEqual(histogram.get_quantile(0.8), 0.0128)
+        self.assertEqual(histogram.get_quantile(1), None)
+
+    def testFormatCode(self):
+        self.assertEqual(format_code(63), '63')
+        self.assertEqual(format_code('0A07'), '0A07')
+        self.assertEqual(format_code('\x1cF\xc9'), '0x1c46c9')
+
+
+class DriverStatsTest(unittest.TestCase):
+    def testDisabled(self):
+        driver = _Driver(VirtualPort())
+        self.assertEqual(driver.get_stats(), None)
+        self.assertRaises(DriverError, driver.send, 'X')
+
+    def testTimeout(self):
+        stats = DriverStats('test')
+        driver = _Driver(VirtualPort())
+        driver.enable_stats(stats)
+        self.assertRaises(DriverError, driver.send, 'X')
+        command = stats.get_command('X')
+        self.assertEqual(command.count, 1)
+        self.assertEqual(command.bytes_written, 1)
+        self.assertEqual(command.bytes_read, 0)
+        self.assertEqual(command.timeouts, 1)
+        self.assertEqual(command.retries, 11)
+        self.assertEqual(command.write_time.count, 1)
+        self.assertEqual(command.first_byte_time.count, 0)
+
+    def testPrinter(self):
+        emulator = PtyEmulator(get_protocol('bematech', 'MP25'))
+        emulator.start()
+        try:
+            printer = FiscalPrinter(brand='bematech', model='MP25',
+                                    port=emulator.open_port())
+            stats = DriverStats('MP25')
+            printer.enable_stats(stats)
+            self.failUnless(printer.get_stats() is stats)
+            printer.get_coo()
+            printer.get_coo()
+        finally:
+            emulator.stop()
+        commands = stats.get_commands()
+        self.assertEqual(sum([c.count for c in commands]), 2)
+        command = commands[0]
+        self.assertEqual(command.first_byte_time.count, 2)
+        self.failUnless(command.bytes_read > 0)
+        self.failUnless(command.last_byte_time.sum >=
+                        command.first_byte_time.sum)
+
+        filename = tempfile.mktemp()
+        stats.write_prometheus(filename)
+        try:
+            text = open(filename).read()
+        finally:
+            os.unlink(filename)
+        self.failUnless(
+            'stoqdrivers_commands_total{driver="MP25",cmd="%s"} 2' % (
+                command.code, ) in text)
+        self.failUnless(
+            'stoqdrivers_first_byte_seconds_bucket'
+            '{driver="MP25",cmd="%s",le="+Inf"} 2' % (
+                command.code, ) in text)
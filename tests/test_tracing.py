@@ -0,0 +1,131 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+import datetime
+from decimal import Decimal
+import json
+import os
+import tempfile
+import unittest
+
+from stoqdrivers.emulator import PtyEmulator, get_protocol
+from stoqdrivers.enum import TaxType
+from stoqdrivers.printers.fiscal import FiscalPrinter
+from stoqdrivers.stats import DriverStats
+from stoqdrivers.tracing import Tracer
+
+
+class TracerTest(unittest.TestCase):
+    def setUp(self):
+        self.filename = tempfile.mktemp()
+        self.emulator = PtyEmulator(get_protocol('fiscnet', 'FiscNetECF'))
+        self.emulator.start()
+        self.printer = FiscalPrinter(brand='fiscnet', model='FiscNetECF',
+                                     port=self.emulator.open_port())
+
+    def tearDown(self):
+        self.emulator.stop()
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+    def _get_traces(self):
+        return [json.loads(line) for line in open(self.filename)]
+
+    def testAddItem(self):
+        stats = DriverStats()
+        self.printer.enable_stats(stats)
+        tracer = Tracer(self.filename, baudrate=9600)
+        self.printer.enable_tracing(tracer)
+        taxcode = self.printer.get_tax_constant(TaxType.NONE)
+        self.printer.open()
+        self.printer.add_item(u'123', u'Item one', Decimal('10'), taxcode)
+        self.printer.enable_tracing(None)
+        tracer.close()
+        self.failUnless(self.printer.get_stats() is stats)
+
+        traces = self._get_traces()
+        self.assertEqual(set([t['kind'] for t in traces[:-2]]),
+                         set(['command']))
+        self.assertEqual([t['name'] for t in traces[-2:]],
+                         ['open', 'add_item'])
+        trace = traces[-1]
+        spans = trace['spans']
+        self.assertEqual(spans[0]['name'], 'validate')
+        self.assertEqual(spans[1]['name'], 'encode')
+        commands = [s for s in spans if s['kind'] == 'command']
+        self.assertEqual(trace['commands'], len(commands))
+        self.failUnless('VendeItem' in [s['name'] for s in commands])
+        for span in commands:
+            self.assertEqual(
+                span['wire_time'],
+                (span['bytes_written'] + span['bytes_read']) * 10 / 9600.0)
+        self.assertAlmostEqual(
+            trace['host_time'],
+            trace['duration'] - sum([s['duration'] for s in commands]))
+        self.assertEqual(sum([c.count for c in stats.get_commands()]),
+                         len(traces) - 2 + len(commands) +
+                         traces[-2]['commands'])
+
+    def testIterMemory(self):
+        emulator = PtyEmulator(get_protocol('bematech', 'MP25'))
+        emulator.start()
+        try:
+            printer = FiscalPrinter(brand='bematech', model='MP25',
+                                    port=emulator.open_port())
+            printer.till_add_cash(Decimal('10'))
+            printer.close_till()
+            tracer = Tracer(self.filename)
+            printer.enable_tracing(tracer)
+            today = datetime.date.today()
+            lines = printer.till_iter_memory(today, today)
+            self.failUnless(list(lines))
+            tracer.close()
+        finally:
+            emulator.stop()
+        # The span lasts until the whole report was read
+        trace = self._get_traces()[-1]
+        self.assertEqual(trace['name'], 'till_iter_memory')
+        self.assertEqual([s['kind'] for s in trace['spans']],
+                         ['command'] * trace['commands'])
+        self.failUnless(trace['commands'])
+
+    def testLazy(self):
+        printer = FiscalPrinter(brand='fiscnet', model='FiscNetECF',
+                                port=self.emulator.open_port(), lazy=True)
+        commands = self.emulator.commands
+        tracer = Tracer(self.filename)
+        printer.enable_tracing(tracer)
+        self.failIf(printer.is_connected())
+        self.assertEqual(self.emulator.commands, commands)
+        # The commands of the setup are traced too
+        printer.open()
+        tracer.close()
+        traces = self._get_traces()
+        self.assertEqual(traces[-1]['name'], 'open')
+        self.assertEqual(sum([t.get('commands', 1) for t in traces]),
+                         self.emulator.commands - commands)
+
+    def testDisabled(self):
+        self.printer.open()
+        self.failIf(os.path.exists(self.filename))
@@ -0,0 +1,165 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+from decimal import Decimal
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from stoqdrivers.printers.virtual.journal import StateJournal
+from stoqdrivers.printers.virtual.output import (create_output, FileOutput,
+                                                 MemoryOutput, NullOutput)
+from stoqdrivers.printers.virtual.Simple import Simple
+
+
+class OutputTest(unittest.TestCase):
+    def testMemoryIsBounded(self):
+        output = MemoryOutput(max_lines=3)
+        for i in range(10):
+            output.feed('line %d\n' % i)
+        output.feed('partial')
+        self.assertEqual(output.get_lines(), ['line 7', 'line 8', 'line 9'])
+        self.assertEqual(output.get_text(),
+                         'line 7\nline 8\nline 9\npartial')
+
+    def testFeedLine(self):
+        output = MemoryOutput()
+        output.feed_line()
+        output.feed_line('X')
+        self.assertEqual(output.get_lines(),
+                         ['-' * 60, '-' * 28 + ' X ' + '-' * 28])
+
+    def testFile(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            output = FileOutput(filename)
+            output.feed(u'Hollyw\xf3\xf3d\n')
+            output.close()
+            self.assertEqual(open(filename).read(), 'Hollyw\xc3\xb3\xc3\xb3d\n')
+        finally:
+            os.unlink(filename)
+
+    def testCreate(self):
+        self.failUnless(isinstance(create_output(None, 'null'), NullOutput))
+        output = create_output(None, 'memory:5')
+        self.assertEqual(output.get_lines(), [])
+        self.assertRaises(ValueError, create_output, None, 'file')
+        self.assertRaises(ValueError, create_output, None, 'paper')
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def testReplay(self):
+        journal = StateJournal(self.dirname)
+        self.assertEqual(journal.load(), {})
+        journal.record(coo=1, ccf=1)
+        journal.record(coo=2)
+        journal.close()
+        self.assertEqual(StateJournal(self.dirname).load(),
+                         dict(coo=2, ccf=1))
+
+    def testCompact(self):
+        journal = StateJournal(self.dirname, compact_every=3)
+        for i in range(7):
+            journal.record(coo=i)
+        journal.close()
+        self.assertEqual(len(open(os.path.join(self.dirname,
+                                               'journal.log')).readlines()),
+                         1)
+        self.assertEqual(StateJournal(self.dirname).load(), dict(coo=6))
+
+    def testTruncatedRecord(self):
+        journal = StateJournal(self.dirname)
+        journal.record(coo=1)
+        journal.close()
+        fp = open(os.path.join(self.dirname, 'journal.log'), 'a')
+        fp.write('{"coo": 2')
+        fp.close()
+        self.assertEqual(StateJournal(self.dirname).load(), dict(coo=1))
+
+    def testRecordAfterTruncatedRecord(self):
+        journal = StateJournal(self.dirname)
+        journal.record(coo=1)
+        journal.close()
+        fp = open(os.path.join(self.dirname, 'journal.log'), 'a')
+        fp.write('{"coo": 2')
+        fp.close()
+        journal = StateJournal(self.dirname)
+        journal.record(coo=3)
+        journal.record(coo=4, ccf=2)
+        journal.close()
+        self.assertEqual(StateJournal(self.dirname).load(),
+                         dict(coo=4, ccf=2))
+
+
+class HeadlessTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _create_printer(self, output=None):
+        return Simple(None, output=output or NullOutput(),
+                      state_dir=self.dirname)
+
+    def testCoupon(self):
+        output = MemoryOutput()
+        printer = self._create_printer(output)
+        printer.coupon_open()
+        printer.coupon_add_item('01', 'Item', Decimal(10), 'T1')
+        printer.coupon_totalize()
+        printer.coupon_add_payment('M', Decimal(10))
+        printer.coupon_close()
+        self.failUnless('CUPOM SIMULADO' in output.get_lines())
+        self.failIf('gtk' in sys.modules)
+
+    def testStatePersisted(self):
+        printer = self._create_printer()
+        coo = printer.get_coo()
+        printer.coupon_open()
+        printer.coupon_add_item('01', 'Item', Decimal(10), 'T1')
+        printer.coupon_totalize()
+        printer.coupon_add_payment('M', Decimal(10))
+        printer.coupon_close()
+        printer.close_till()
+
+        printer = self._create_printer()
+        self.assertEqual(printer.get_coo(), coo + 2)
+        self.assertEqual(printer.get_ccf(), 2)
+        self.assertEqual(printer.total, Decimal(10))
+        self.assertEqual(printer.period_total, Decimal(0))
+        self.failUnless(printer.till_closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+from decimal import Decimal
+import logging
+import unittest
+
+from stoqdrivers import wirelog
+from stoqdrivers.emulator import PtyEmulator, get_protocol
+from stoqdrivers.enum import TaxType
+from stoqdrivers.printers.fiscal import FiscalPrinter
+
+
+class _Handler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        # The emulator is the device, it is not redacted
+        if not record.name.startswith('stoqdrivers.emulator'):
+            self.messages.append(record.getMessage())
+
+
+class WireLogTest(unittest.TestCase):
+    def tearDown(self):
+        wirelog.end_coupon()
+        wirelog.set_sampling(1)
+
+    def testFrame(self):
+        wirelog.add_secret('John Doe')
+        frame = wirelog.frame('\x1bJohn Doe\x1bDoe\x1bJohn Do')
+        self.assertEqual(str(frame), repr('\x1b********\x1b***\x1b**** Do'))
+        self.assertEqual('%r' % (wirelog.redacted('abc'), ), "'***'")
+        wirelog.end_coupon()
+        self.assertEqual(str(wirelog.frame('John')), repr('John'))
+
+    def testSampling(self):
+        wirelog.set_sampling(3)
+        sampled = []
+        for i in range(6):
+            wirelog.start_coupon()
+            wirelog.start_coupon()
+            sampled.append(wirelog.is_sampled())
+            wirelog.end_coupon()
+            self.failUnless(wirelog.is_sampled())
+        self.assertEqual(sampled.count(True), 2)
+        self.assertEqual(sampled[0], sampled[3])
+        wirelog.set_sampling(0)
+        self.failIf(wirelog.is_sampled())
+
+    def testIsEnabled(self):
+        logger = logging.getLogger('stoqdrivers.test.wirelog')
+        # Keep the handlers installed by the test runner out of this
+        logger.propagate = False
+        self.failIf(wirelog.is_enabled(logger))
+        handler = _Handler()
+        logger.addHandler(handler)
+        try:
+            self.failIf(wirelog.is_enabled(logger))
+            wirelog.update()
+            self.failUnless(wirelog.is_enabled(logger))
+            wirelog.start_coupon()
+            wirelog.set_sampling(0)
+            self.failIf(wirelog.is_enabled(logger))
+        finally:
+            logger.removeHandler(handler)
+            wirelog.update()
+
+    def testPrinter(self):
+        handler = _Handler()
+        logger = logging.getLogger('stoqdrivers')
+        logger.addHandler(handler)
+        wirelog.update()
+        emulator = PtyEmulator(get_protocol('bematech', 'MP25'))
+        emulator.start()
+        try:
+            printer = FiscalPrinter(brand='bematech', model='MP25',
+                                    port=emulator.open_port())
+            taxcode = printer.get_tax_constant(TaxType.NONE)
+            printer.identify_customer(u'Mary Jane Watson', u'Queens',
+                                      u'160.618.061-40')
+            printer.open()
+            printer.add_item(u'123', u'Item', Decimal('10'), taxcode)
+            printer.cancel()
+        finally:
+            emulator.stop()
+            logger.removeHandler(handler)
+            wirelog.update()
+        text = '\n'.join(handler.messages)
+        self.failUnless('>>> ' in text)
+        for secret in ['Mary', 'Watson', 'Queens', '160.618.061-40']:
+            self.failIf(secret in text, secret)
@@ -0,0 +1,83 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Stoqdrivers
+## Copyright (C) 2013 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+
+import optparse
+import sys
+import time
+
+from stoqdrivers.emulator import PtyEmulator, get_protocol, get_protocols
+
+
+def main(args):
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-b', '--brand',
+                      action="store",
+                      dest="brand",
+                      help='Printer brand')
+    parser.add_option('-m', '--model',
+                      action="store",
+                      dest="model",
+                      help='Printer model')
+    parser.add_option('-l', '--latency',
+                      action="store",
+                      dest="latency",
+                      type="float",
+                      default=0,
+                      help='Seconds spent processing each command')
+    parser.add_option('-s', '--speed',
+                      action="store",
+                      dest="baudrate",
+                      type="int",
+                      help='Baud rate of the emulated serial line')
+    parser.add_option('', '--list',
+                      action="store_true",
+                      dest="list",
+                      help='List the emulated printers')
+
+    options, args = parser.parse_args(args)
+    if options.list:
+        for brand, model in get_protocols():
+            print brand, model
+        return 0
+    if not options.brand or not options.model:
+        raise SystemExit("Need a brand and a model")
+
+    emulator = PtyEmulator(get_protocol(options.brand, options.model),
+                           latency=options.latency,
+                           baudrate=options.baudrate)
+    print 'Emulating %s %s on %s' % (options.brand, options.model,
+                                     emulator.start())
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    emulator.stop()
+    print '%d commands processed' % (emulator.commands,)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))